@@ -0,0 +1,45 @@
+import numpy as np
+import errno
+import hashlib
+import os
+import tempfile
+
+# Files of NumPy arrays that are computed from the contents of some input files and shared between jobs through a
+# common directory. The name of a file is derived from the contents of the input files, from any additional settings
+# and from a version tag, which is to be incremented whenever the code that computes the arrays changes.
+
+def get_cache_file(cacheDir, name, version, fileNames, extras = ()):
+  if not cacheDir:
+    return None
+  digest = hashlib.sha1()
+  digest.update(('version %s' % str(version)).encode('utf-8'))
+  for fileName in fileNames:
+    with open(fileName, 'rb') as fileObj:
+      for chunk in iter(lambda: fileObj.read(1 << 20), b''):
+        digest.update(chunk)
+  for extra in extras:
+    digest.update(str(extra).encode('utf-8'))
+  return os.path.join(cacheDir, "{}_{}.npz".format(name, digest.hexdigest()))
+
+def load_arrays(fileName):
+  with np.load(fileName) as data:
+    return { key : data[key] for key in data.files }
+
+def save_arrays(fileName, **arrays):
+  dirName = os.path.dirname(fileName)
+  if dirName:
+    try:
+      os.makedirs(dirName)
+    except OSError as err:
+      # another job may have created the directory in the meantime
+      if err.errno != errno.EEXIST or not os.path.isdir(dirName):
+        raise
+  # write to a temporary file first so that concurrent jobs never read an incomplete file
+  fileDescriptor, tmpFileName = tempfile.mkstemp(suffix = '.npz', dir = dirName or None)
+  with os.fdopen(fileDescriptor, 'wb') as fileObj:
+    np.savez(fileObj, **arrays)
+  # mkstemp() makes the file readable only by its owner, whereas the cache may be shared with other users
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(tmpFileName, 0o666 & ~umask)
+  os.rename(tmpFileName, fileName)
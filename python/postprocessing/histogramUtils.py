@@ -0,0 +1,29 @@
+import numpy as np
+
+# Conversions between 1D histograms and NumPy arrays of the sums of weights and of the sums of squared weights in
+# their bins, which are used by the modules that write their results as histograms and by the readers of these.
+
+def create_histogram(histogram_type, histogramName, histogramTitle, histogramMin, histogramMax, sumw, sumw2, nofEntries):
+  nofBins = len(sumw)
+  histogram = histogram_type(histogramName, histogramTitle, nofBins, histogramMin, histogramMax)
+  # the arrays include the under- and overflow bins
+  content = np.zeros(nofBins + 2, dtype = np.float64)
+  content[1:-1] = sumw
+  error = np.zeros(nofBins + 2, dtype = np.float64)
+  error[1:-1] = np.sqrt(sumw2)
+  histogram.SetContent(content)
+  histogram.SetError(error)
+  histogram.ResetStats()
+  histogram.SetEntries(nofEntries)
+  return histogram
+
+def read_histogram(histogram):
+  # returns the bin contents and the sums of squared weights, without the under- and overflow bins
+  nofBins = histogram.GetNbinsX()
+  content = histogram.GetArray()
+  content.SetSize(nofBins + 2)
+  sumw = np.frombuffer(content, dtype = np.float64, count = nofBins + 2)[1:-1].copy()
+  error = histogram.GetSumw2().GetArray()
+  error.SetSize(nofBins + 2)
+  sumw2 = np.frombuffer(error, dtype = np.float64, count = nofBins + 2)[1:-1].copy()
+  return sumw, sumw2
@@ -1,15 +1,32 @@
 import ROOT
 import numpy as np
 import collections
+import contextlib
+import bisect
+import json
+import os
+import shutil
+import tempfile
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 
 from tthAnalysis.NanoAODTools.tHweights_cfi import thIdxs
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import readGenCollection
+from tthAnalysis.NanoAODTools.postprocessing.histogramUtils import create_histogram, read_histogram
 
 REF_GENWEIGHT_LIMIT = 3
+REF_GENWEIGHT_AUTO = 'auto'
+# |genWeight| is binned logarithmically such that the clipping limit at REF_GENWEIGHT_LIMIT times the center of any bin
+# coincides with a bin edge; all events with zero genWeight are collected into a separate bin
+GENWEIGHT_BIN_WIDTH = np.log(REF_GENWEIGHT_LIMIT) / 8.5
+GENWEIGHT_BIN_ZERO = -2**62
+# prefix of the histograms written in the compact output layout, see CountHistogramReader
+COMPACT_PREFIX = 'CountHistograms'
+# histogram that records the reference genWeight used in the clipping, in both output layouts, see read_refGenWeight()
+REF_GENWEIGHT_HISTOGRAM_NAME = 'refGenWeight'
+COLUMNAR_CHUNK_SIZE = 5000
 
 def clip(value, min_val = -10., max_val = 10.):
   return min(max(value, min_val), max_val)
@@ -20,9 +37,240 @@ def clip_genWeight(genWeight, ref_genWeight):
     min_val = -max_val
     return clip(genWeight, min_val = min_val, max_val = max_val)
 
+def get_tree_entry(event):
+  # the entry number of the event in the input tree; if the post-processor has preselected the events, the event loop
+  # counts the entries within the entry list of the preselection
+  entryList = getattr(event._tree, '_entrylist', None)
+  return entryList.GetEntry(event._entry) if entryList else event._entry
+
+@contextlib.contextmanager
+def attached_entry_list(inputTree, entryList):
+  # makes TTree::Draw() loop over the entries in the given list, with the first entry and the number of entries
+  # counted within the list; yields the number of entries in the list
+  previousEntryList = inputTree.GetEntryList()
+  inputTree.SetEntryList(entryList)
+  try:
+    yield entryList.GetN()
+  finally:
+    inputTree.SetEntryList(previousEntryList)
+
+def get_genWeightBins(absGenWeights):
+  absGenWeights = np.asarray(absGenWeights, dtype = np.float64)
+  genWeightBins = np.full(absGenWeights.shape, GENWEIGHT_BIN_ZERO, dtype = np.int64)
+  isNonZero = absGenWeights > 0.
+  genWeightBins[isNonZero] = np.floor(np.log(absGenWeights[isNonZero]) / GENWEIGHT_BIN_WIDTH)
+  return genWeightBins
+
+class AuxBinRouter(object):
+  # Assigns events to (possibly overlapping) bins that are given as boxes of half-open intervals [lo, hi) in a few
+  # variables. The edges of each variable are sorted once, every cell of the resulting grid is mapped to the list of
+  # bins that contain it, and the lookup of an event takes one bisection per variable, irrespective of the number of bins.
+  # Each variable has an extra slot for NaN values, which are in no interval: an event with a NaN value is only routed
+  # to the bins that do not constrain the corresponding variable.
+
+  def __init__(self, variables, bins):
+    # variables: OrderedDict of variable names to the transformations applied to their values (or None)
+    # bins: list of dicts mapping the variable names to the intervals; missing variables are unconstrained
+    self.variables = variables
+    self.edges = collections.OrderedDict()
+    for variable in self.variables:
+      edges = set()
+      for binIntervals in bins:
+        if variable in binIntervals:
+          edges.update(edge for edge in binIntervals[variable] if np.isfinite(edge))
+      self.edges[variable] = sorted(edges)
+    self.strides = []
+    nofCells = 1
+    for variable in reversed(self.variables):
+      self.strides.insert(0, nofCells)
+      nofCells *= self.getNaNSlot(variable) + 1
+
+    cellBins = [ [] for cellIdx in range(nofCells) ]
+    for binIdx, binIntervals in enumerate(bins):
+      for cellIdx in range(nofCells):
+        if all(self.isCovered(variable, cellIdx // stride % (self.getNaNSlot(variable) + 1), binIntervals)
+               for variable, stride in zip(self.variables, self.strides)):
+          cellBins[cellIdx].append(binIdx)
+    maxBins = max(len(binIdxs) for binIdxs in cellBins)
+    self.cellBins = cellBins
+    self.cellBinsArr = np.full((nofCells, maxBins), -1, dtype = np.int64)
+    for cellIdx, binIdxs in enumerate(cellBins):
+      self.cellBinsArr[cellIdx, :len(binIdxs)] = binIdxs
+
+  def getNaNSlot(self, variable):
+    return len(self.edges[variable]) + 1
+
+  def isCovered(self, variable, slotIdx, binIntervals):
+    if variable not in binIntervals:
+      return True
+    if slotIdx == self.getNaNSlot(variable):
+      return False
+    edges = self.edges[variable]
+    slot_lo = edges[slotIdx - 1] if slotIdx > 0 else -np.inf
+    slot_hi = edges[slotIdx] if slotIdx < len(edges) else np.inf
+    lo, hi = binIntervals[variable]
+    return lo <= slot_lo and slot_hi <= hi
+
+  def getValue(self, variable, value):
+    transformation = self.variables[variable]
+    return transformation(value) if transformation else value
+
+  def route(self, values):
+    # returns the indices of the bins that contain the event
+    cellIdx = 0
+    for variable, stride in zip(self.variables, self.strides):
+      value = self.getValue(variable, values[variable])
+      slotIdx = self.getNaNSlot(variable) if np.isnan(value) else bisect.bisect_right(self.edges[variable], value)
+      cellIdx += slotIdx * stride
+    return self.cellBins[cellIdx]
+
+  def routeColumns(self, columns, nofEntries):
+    # returns the mask of shape (event, bin)
+    cellIdxs = np.zeros(nofEntries, dtype = np.int64)
+    for variable, stride in zip(self.variables, self.strides):
+      values = self.getValue(variable, columns[variable])
+      slotIdxs = np.digitize(values, self.edges[variable])
+      slotIdxs[np.isnan(values)] = self.getNaNSlot(variable)
+      cellIdxs += slotIdxs * stride
+    binIdxs = self.cellBinsArr[cellIdxs]
+    binMask = np.zeros((nofEntries, binIdxs.max() + 1 if binIdxs.size else 0), dtype = bool)
+    entryIdxs, matchIdxs = np.nonzero(binIdxs >= 0)
+    binMask[entryIdxs, binIdxs[entryIdxs, matchIdxs]] = True
+    return binMask
+
+def pad_accumulator(accumulator, nofBins):
+  # extends the variation bin axis of the sums with zeros
+  nofBins_acc = accumulator['sumw'].shape[-1]
+  if nofBins > nofBins_acc:
+    padding = [ (0, 0) ] * (accumulator['sumw'].ndim - 1) + [ (0, nofBins - nofBins_acc) ]
+    accumulator['sumw'] = np.pad(accumulator['sumw'], padding, 'constant')
+    accumulator['sumw2'] = np.pad(accumulator['sumw2'], padding, 'constant')
+  return accumulator
+
+def add_to_spill_file(spillPath, array):
+  # adds the array to the one stored in the file; the sums are updated in place, unless the variation bin axis of the
+  # stored array has to be extended, in which case the file is rewritten
+  if not os.path.exists(spillPath):
+    np.save(spillPath, array)
+    return
+  spilledArray = np.load(spillPath, mmap_mode = 'r+')
+  if spilledArray.shape[-1] >= array.shape[-1]:
+    spilledArray[..., :array.shape[-1]] += array
+    spilledArray.flush()
+    del spilledArray
+    return
+  extendedArray = array.copy()
+  extendedArray[..., :spilledArray.shape[-1]] += spilledArray
+  del spilledArray
+  np.save(spillPath, extendedArray)
+
+class AccumulatorStore(object):
+  # Keeps the accumulators of each (|genWeight| bin, family) pair within a memory budget. If the arrays that are held
+  # in memory exceed the budget, the least recently filled accumulators are added to the spill files of their keys in
+  # a scratch directory and restarted from zero on their next use. Each key has one spill file per array, so that the
+  # disk usage does not grow with the number of spills, and the store is read out one key at a time.
+
+  def __init__(self, memoryLimit = None, scratchDir = None):
+    # memoryLimit is given in MB, None disables the spilling
+    self.memoryLimit = int(memoryLimit * 1024**2) if memoryLimit is not None else None
+    self.scratchDir  = scratchDir
+    self.scratchPath = None
+    self.live        = collections.OrderedDict() # in the order of the last use
+    self.sizes       = {}
+    self.nofBytes    = 0
+    self.spilled     = collections.OrderedDict() # prefix of the spill files of each key
+    self.keyOrder    = collections.OrderedDict() # in the order of the first use
+
+  def bucket(self, genWeightBin):
+    return AccumulatorBucket(self, genWeightBin)
+
+  def genWeightBins(self):
+    return list(collections.OrderedDict((genWeightBin, None) for genWeightBin, _ in self.keyOrder))
+
+  def families(self):
+    return list(collections.OrderedDict((family, None) for _, family in self.keyOrder))
+
+  def contains(self, key):
+    return key in self.live
+
+  def get(self, key):
+    if self.memoryLimit is None:
+      return self.live[key]
+    # the order of the last use is only needed to choose the accumulators to be spilled
+    accumulator = self.live.pop(key)
+    self.live[key] = accumulator
+    return accumulator
+
+  def put(self, key, accumulator):
+    # called only when an accumulator is created or padded, since this is when its size changes
+    self.live.pop(key, None)
+    self.live[key] = accumulator
+    self.keyOrder[key] = None
+    nofBytes = sum(array.nbytes for array in accumulator.values())
+    self.nofBytes += nofBytes - self.sizes.get(key, 0)
+    self.sizes[key] = nofBytes
+    if self.memoryLimit is not None:
+      # the accumulator that was just stored is about to be filled, so it is never evicted
+      while self.nofBytes > self.memoryLimit and len(self.live) > 1:
+        self.spill(next(iter(self.live)))
+
+  def spill(self, key):
+    if self.scratchPath is None:
+      self.scratchPath = tempfile.mkdtemp(prefix = 'countHistograms_', dir = self.scratchDir)
+      print("Spilling count histograms to %s" % self.scratchPath)
+    accumulator = self.live.pop(key)
+    self.nofBytes -= self.sizes.pop(key)
+    if key not in self.spilled:
+      self.spilled[key] = os.path.join(self.scratchPath, 'spill_%d' % len(self.spilled))
+    for name, array in accumulator.items():
+      add_to_spill_file('%s_%s.npy' % (self.spilled[key], name), array)
+
+  def collect(self, genWeightBin, family):
+    # returns the total sums of the family in the given |genWeight| bin, or None if the family has not been filled in
+    # the bin; the contents of the store are not modified
+    key = (genWeightBin, family)
+    if key not in self.keyOrder:
+      return None
+    if key not in self.spilled:
+      return self.live[key]
+    accumulator = collections.OrderedDict(
+      (name, np.load('%s_%s.npy' % (self.spilled[key], name))) for name in [ 'nofEntries', 'sumw', 'sumw2' ]
+    )
+    if key in self.live:
+      part = self.live[key]
+      accumulator = pad_accumulator(accumulator, part['sumw'].shape[-1])
+      accumulator['nofEntries'] += part['nofEntries']
+      accumulator['sumw'][..., :part['sumw'].shape[-1]] += part['sumw']
+      accumulator['sumw2'][..., :part['sumw2'].shape[-1]] += part['sumw2']
+    return accumulator
+
+  def close(self):
+    if self.scratchPath is not None:
+      shutil.rmtree(self.scratchPath, ignore_errors = True)
+      self.scratchPath = None
+      self.spilled = collections.OrderedDict()
+
+class AccumulatorBucket(object):
+  # dict-like view of the accumulators of one |genWeight| bin in AccumulatorStore
+
+  def __init__(self, store, genWeightBin):
+    self.store = store
+    self.genWeightBin = genWeightBin
+
+  def __contains__(self, family):
+    return self.store.contains((self.genWeightBin, family))
+
+  def __getitem__(self, family):
+    return self.store.get((self.genWeightBin, family))
+
+  def __setitem__(self, family, accumulator):
+    self.store.put((self.genWeightBin, family), accumulator)
+
 class countHistogramProducer(Module):
 
-  def __init__(self, outputFileName, process_name, refGenWeight, compTopRwgt, compHTXS, splitByLHENjet, splitByLHEHT):
+  def __init__(self, outputFileName, process_name, refGenWeight, compTopRwgt, compHTXS, splitByLHENjet, splitByLHEHT,
+               columnar = False, chunkSize = COLUMNAR_CHUNK_SIZE, splitBy = None, families = None, outputLayout = 'legacy',
+               memoryLimit = None, scratchDir = None):
     self.puWeightName            = 'puWeight'
     self.puWeightName_up         = '%sUp' % self.puWeightName
     self.puWeightName_down       = '%sDown' % self.puWeightName
@@ -54,21 +302,49 @@ class countHistogramProducer(Module):
     self.compTopRwgt             = compTopRwgt
     self.topRwgtBranchName       = "topPtRwgt"
     self.genTopCollectionName    = "GenTop"
-    self.compHTXS                = compHTXS
-    self.splitByLHENjet          = splitByLHENjet
-    self.splitByLHEHT            = splitByLHEHT
+    self.genPartCollectionName   = "GenPart"
     self.htxsBranchName          = "HTXS_Higgs"
     self.htxsPtBranchName        = "%s_pt" % self.htxsBranchName
     self.htxsEtaBranchName       = "%s_y" % self.htxsBranchName
     self.LHENjetsBranchName      = "LHE_Njets"
     self.LHEHTBranchName         = "LHE_HT"
-    self.ref_genWeight           = abs(float(refGenWeight))
+    # if the reference genWeight is not given, it is estimated as the most probable |genWeight| while filling
+    # the sums in bins of |genWeight|, so that the genWeight can be clipped after all events have been processed;
+    # the estimate depends on the events of the job, hence it is valid only if the whole sample is processed in one job:
+    # the outputs of jobs with different estimates cannot be merged, which read_refGenWeight() detects after hadd
+    self.estimateRefGenWeight    = str(refGenWeight) == REF_GENWEIGHT_AUTO
+    self.ref_genWeight           = None if self.estimateRefGenWeight else abs(float(refGenWeight))
     self.process_name            = process_name
     self.outputFileName          = outputFileName
     self.out                     = None
-
-    if self.compHTXS and (self.splitByLHENjet or self.splitByLHEHT):
-      raise ValueError("Cannot enable HTXS binning and LHE binning simultanteously")
+    self.accumulators            = None
+    # in the columnar mode the entries that reach the module are only recorded in an entry list, and the sums are
+    # computed in endFile() from exactly these entries of the input tree, in chunks of chunkSize events; hence, the
+    # results do not depend on the preselection, on the range of processed entries or on the upstream modules
+    self.columnar                = columnar
+    self.analyzedEntries         = None
+    self.chunkSize               = int(chunkSize)
+    self.outputLayout            = outputLayout
+    # the sums that exceed memoryLimit (in MB) are moved to a temporary directory under scratchDir
+    self.memoryLimit             = memoryLimit
+    self.scratchDir              = scratchDir
+
+    if self.outputLayout not in [ 'legacy', 'compact' ]:
+      raise ValueError("Invalid output layout: %s" % self.outputLayout)
+
+    # binning schemes of the auxiliary count histograms, filled side by side in the same event loop
+    self.splitBy = []
+    if compHTXS:
+      self.splitBy.append('HTXS')
+    if splitByLHENjet and splitByLHEHT:
+      self.splitBy.append('LHENjetHT')
+    elif splitByLHENjet:
+      self.splitBy.append('LHENjet')
+    elif splitByLHEHT:
+      self.splitBy.append('LHEHT')
+    for auxBinScheme in self.assign_list(splitBy):
+      if auxBinScheme not in self.splitBy:
+        self.splitBy.append(auxBinScheme)
 
     self.ISR_down_idx = 0
     self.FSR_down_idx = 1
@@ -79,34 +355,64 @@ class countHistogramProducer(Module):
 
     self.useFullGenWeight = [ False, True ]
 
+    # histogram titles of each family; the names and titles are rendered only when the histograms are written
+    self.countFamilies = collections.OrderedDict([
+      ('',                             'sum({gen} * PU(central,up,down){rwgt}) {aux}'),
+      ('L1PrefireNom',                 'sum({gen} * PU(central,up,down){rwgt} * L1Prefire(nom)) {aux}'),
+      ('L1Prefire',                    'sum({gen} * PU(central){rwgt} * L1Prefire(nom,up,down)) {aux}'),
+      ('LHEWeightPdf',                 'sum({gen} * PU(central){rwgt} * LHE(pdf)) {aux}'),
+      ('LHEWeightPdfL1PrefireNom',     'sum({gen} * PU(central){rwgt} * LHE(pdf) * L1Prefire(nom)) {aux}'),
+      ('LHEWeightScale',               'sum({gen} * PU(central){rwgt} * LHE(scale)) {aux}'),
+      ('LHEWeightScaleL1PrefireNom',   'sum({gen} * PU(central){rwgt} * LHE(scale) * L1Prefire(nom)) {aux}'),
+      ('LHEEnvelope',                  'sum({gen} * PU(central){rwgt} * LHE(envelope up, down)) {aux}'),
+      ('LHEEnvelopeL1PrefireNom',      'sum({gen} * PU(central){rwgt} * LHE(envelope up, down) * L1Prefire(nom)) {aux}'),
+      ('PSWeight',                     'sum({gen} * PU(central){rwgt} * PS(ISR/FSR/both up, ISR/FSR/both down)) {aux}'),
+      ('PSWeightL1PrefireNom',         'sum({gen} * PU(central){rwgt} * PS(ISR/FSR/both up, ISR/FSR/both down) * L1Prefire(nom)) {aux}'),
+      # the PS weights may not average to 1 because of incorrect normalization, see
+      # https://hypernews.cern.ch/HyperNews/CMS/get/physTools/3709.html
+      # https://github.com/cms-nanoAOD/cmssw/issues/381
+      ('PSWeightOriginalXWGTUP',       'sum({gen} * PU(central){rwgt} * PS(ISR/FSR/both up, ISR/FSR/both down) * LHE(nom)) {aux}'),
+      ('PSWeightOriginalXWGTUPL1PrefireNom',
+                                       'sum({gen} * PU(central){rwgt} * PS(ISR/FSR/both up, ISR/FSR/both down) * L1Prefire(nom) * LHE(nom)) {aux}'),
+    ])
+    # histogram families that are computed and written; 'PU' stands for the family without any additional weights
+    self.families = [ '' if family == 'PU' else family for family in self.assign_list(families) ]
+    for family in self.families:
+      if family not in self.countFamilies:
+        raise ValueError("Invalid histogram family: %s" % family)
+    if not self.families:
+      self.families = list(self.countFamilies.keys())
+
+    # HTXS bins in Higgs pT, including the overlapping bins above 300 GeV; the forward bin is defined by |y| >= 2.5
+    self.htxsEtaMax = 2.5
     self.htxs = collections.OrderedDict([
-      ("fwd",         lambda pt, eta: abs(eta) >= 2.5                     ),
-      ("pt0to60",     lambda pt, eta: abs(eta) < 2.5 and         pt <  60.),
-      ("pt60to120",   lambda pt, eta: abs(eta) < 2.5 and  60. <= pt < 120.),
-      ("pt120to200",  lambda pt, eta: abs(eta) < 2.5 and 120. <= pt < 200.),
-      ("pt200to300",  lambda pt, eta: abs(eta) < 2.5 and 200. <= pt < 300.),
-      ("ptGt300",     lambda pt, eta: abs(eta) < 2.5 and 300. <= pt       ),
-      ("pt300to450",  lambda pt, eta: abs(eta) < 2.5 and 300. <= pt < 450.),
-      ("ptGt450",     lambda pt, eta: abs(eta) < 2.5 and 450. <= pt       ),
+      ("fwd",         None          ),
+      ("pt0to60",     (-np.inf,  60.)),
+      ("pt60to120",   (  60.,   120.)),
+      ("pt120to200",  ( 120.,   200.)),
+      ("pt200to300",  ( 200.,   300.)),
+      ("ptGt300",     ( 300., np.inf)),
+      ("pt300to450",  ( 300.,   450.)),
+      ("ptGt450",     ( 450., np.inf)),
     ])
 
     self.lheNjets = collections.OrderedDict([
-      ("LHENjet0", lambda lheNjet: lheNjet == 0),
-      ("LHENjet1", lambda lheNjet: lheNjet == 1),
-      ("LHENjet2", lambda lheNjet: lheNjet == 2),
-      ("LHENjet3", lambda lheNjet: lheNjet == 3),
-      ("LHENjet4", lambda lheNjet: lheNjet == 4),
+      ("LHENjet0", 0),
+      ("LHENjet1", 1),
+      ("LHENjet2", 2),
+      ("LHENjet3", 3),
+      ("LHENjet4", 4),
     ])
     self.lheHT = collections.OrderedDict([
-      ("LHEHT0to70",      lambda lhe_HT:          lhe_HT <   70.),
-      ("LHEHT70to100",    lambda lhe_HT:   70. <= lhe_HT <  100.),
-      ("LHEHT100to200",   lambda lhe_HT:  100. <= lhe_HT <  200.),
-      ("LHEHT200to400",   lambda lhe_HT:  200. <= lhe_HT <  400.),
-      ("LHEHT400to600",   lambda lhe_HT:  400. <= lhe_HT <  600.),
-      ("LHEHT600to800",   lambda lhe_HT:  600. <= lhe_HT <  800.),
-      ("LHEHT800to1200",  lambda lhe_HT:  800. <= lhe_HT < 1200.),
-      ("LHEHT1200to2500", lambda lhe_HT: 1200. <= lhe_HT < 2500.),
-      ("LHEHT2500toInf",  lambda lhe_HT: 2500. <= lhe_HT        ),
+      ("LHEHT0to70",      (-np.inf,   70.)),
+      ("LHEHT70to100",    (   70.,   100.)),
+      ("LHEHT100to200",   (  100.,   200.)),
+      ("LHEHT200to400",   (  200.,   400.)),
+      ("LHEHT400to600",   (  400.,   600.)),
+      ("LHEHT600to800",   (  600.,   800.)),
+      ("LHEHT800to1200",  (  800.,  1200.)),
+      ("LHEHT1200to2500", ( 1200.,  2500.)),
+      ("LHEHT2500toInf",  ( 2500., np.inf)),
     ])
     self.lheNjetsHT = []
     for lheNjet_key in self.lheNjets:
@@ -118,15 +424,9 @@ class countHistogramProducer(Module):
     else:
       print("NOT computing top reweighting: %s" % self.compTopRwgt)
 
-    self.histograms = collections.OrderedDict([
-      ('Count', {
-        'bins'  : 1,
-        'min'   : 0.,
-        'max'   : 2.,
-        'title' : 'sum(1)',
-      }),
-    ])
     self.lheTHXSMWeightIndices = thIdxs
+    self.lheTHXSMWeightIndicesArr = np.array(self.lheTHXSMWeightIndices, dtype = np.int64)
+    self.lheTHXSMWeightIsNominal = self.lheTHXSMWeightIndicesArr < 0
     self.topPtRwgtLabels = [ "" ]
     self.topPtRwgtTitles = [ "" ]
     if self.compTopRwgt:
@@ -134,152 +434,20 @@ class countHistogramProducer(Module):
         self.topPtRwgtLabels.extend([ "{}TopPtRwgtSF".format(choice), "{}TopPtRwgtSFSquared".format(choice) ])
         self.topPtRwgtTitles.extend([ "* top-pT({})".format(choice), "* top-pT({})^2".format(choice) ])
 
+    self.auxBinSchemes = collections.OrderedDict([
+      ('HTXS',      list(self.htxs.keys())),
+      ('LHENjet',   list(self.lheNjets.keys())),
+      ('LHEHT',     list(self.lheHT.keys())),
+      ('LHENjetHT', self.lheNjetsHT),
+    ])
     self.aux_binning = [ "" ]
-    if self.compHTXS:
-      self.aux_binning.extend(list(self.htxs.keys()))
-    elif self.splitByLHENjet and not self.splitByLHEHT:
-      self.aux_binning.extend(list(self.lheNjets.keys()))
-    elif self.splitByLHEHT and not self.splitByLHENjet:
-      self.aux_binning.extend(list(self.lheHT.keys()))
-    elif self.splitByLHENjet and self.splitByLHEHT:
-      self.aux_binning.extend(self.lheNjetsHT)
-
-    for fullGenWeight in self.useFullGenWeight:
-      for topPtRwgtIdx, topPtRwgtLabel in enumerate(self.topPtRwgtLabels):
-        for lheTHXSMWeightIndex in self.lheTHXSMWeightIndices:
-          for aux_bin in self.aux_binning:
-            do_tH = lheTHXSMWeightIndex >= 0
-            insert_title = self.topPtRwgtTitles[topPtRwgtIdx]
-            insert_title += ("* LHE(tH %d)" % lheTHXSMWeightIndex) if do_tH else ""
-            insert_name = topPtRwgtLabel
-            insert_name += ("_rwgt%d" % lheTHXSMWeightIndex) if do_tH else ""
-            suffix_title = ""
-
-            if aux_bin:
-              insert_name_empty = not bool(insert_name)
-              insert_name += "_%s" % aux_bin
-              if self.compHTXS:
-                aux_bin_name = aux_bin.replace('pt', 'Higgs pt ').replace('to', '-').replace('Gt', '> ').replace('fwd', 'forward Higgs')
-              elif self.splitByLHENjet and not self.splitByLHEHT:
-                aux_bin_name = 'LHENjets == {}'.format(aux_bin[-1])
-              elif self.splitByLHEHT and not self.splitByLHENjet:
-                aux_bin_split = aux_bin[len('LHEHT'):].split('to')
-                if aux_bin_split[1] != 'Inf':
-                  aux_bin_name = '{} <= LHEHT < {}'.format(*aux_bin_split)
-                else:
-                  aux_bin_name = 'LHEHT >= {}'.format(aux_bin_split[0])
-              elif self.splitByLHENjet and self.splitByLHEHT:
-                aux_bin_njet, aux_bin_ht = aux_bin.split('_')
-                aux_bin_name_njet = 'LHENjets == {}'.format(aux_bin_njet[-1])
-                aux_bin_split = aux_bin_ht[len('LHEHT'):].split('to')
-                if aux_bin_split[1] != 'Inf':
-                  aux_bin_name_ht = '{} <= LHEHT < {}'.format(*aux_bin_split)
-                else:
-                  aux_bin_name_ht = 'LHEHT >= {}'.format(aux_bin_split[0])
-                aux_bin_name = '{} and {}'.format(aux_bin_name_njet, aux_bin_name_ht)
-              else:
-                assert(False)
-              suffix_title += " (%s)" % aux_bin_name
-
-              insert_name_empty_key = 'Count{}'.format(insert_name)
-              if insert_name_empty and insert_name_empty_key not in self.histograms:
-                self.histograms.update([
-                  (insert_name_empty_key, {
-                    'bins'  : 1,
-                    'min'   : 0.,
-                    'max'   : 2.,
-                    'title' : 'sum(1) {}'.format(suffix_title),
-                  })
-                ])
-
-            gen_str = "gen" if fullGenWeight else "sgn(gen)"
-            prefix = "CountWeighted{}".format("Full" if fullGenWeight else "")
-            self.histograms.update([
-              ('{}{}'.format(prefix, insert_name), {
-                'bins'  : 3,
-                'min'   : -0.5,
-                'max'   : 2.5,
-                'title' : 'sum({} * PU(central,up,down){}) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}L1PrefireNom{}'.format(prefix, insert_name), {
-                'bins'  : 3,
-                'min'   : -0.5,
-                'max'   : 2.5,
-                'title' : 'sum({} * PU(central,up,down){} * L1Prefire(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}L1Prefire{}'.format(prefix, insert_name), {
-                'bins'  : 3,
-                'min'   : -0.5,
-                'max'   : 2.5,
-                'title' : 'sum({} * PU(central){} * L1Prefire(nom,up,down)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEWeightPdf{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEPdfWeight,
-                'min'   : -0.5,
-                'max'   : self.nLHEPdfWeight - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(pdf)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEWeightPdfL1PrefireNom{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEPdfWeight,
-                'min'   : -0.5,
-                'max'   : self.nLHEPdfWeight - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(pdf) * L1Prefire(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEWeightScale{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEScaleWeight,
-                'min'   : -0.5,
-                'max'   : self.nLHEScaleWeight - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(scale)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEWeightScaleL1PrefireNom{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEScaleWeight,
-                'min'   : -0.5,
-                'max'   : self.nLHEScaleWeight - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(scale) * L1Prefire(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEEnvelope{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEEnvelope,
-                'min'   : -0.5,
-                'max'   : self.nLHEEnvelope - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(envelope up, down)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}LHEEnvelopeL1PrefireNom{}'.format(prefix, insert_name), {
-                'bins'  : self.nLHEEnvelope,
-                'min'   : -0.5,
-                'max'   : self.nLHEEnvelope - 0.5,
-                'title' : 'sum({} * PU(central){} * LHE(envelope up, down) * L1Prefire(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}PSWeight{}'.format(prefix, insert_name), {
-                'bins': self.nPSweight,
-                'min': -0.5,
-                'max': self.nPSweight - 0.5,
-                'title': 'sum({} * PU(central){} * PS(ISR/FSR/both up, ISR/FSR/both down)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}PSWeightL1PrefireNom{}'.format(prefix, insert_name), {
-                'bins': self.nPSweight,
-                'min': -0.5,
-                'max': self.nPSweight - 0.5,
-                'title': 'sum({} * PU(central){} * PS(ISR/FSR/both up, ISR/FSR/both down) * L1Prefire(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              # the PS weights may not average to 1 because of incorrect normalization, see
-              # https://hypernews.cern.ch/HyperNews/CMS/get/physTools/3709.html
-              # https://github.com/cms-nanoAOD/cmssw/issues/381
-              ('{}PSWeightOriginalXWGTUP{}'.format(prefix, insert_name), {
-                'bins': self.nPSweight,
-                'min': -0.5,
-                'max': self.nPSweight - 0.5,
-                'title': 'sum({} * PU(central){} * PS(ISR/FSR/both up, ISR/FSR/both down) * LHE(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-              ('{}PSWeightOriginalXWGTUPL1PrefireNom{}'.format(prefix, insert_name), {
-                'bins': self.nPSweight,
-                'min': -0.5,
-                'max': self.nPSweight - 0.5,
-                'title': 'sum({} * PU(central){} * PS(ISR/FSR/both up, ISR/FSR/both down) * L1Prefire(nom) * LHE(nom)) {}'.format(gen_str, insert_title, suffix_title),
-              }),
-            ])
-
-    for histogramName in self.histograms:
-      self.histograms[histogramName]['histogram'] = None
+    self.aux_binSchemes = [ "" ]
+    for auxBinScheme in self.splitBy:
+      if auxBinScheme not in self.auxBinSchemes:
+        raise ValueError("Invalid binning scheme: %s" % auxBinScheme)
+      self.aux_binning.extend(self.auxBinSchemes[auxBinScheme])
+      self.aux_binSchemes.extend([ auxBinScheme ] * len(self.auxBinSchemes[auxBinScheme]))
+    self.auxBinRouter = self.buildAuxBinRouter() if len(self.aux_binning) > 1 else None
 
     self.isPrinted = {
       branchName : False for branchName in [
@@ -288,48 +456,108 @@ class countHistogramProducer(Module):
       ]
     }
 
-  def initHistograms(self, histogramNames, nofBins = -1):
-    for histogramName in histogramNames:
-      assert(histogramName in self.histograms)
-      histogramParams = self.histograms[histogramName]
-      if nofBins >= 0 and histogramParams['bins'] != nofBins:
-        histogramParams['bins'] = nofBins
-        histogramParams['max'] = nofBins - 0.5
-      histogram_type = ROOT.TH1I if histogramName == 'Count' or histogramName.startswith('Count_') else ROOT.TH1F
-      histogramParams['histogram'] = histogram_type(
-        histogramName, histogramParams['title'],
-        histogramParams['bins'], histogramParams['min'], histogramParams['max']
-      )
+  def assign_list(self, val):
+    if val is None:
+      return []
+    elif type(val) == list:
+      return val
+    elif type(val) == str:
+      return [ item for item in val.split('|') if item ]
+    else:
+      raise ValueError('Cannot convert to list: %s' % str(val))
+
+  def hasFamily(self, *families):
+    return any(family in self.families for family in families)
+
+  def getAuxBinTitle(self, aux_binIdx):
+    aux_bin = self.aux_binning[aux_binIdx]
+    aux_binScheme = self.aux_binSchemes[aux_binIdx]
+    if not aux_bin:
+      return ""
+    if aux_binScheme == 'HTXS':
+      aux_bin_name = aux_bin.replace('pt', 'Higgs pt ').replace('to', '-').replace('Gt', '> ').replace('fwd', 'forward Higgs')
+    elif aux_binScheme == 'LHENjet':
+      aux_bin_name = 'LHENjets == {}'.format(aux_bin[-1])
+    elif aux_binScheme == 'LHEHT':
+      aux_bin_split = aux_bin[len('LHEHT'):].split('to')
+      if aux_bin_split[1] != 'Inf':
+        aux_bin_name = '{} <= LHEHT < {}'.format(*aux_bin_split)
+      else:
+        aux_bin_name = 'LHEHT >= {}'.format(aux_bin_split[0])
+    elif aux_binScheme == 'LHENjetHT':
+      aux_bin_njet, aux_bin_ht = aux_bin.split('_')
+      aux_bin_name_njet = 'LHENjets == {}'.format(aux_bin_njet[-1])
+      aux_bin_split = aux_bin_ht[len('LHEHT'):].split('to')
+      if aux_bin_split[1] != 'Inf':
+        aux_bin_name_ht = '{} <= LHEHT < {}'.format(*aux_bin_split)
+      else:
+        aux_bin_name_ht = 'LHEHT >= {}'.format(aux_bin_split[0])
+      aux_bin_name = '{} and {}'.format(aux_bin_name_njet, aux_bin_name_ht)
+    else:
+      assert(False)
+    return " (%s)" % aux_bin_name
+
+  def getCountHistogramName(self, aux_binIdx):
+    aux_bin = self.aux_binning[aux_binIdx]
+    return 'Count_{}'.format(aux_bin) if aux_bin else 'Count'
+
+  def getCountHistogramTitle(self, aux_binIdx):
+    if not self.aux_binning[aux_binIdx]:
+      return 'sum(1)'
+    return 'sum(1) {}'.format(self.getAuxBinTitle(aux_binIdx))
+
+  # the histogram names and titles are assembled from the (name, title) labels of each axis
+  def getGenWeightLabel(self, genWeightIdx):
+    return ("Full", "gen") if self.useFullGenWeight[genWeightIdx] else ("", "sgn(gen)")
+
+  def getTopPtRwgtLabel(self, topPtRwgtIdx):
+    return (self.topPtRwgtLabels[topPtRwgtIdx], self.topPtRwgtTitles[topPtRwgtIdx])
+
+  def getLheTHXLabel(self, lheTHXSMWeightIdx):
+    lheTHXSMWeightIndex = self.lheTHXSMWeightIndices[lheTHXSMWeightIdx]
+    if lheTHXSMWeightIndex < 0:
+      return ("", "")
+    return ("_rwgt%d" % lheTHXSMWeightIndex, "* LHE(tH %d)" % lheTHXSMWeightIndex)
+
+  def getAuxBinLabel(self, aux_binIdx):
+    aux_bin = self.aux_binning[aux_binIdx]
+    return (("_%s" % aux_bin) if aux_bin else "", self.getAuxBinTitle(aux_binIdx))
+
+  def getHistogramName(self, family, genWeightIdx, topPtRwgtIdx, lheTHXSMWeightIdx, aux_binIdx):
+    return "CountWeighted{}{}{}{}{}".format(
+      self.getGenWeightLabel(genWeightIdx)[0], family, self.getTopPtRwgtLabel(topPtRwgtIdx)[0],
+      self.getLheTHXLabel(lheTHXSMWeightIdx)[0], self.getAuxBinLabel(aux_binIdx)[0],
+    )
+
+  def getHistogramTitle(self, family, genWeightIdx, topPtRwgtIdx, lheTHXSMWeightIdx, aux_binIdx):
+    return self.countFamilies[family].format(
+      gen  = self.getGenWeightLabel(genWeightIdx)[1],
+      rwgt = self.getTopPtRwgtLabel(topPtRwgtIdx)[1] + self.getLheTHXLabel(lheTHXSMWeightIdx)[1],
+      aux  = self.getAuxBinTitle(aux_binIdx),
+    )
 
   def clip_lhe(self, value, nominal = 1., min_val = -10., max_val = 10.):
     denom = nominal if nominal != 0. else 1.
     correctiveFactor = 2. if self.nLHEScaleWeight == 8 else 1.
-    return clip(value * correctiveFactor / denom, min_val, max_val)
-
-  def isInitialized(self, histogramNames):
-    return all(map(
-      lambda histogramName: histogramName in self.histograms and \
-                            self.histograms[histogramName]['histogram'] != None,
-      histogramNames
-    ))
+    return np.clip(np.multiply(value, correctiveFactor / denom), min_val, max_val)
 
   def compTopRwgtSF(self, genTopPt, choice):
     if choice == 'TOP16011':
       # figures from TOP-16-011
       a = 0.0615
       b = -0.0005
-      genTopPt = min(genTopPt, 800.)
+      genTopPt = np.minimum(genTopPt, 800.)
       return np.exp(a + b * genTopPt)
     elif choice == 'Linear':
       a = 0.058
       b = -0.000466
-      genTopPt = min(genTopPt, 500.)
+      genTopPt = np.minimum(genTopPt, 500.)
       return np.exp(a + b * genTopPt)
     elif choice == 'Quadratic':
       a = 0.088
       b = -0.00087
       c = 9.2e-07
-      genTopPt = min(genTopPt, 472.)
+      genTopPt = np.minimum(genTopPt, 472.)
       return np.exp(a + b * genTopPt + c * genTopPt**2)
     elif choice == 'HighPt':
       # CV: new parametrization that is valid up tp 3 TeV, given on slide 12 of the presentation by Dennis Roy in the Higgs PAG meeting on 12/05/2020:
@@ -339,7 +567,7 @@ class countHistogramProducer(Module):
       c = -1.30088e-07
       d =  5.83494e+01
       e =  1.96252e+02
-      genTopPt = min(genTopPt, 3000.)
+      genTopPt = np.minimum(genTopPt, 3000.)
       return np.exp(a + b * genTopPt + c * genTopPt**2 + d / (genTopPt + e))
     else:
       raise RuntimeError("Invalid choice: %s" % choice)
@@ -355,6 +583,15 @@ class countHistogramProducer(Module):
     genTop_neg_pt = genTops[genTop_neg_idx].pt
     return np.sqrt(self.compTopRwgtSF(genTop_pos_pt, choice) * self.compTopRwgtSF(genTop_neg_pt, choice))
 
+  def getTopRwgtSFColumn(self, nofGenTops, genTopPt, genTopPdgId, choice):
+    assert((nofGenTops == 2).all())
+    assert((genTopPdgId[:, 0] * genTopPdgId[:, 1] < 0).all())
+    assert(choice in self.topPtRwgtChoices)
+    genTop_pos_first = genTopPdgId[:, 0] > 0
+    genTop_pos_pt = np.where(genTop_pos_first, genTopPt[:, 0], genTopPt[:, 1])
+    genTop_neg_pt = np.where(genTop_pos_first, genTopPt[:, 1], genTopPt[:, 0])
+    return np.sqrt(self.compTopRwgtSF(genTop_pos_pt, choice) * self.compTopRwgtSF(genTop_neg_pt, choice))
+
   def getLHENominal(self, LHEScaleWeight):
     return LHEScaleWeight[4] if len(LHEScaleWeight) == 9 else 1.
 
@@ -369,7 +606,8 @@ class countHistogramProducer(Module):
     pass
 
   def endJob(self):
-    pass
+    if self.accumulators is not None:
+      self.accumulators.close()
 
   def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
     if wrappedOutputTree:
@@ -387,8 +625,18 @@ class countHistogramProducer(Module):
         self.out.branch(self.LHEEnvelopeNameDown, "F")
     else:
       print("NOT computing LHE envelope weights")
+    if self.accumulators is None:
+      self.initAccumulators()
+    if self.columnar:
+      self.analyzedEntries = ROOT.TEntryList(inputTree)
+      self.analyzedEntries.SetDirectory(0)
 
   def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    if self.columnar:
+      inputTreeBranchNames = [ branch.GetName() for branch in inputTree.GetListOfBranches() ]
+      with attached_entry_list(inputTree, self.analyzedEntries) as nofEvents:
+        self.processColumnar(inputTree, inputTreeBranchNames, nofEvents)
+      self.analyzedEntries = None
     out_file = None
 
     if outputFile:
@@ -400,23 +648,686 @@ class countHistogramProducer(Module):
       out_dir = out_file.mkdir(self.process_name)
       out_dir.cd()
 
-    for histogramName in self.histograms:
-      if 'histogram' in self.histograms[histogramName] and \
-         self.histograms[histogramName]['histogram'] != None:
-        self.histograms[histogramName]['histogram'].Write()
+    if self.outputLayout == 'compact':
+      self.writeCompact(self.getFinalAccumulators())
+    else:
+      self.writeLegacy(self.getFinalAccumulators())
+    self.writeRefGenWeight()
 
     if out_file:
       out_file.Close()
 
+  def writeLegacy(self, accumulators):
+    # one histogram per name; the accumulators are given as (family, accumulator) pairs
+    for aux_binIdx in np.flatnonzero(self.counts):
+      nofCounts = self.counts[aux_binIdx]
+      create_histogram(
+        ROOT.TH1I, self.getCountHistogramName(aux_binIdx), self.getCountHistogramTitle(aux_binIdx), 0., 2.,
+        [ nofCounts ], [ nofCounts ], nofCounts
+      ).Write()
+
+    for family, accumulator in accumulators:
+      nofBins = accumulator['sumw'].shape[-1]
+      for lheTHXSMWeightIdx, aux_binIdx in np.argwhere(accumulator['nofEntries'] > 0):
+        nofEntries = accumulator['nofEntries'][lheTHXSMWeightIdx, aux_binIdx]
+        for genWeightIdx in range(len(self.useFullGenWeight)):
+          for topPtRwgtIdx in range(len(self.topPtRwgtLabels)):
+            histogramIdx = (genWeightIdx, topPtRwgtIdx, lheTHXSMWeightIdx, aux_binIdx)
+            create_histogram(
+              ROOT.TH1F, self.getHistogramName(family, *histogramIdx), self.getHistogramTitle(family, *histogramIdx),
+              -0.5, nofBins - 0.5, accumulator['sumw'][histogramIdx], accumulator['sumw2'][histogramIdx], nofEntries
+            ).Write()
+
+  def writeCompact(self, accumulators):
+    # one flattened histogram per family, plus the number of entries in each (tH index, aux bin) cell and an index
+    # that allows to reconstruct the histograms of the legacy layout with CountHistogramReader
+    index = collections.OrderedDict([
+      ('genWeight', [ self.getGenWeightLabel(genWeightIdx) for genWeightIdx in range(len(self.useFullGenWeight)) ]),
+      ('topPtRwgt', [ self.getTopPtRwgtLabel(topPtRwgtIdx) for topPtRwgtIdx in range(len(self.topPtRwgtLabels)) ]),
+      ('lheTHX',    [ self.getLheTHXLabel(lheTHXSMWeightIdx) for lheTHXSMWeightIdx in range(len(self.lheTHXSMWeightIndices)) ]),
+      ('aux',       [ self.getAuxBinLabel(aux_binIdx) for aux_binIdx in range(len(self.aux_binning)) ]),
+      ('count',     [
+        (self.getCountHistogramName(aux_binIdx), self.getCountHistogramTitle(aux_binIdx)) for aux_binIdx in range(len(self.aux_binning))
+      ]),
+      ('families',  []),
+    ])
+
+    countName = '%s_Count' % COMPACT_PREFIX
+    create_histogram(
+      ROOT.TH1D, countName, 'sum(1)', -0.5, len(self.counts) - 0.5, self.counts, self.counts, self.counts.sum()
+    ).Write()
+
+    for family, accumulator in accumulators:
+      histogramName = '%s_%s' % (COMPACT_PREFIX, family if family else 'PU')
+      nofEntries = accumulator['nofEntries']
+      nofValues = accumulator['sumw'].size
+      create_histogram(
+        ROOT.TH1D, histogramName, self.countFamilies[family], -0.5, nofValues - 0.5,
+        accumulator['sumw'].ravel(), accumulator['sumw2'].ravel(), nofEntries.sum()
+      ).Write()
+      create_histogram(
+        ROOT.TH1D, '%s_entries' % histogramName, 'entries', -0.5, nofEntries.size - 0.5,
+        nofEntries.ravel(), nofEntries.ravel(), nofEntries.sum()
+      ).Write()
+      index['families'].append((family, histogramName, self.countFamilies[family], list(accumulator['sumw'].shape)))
+
+    ROOT.TObjString(json.dumps(index)).Write('%s_index' % COMPACT_PREFIX)
+
+  def writeRefGenWeight(self):
+    # the first bin holds the reference genWeight and the second one counts the files, so that the outputs of several
+    # jobs can be merged with hadd and the reference genWeight can be checked to be the same in all of them
+    create_histogram(
+      ROOT.TH1D, REF_GENWEIGHT_HISTOGRAM_NAME,
+      'reference genWeight (%s)' % ('estimated' if self.estimateRefGenWeight else 'given'), -0.5, 1.5,
+      [ self.ref_genWeight, 1. ], [ self.ref_genWeight**2, 1. ], 1
+    ).Write()
+
+  def initAccumulators(self):
+    self.counts = np.zeros(len(self.aux_binning), dtype = np.int64)
+    # the accumulators of each family are kept per |genWeight| bin if the reference genWeight is estimated,
+    # otherwise all of them are stored under None
+    self.accumulators = AccumulatorStore(self.memoryLimit, self.scratchDir)
+    # number of events and the sum of |genWeight| in each |genWeight| bin
+    self.genWeightSketch = collections.OrderedDict()
+
+  def getAccumulators(self, genWeightBin):
+    return self.accumulators.bucket(genWeightBin)
+
+  def fillGenWeightSketch(self, genWeightBins, absGenWeights):
+    uniqueBins, uniqueBinIdxs, nofEvents = np.unique(genWeightBins, return_inverse = True, return_counts = True)
+    sumAbsGenWeights = np.bincount(uniqueBinIdxs, weights = absGenWeights)
+    for genWeightBin, nofEventsInBin, sumAbsGenWeight in zip(uniqueBins, nofEvents, sumAbsGenWeights):
+      sketch = self.genWeightSketch.setdefault(int(genWeightBin), [ 0, 0. ])
+      sketch[0] += int(nofEventsInBin)
+      sketch[1] += sumAbsGenWeight
+
+  def estimateRefGenWeightFromSketch(self):
+    # returns the reference genWeight and the last |genWeight| bin that is not affected by the clipping;
+    # since the sums are kept only per |genWeight| bin, the clipping limit must not fall inside a populated bin,
+    # which is why the estimate falls back to the center of the most populated bin if it would; the reference genWeight
+    # then differs from the mean |genWeight| in that bin by at most half of the bin width, i.e. by up to
+    # exp(GENWEIGHT_BIN_WIDTH / 2) - 1 = 6.7%
+    nonZeroBins = [ genWeightBin for genWeightBin in self.genWeightSketch if genWeightBin != GENWEIGHT_BIN_ZERO ]
+    if not nonZeroBins:
+      print("WARNING: No events with non-zero genWeight, setting the reference genWeight to 1")
+      return 1., GENWEIGHT_BIN_ZERO
+    modeBin = min(nonZeroBins, key = lambda genWeightBin: (-self.genWeightSketch[genWeightBin][0], genWeightBin))
+    # if no events fall into the bin of the clipping limit, the mean |genWeight| in the most populated bin can be used
+    # as the reference, since all other bins are either fully below or fully above the limit
+    nofEvents, sumAbsGenWeight = self.genWeightSketch[modeBin]
+    ref_genWeight = sumAbsGenWeight / nofEvents
+    limitBin = int(get_genWeightBins(REF_GENWEIGHT_LIMIT * ref_genWeight))
+    if limitBin in self.genWeightSketch:
+      # otherwise, the center of the bin is used as the reference, which puts the limit on the edge of a bin
+      ref_genWeight = np.exp((modeBin + 0.5) * GENWEIGHT_BIN_WIDTH)
+      limitBin = int(np.round(np.log(REF_GENWEIGHT_LIMIT * ref_genWeight) / GENWEIGHT_BIN_WIDTH)) - 1
+    return ref_genWeight, limitBin
+
+  def getFinalAccumulators(self):
+    # yields the total sums of one family at a time, so that only one family is assembled in memory at once
+    if not self.estimateRefGenWeight:
+      for family in self.accumulators.families():
+        yield family, self.accumulators.collect(None, family)
+      return
+
+    self.ref_genWeight, limitBin = self.estimateRefGenWeightFromSketch()
+    print("Estimated reference genWeight: %s" % str(self.ref_genWeight))
+    genWeightLimit = REF_GENWEIGHT_LIMIT * self.ref_genWeight
+    signIdx = self.useFullGenWeight.index(False)
+    fullIdx = self.useFullGenWeight.index(True)
+
+    # the full genWeight of the events above the clipping limit is replaced by its sign times the limit
+    for family in self.accumulators.families():
+      finalAccumulators = {}
+      for genWeightBin in sorted(self.accumulators.genWeightBins()):
+        accumulator = self.accumulators.collect(genWeightBin, family)
+        if accumulator is None:
+          continue
+        isClipped = genWeightBin > limitBin
+        nofBins = accumulator['sumw'].shape[-1]
+        finalAccumulator = self.getAccumulator(finalAccumulators, family, nofBins)
+        finalAccumulator['nofEntries'] += accumulator['nofEntries']
+        finalAccumulator['sumw'][signIdx, ..., :nofBins] += accumulator['sumw'][signIdx]
+        finalAccumulator['sumw2'][signIdx, ..., :nofBins] += accumulator['sumw2'][signIdx]
+        if isClipped:
+          finalAccumulator['sumw'][fullIdx, ..., :nofBins] += genWeightLimit * accumulator['sumw'][signIdx]
+          finalAccumulator['sumw2'][fullIdx, ..., :nofBins] += genWeightLimit**2 * accumulator['sumw2'][signIdx]
+        else:
+          finalAccumulator['sumw'][fullIdx, ..., :nofBins] += accumulator['sumw'][fullIdx]
+          finalAccumulator['sumw2'][fullIdx, ..., :nofBins] += accumulator['sumw2'][fullIdx]
+        del accumulator
+      yield family, finalAccumulators[family]
+
+  def getAccumulator(self, accumulators, family, nofBins):
+    # the sums are kept in a dense tensor per family, with axes:
+    # (genWeight mode, top pT reweighting label, tH index, aux bin, variation bin)
+    if family in accumulators:
+      accumulator = accumulators[family]
+      if accumulator['sumw'].shape[-1] >= nofBins:
+        return accumulator
+      accumulator = pad_accumulator(accumulator, nofBins)
+    else:
+      shape = (len(self.useFullGenWeight), len(self.topPtRwgtLabels), len(self.lheTHXSMWeightIndices),
+               len(self.aux_binning), nofBins)
+      accumulator = {
+        'sumw'       : np.zeros(shape, dtype = np.float64),
+        'sumw2'      : np.zeros(shape, dtype = np.float64),
+        'nofEntries' : np.zeros((len(self.lheTHXSMWeightIndices), len(self.aux_binning)), dtype = np.int64),
+      }
+    # storing a new or resized accumulator keeps the memory accounting of AccumulatorStore up to date
+    accumulators[family] = accumulator
+    return accumulator
+
+  def accumulate(self, accumulators, family, evtWeights, weights, aux_binIdxs, lheTHXWeightsMask):
+    nofBins = len(weights)
+    accumulator = self.getAccumulator(accumulators, family, nofBins)
+    fillWeights = np.multiply.outer(evtWeights, weights)[:, :, :, np.newaxis, :]
+    accumulator['sumw'][:, :, :, aux_binIdxs, :nofBins] += fillWeights
+    accumulator['sumw2'][:, :, :, aux_binIdxs, :nofBins] += fillWeights**2
+    accumulator['nofEntries'][:, aux_binIdxs] += lheTHXWeightsMask[:, np.newaxis] * nofBins
+
+  def accumulateColumns(self, accumulators, family, evtWeights, weights, nofBins, isValid, aux_binMask, lheTHXWeightsMask):
+    # evtWeights has the shape of (event, genWeight mode, top pT reweighting label, tH index), weights has the shape
+    # of (event, variation bin) and is zero-padded beyond the nofBins entries that are filled in each event
+    accumulator = self.getAccumulator(accumulators, family, weights.shape[1])
+    evtWeights_flat = evtWeights.reshape(len(evtWeights), -1)
+    sumShape = evtWeights.shape[1:] + (weights.shape[1],)
+    for aux_binIdx in range(len(self.aux_binning)):
+      selection = isValid & aux_binMask[:, aux_binIdx]
+      if not selection.any():
+        continue
+      evtWeights_sel = evtWeights_flat[selection]
+      weights_sel = weights[selection]
+      accumulator['sumw'][:, :, :, aux_binIdx, :weights.shape[1]] += \
+        np.dot(evtWeights_sel.T, weights_sel).reshape(sumShape)
+      accumulator['sumw2'][:, :, :, aux_binIdx, :weights.shape[1]] += \
+        np.dot((evtWeights_sel**2).T, weights_sel**2).reshape(sumShape)
+      accumulator['nofEntries'][:, aux_binIdx] += np.dot(
+        lheTHXWeightsMask[selection].T.astype(np.int64), nofBins[selection].astype(np.int64)
+      )
+
+  def readColumns(self, inputTree, expressions, firstEntry, nofEntries, nofRows):
+    # TTree::Draw() evaluates at most four expressions at a time
+    if nofRows == 0:
+      return [ np.zeros(0, dtype = np.float64) for expression in expressions ]
+    if inputTree.GetEstimate() <= nofRows:
+      inputTree.SetEstimate(nofRows + 1)
+    columns = []
+    for expressionIdx in range(0, len(expressions), 4):
+      expressions_draw = expressions[expressionIdx:expressionIdx + 4]
+      inputTree.Draw(':'.join(expressions_draw), '', 'goff', nofEntries, firstEntry)
+      nofSelectedRows = inputTree.GetSelectedRows()
+      if nofSelectedRows != nofRows:
+        raise RuntimeError(
+          "Expected %d rows but read %d rows from: %s" % (nofRows, nofSelectedRows, ', '.join(expressions_draw))
+        )
+      for valueIdx in range(len(expressions_draw)):
+        values = inputTree.GetVal(valueIdx)
+        values.SetSize(nofRows)
+        columns.append(np.frombuffer(values, dtype = np.float64, count = nofRows).copy())
+    return columns
+
+  def readJaggedColumn(self, inputTree, branchName, counts, firstEntry, nofEntries):
+    # returns the array zero-padded to the largest length in the given range of entries
+    counts = counts.astype(np.int64)
+    values = np.zeros((nofEntries, counts.max() if nofEntries > 0 else 0), dtype = np.float64)
+    nofRows = int(counts.sum())
+    if nofRows > 0:
+      flatValues = self.readColumns(inputTree, [ branchName ], firstEntry, nofEntries, nofRows)[0]
+      entryIdxs = np.repeat(np.arange(nofEntries), counts)
+      iterationIdxs = np.arange(nofRows) - np.repeat(np.cumsum(counts) - counts, counts)
+      values[entryIdxs, iterationIdxs] = flatValues
+    return values
+
+  def checkArrayLengths(self, branchName, counts, nofExpected):
+    # mimics the warnings that are printed in the event-by-event mode whenever the array length changes
+    counts_prev = np.concatenate([ [ nofExpected ], counts[:-1] ])
+    for entryIdx in np.flatnonzero(counts != counts_prev):
+      print(
+        "WARNING: The length of '%s' array (= %i) does not match to the expected length of %i" % \
+        (branchName, counts[entryIdx], counts_prev[entryIdx])
+      )
+    return int(counts[-1]) if len(counts) else nofExpected
+
+  def processColumnar(self, inputTree, inputTreeBranchNames, nofEvents):
+    for firstEntry in range(0, nofEvents, self.chunkSize):
+      self.processColumns(inputTree, inputTreeBranchNames, firstEntry, min(self.chunkSize, nofEvents - firstEntry))
+
+  def processColumns(self, inputTree, inputTreeBranchNames, firstEntry, nofEntries):
+    readBranches = lambda branchNames: collections.OrderedDict(zip(
+      branchNames, self.readColumns(inputTree, branchNames, firstEntry, nofEntries, nofEntries)
+    ))
+    readJaggedBranch = lambda branchName, counts: self.readJaggedColumn(
+      inputTree, branchName, counts, firstEntry, nofEntries
+    )
+
+    aux_binMask = np.ones((nofEntries, len(self.aux_binning)), dtype = bool)
+    if len(self.aux_binning) > 1:
+      auxBranchNames = self.getAuxBranchNames()
+      for branchName in auxBranchNames:
+        if branchName not in inputTreeBranchNames:
+          raise RuntimeError("No such branch: %s" % branchName)
+      auxBinMask = self.auxBinRouter.routeColumns(readBranches(auxBranchNames), nofEntries)
+      aux_binMask[:, 1:] = False
+      aux_binMask[:, 1:auxBinMask.shape[1] + 1] = auxBinMask
+    self.counts += aux_binMask.sum(axis = 0)
+
+    if self.genWeightName not in inputTreeBranchNames:
+      if not self.isPrinted[self.genWeightName]:
+        self.isPrinted[self.genWeightName] = True
+        print('Missing branch: %s' % self.genWeightName)
+      return
+    if self.puWeightName not in inputTreeBranchNames:
+      if not self.isPrinted[self.puWeightName]:
+        self.isPrinted[self.puWeightName] = True
+        print('Missing branch: %s' % self.puWeightName)
+      return
+
+    has_l1Prefire = self.l1PrefireWeightNomName  in inputTreeBranchNames and \
+                    self.l1PrefireWeightUpName   in inputTreeBranchNames and \
+                    self.l1PrefireWeightDownName in inputTreeBranchNames
+    scalarBranchNames = [ self.genWeightName, self.puWeightName, self.puWeightName_up, self.puWeightName_down ]
+    if has_l1Prefire:
+      scalarBranchNames.extend([ self.l1PrefireWeightNomName, self.l1PrefireWeightUpName, self.l1PrefireWeightDownName ])
+    for branchName in [ self.lheTHXWeightCountName, self.PSWeightCountName, self.nominalLHEweightName ]:
+      if branchName in inputTreeBranchNames:
+        scalarBranchNames.append(branchName)
+    for branchName in [ self.LHEScaleWeightName, self.LHEPdfWeightName ]:
+      if branchName in inputTreeBranchNames:
+        scalarBranchNames.append('n%s' % branchName)
+    # the GenTop collection is either written in full or as indices to the GenPart collection, see genParticleProducer
+    genTopIdxBranchName = '%s_genPartIdx' % self.genTopCollectionName
+    isGenTopIndexed = genTopIdxBranchName in inputTreeBranchNames
+    if self.compTopRwgt:
+      scalarBranchNames.append('n%s' % self.genTopCollectionName)
+      if isGenTopIndexed:
+        scalarBranchNames.append('n%s' % self.genPartCollectionName)
+    columns = readBranches(scalarBranchNames)
+
+    genWeightBins = None
+    if self.estimateRefGenWeight:
+      # the genWeight is clipped once the reference is known, see getFinalAccumulators()
+      genWeight_full = columns[self.genWeightName]
+      genWeightBins = get_genWeightBins(np.abs(genWeight_full))
+      self.fillGenWeightSketch(genWeightBins, np.abs(genWeight_full))
+    else:
+      genWeight_full = np.clip(
+        columns[self.genWeightName], -REF_GENWEIGHT_LIMIT * self.ref_genWeight, REF_GENWEIGHT_LIMIT * self.ref_genWeight
+      )
+    genWeights = np.column_stack([
+      genWeight_full if fullGenWeight else np.sign(genWeight_full) for fullGenWeight in self.useFullGenWeight
+    ])
+
+    topPtRwgtSFs = np.ones((nofEntries, len(self.topPtRwgtLabels)), dtype = np.float64)
+    if self.compTopRwgt:
+      nofGenTops = columns['n%s' % self.genTopCollectionName]
+      if isGenTopIndexed:
+        nofGenParts = columns['n%s' % self.genPartCollectionName]
+        genTopIdxs = readJaggedBranch(genTopIdxBranchName, nofGenTops).astype(np.int64)
+        entryIdxs = np.arange(nofEntries)[:, np.newaxis]
+        genTopPt = readJaggedBranch('%s_pt' % self.genPartCollectionName, nofGenParts)[entryIdxs, genTopIdxs]
+        genTopPdgId = readJaggedBranch('%s_pdgId' % self.genPartCollectionName, nofGenParts)[entryIdxs, genTopIdxs]
+      else:
+        genTopPt = readJaggedBranch('%s_pt' % self.genTopCollectionName, nofGenTops)
+        genTopPdgId = readJaggedBranch('%s_pdgId' % self.genTopCollectionName, nofGenTops)
+      for topPtRwgtIdx, choice in enumerate(self.topPtRwgtChoices):
+        topRwgtSF = self.getTopRwgtSFColumn(nofGenTops, genTopPt, genTopPdgId, choice)
+        topPtRwgtSFs[:, 2 * topPtRwgtIdx + 1] = topRwgtSF
+        topPtRwgtSFs[:, 2 * topPtRwgtIdx + 2] = topRwgtSF**2
+
+    lheTHXWeights = np.zeros((nofEntries, len(self.lheTHXSMWeightIndices)), dtype = np.float64)
+    lheTHXWeights[:, self.lheTHXSMWeightIsNominal] = 1.
+    nofLheTHXWeights = np.zeros(nofEntries, dtype = np.int64)
+    if self.lheTHXWeightCountName in columns and self.lheTHXWeightName in inputTreeBranchNames:
+      nofLheTHXWeights = columns[self.lheTHXWeightCountName].astype(np.int64)
+    lheTHXWeightsMask = self.lheTHXSMWeightIndicesArr[np.newaxis, :] < nofLheTHXWeights[:, np.newaxis]
+    if not lheTHXWeightsMask.all() and not self.isPrinted[self.lheTHXWeightName]:
+      self.isPrinted[self.lheTHXWeightName] = True
+      print('Missing or unfilled branch: %s' % self.lheTHXWeightName)
+    lheTHXWeightsMask |= self.lheTHXSMWeightIsNominal[np.newaxis, :]
+    if nofLheTHXWeights.any():
+      lheTHXWeightArr = readJaggedBranch(self.lheTHXWeightName, nofLheTHXWeights)
+      lheTHXWeightsIdxs = np.clip(self.lheTHXSMWeightIndicesArr, 0, lheTHXWeightArr.shape[1] - 1)
+      lheTHXWeights = np.where(
+        lheTHXWeightsMask & ~self.lheTHXSMWeightIsNominal[np.newaxis, :], lheTHXWeightArr[:, lheTHXWeightsIdxs], lheTHXWeights
+      )
+
+    evtWeights = genWeights[:, :, np.newaxis, np.newaxis] * topPtRwgtSFs[:, np.newaxis, :, np.newaxis] * \
+                 lheTHXWeights[:, np.newaxis, np.newaxis, :]
+
+    familyWeights = self.getFamilyWeightColumns(
+      columns, has_l1Prefire, inputTreeBranchNames, readJaggedBranch, nofEntries
+    )
+    for family, (weights, nofBins, isValid) in familyWeights.items():
+      if genWeightBins is None:
+        self.accumulateColumns(
+          self.getAccumulators(None), family, evtWeights, weights, nofBins, isValid, aux_binMask, lheTHXWeightsMask
+        )
+        continue
+      for genWeightBin in np.unique(genWeightBins):
+        self.accumulateColumns(
+          self.getAccumulators(int(genWeightBin)), family, evtWeights, weights, nofBins,
+          isValid & (genWeightBins == genWeightBin), aux_binMask, lheTHXWeightsMask
+        )
+
+  def getFamilyWeightColumns(self, columns, has_l1Prefire, inputTreeBranchNames, readJaggedBranch, nofEntries):
+    # same as getFamilyWeights(), but each family is given by its weights, the number of filled bins and
+    # the mask of events that contribute to it
+    puWeight = columns[self.puWeightName][:, np.newaxis]
+    allEvents = np.ones(nofEntries, dtype = bool)
+    fixedBins = lambda nofBins: np.full(nofEntries, nofBins, dtype = np.int64)
+
+    familyWeights = collections.OrderedDict()
+    familyWeights[''] = (
+      np.column_stack([ columns[self.puWeightName], columns[self.puWeightName_up], columns[self.puWeightName_down] ]),
+      fixedBins(3), allEvents,
+    )
+    if has_l1Prefire:
+      l1_nom = columns[self.l1PrefireWeightNomName][:, np.newaxis]
+      familyWeights['L1PrefireNom'] = (familyWeights[''][0] * l1_nom, fixedBins(3), allEvents)
+      familyWeights['L1Prefire'] = (
+        puWeight * np.column_stack([
+          columns[self.l1PrefireWeightNomName], columns[self.l1PrefireWeightUpName], columns[self.l1PrefireWeightDownName]
+        ]),
+        fixedBins(3), allEvents,
+      )
+
+    correctiveFactor = np.full(nofEntries, 2. if self.nLHEScaleWeight == 8 else 1.)
+    if self.LHEScaleWeightName in inputTreeBranchNames:
+      assert(self.compLHEEnvelope)
+      nofLHEScaleWeights = columns['n%s' % self.LHEScaleWeightName].astype(np.int64)
+      self.nLHEScaleWeight = self.checkArrayLengths(self.LHEScaleWeightName, nofLHEScaleWeights, self.nLHEScaleWeight)
+      correctiveFactor = np.where(nofLHEScaleWeights == 8, 2., 1.)
+
+    if self.LHEScaleWeightName in inputTreeBranchNames and \
+       self.hasFamily('LHEWeightScale', 'LHEWeightScaleL1PrefireNom', 'LHEEnvelope', 'LHEEnvelopeL1PrefireNom'):
+      LHEScaleWeight = readJaggedBranch(self.LHEScaleWeightName, nofLHEScaleWeights)
+      LHENominal = np.ones(nofEntries, dtype = np.float64)
+      if LHEScaleWeight.shape[1] > 4:
+        LHENominal = np.where(nofLHEScaleWeights == 9, LHEScaleWeight[:, 4], 1.)
+      LHENominal[LHENominal == 0.] = 1.
+      LHENorm = (correctiveFactor / LHENominal)[:, np.newaxis]
+
+      LHEEnvelopeValues = np.ones((nofEntries, self.nLHEEnvelope), dtype = np.float64)
+      for nof_lheScaleWeights, LHEEnvelopeIdxs in self.LHEEnvelopeIdxs.items():
+        isLength = nofLHEScaleWeights == nof_lheScaleWeights
+        if isLength.any():
+          LHEEnvelopeValuesAll = LHEScaleWeight[isLength][:, LHEEnvelopeIdxs]
+          LHEEnvelopeValues[isLength] = np.column_stack([
+            LHEEnvelopeValuesAll.max(axis = 1), LHEEnvelopeValuesAll.min(axis = 1)
+          ])
+
+      familyWeights['LHEWeightScale'] = (
+        puWeight * np.clip(LHEScaleWeight * LHENorm, -10., 10.), nofLHEScaleWeights, allEvents
+      )
+      familyWeights['LHEEnvelope'] = (
+        puWeight * np.clip(LHEEnvelopeValues * LHENorm, -10., 10.), fixedBins(self.nLHEEnvelope), allEvents
+      )
+      if has_l1Prefire:
+        for family in [ 'LHEWeightScale', 'LHEEnvelope' ]:
+          weights, nofBins, isValid = familyWeights[family]
+          familyWeights['{}L1PrefireNom'.format(family)] = (weights * l1_nom, nofBins, isValid)
+    elif self.LHEScaleWeightName not in inputTreeBranchNames:
+      if not self.isPrinted[self.LHEScaleWeightName]:
+        self.isPrinted[self.LHEScaleWeightName] = True
+        print('Missing branch: %s' % self.LHEScaleWeightName)
+
+    if self.hasFamily('LHEWeightPdf', 'LHEWeightPdfL1PrefireNom'):
+      if self.LHEPdfWeightName in inputTreeBranchNames:
+        nofLHEPdfWeights = columns['n%s' % self.LHEPdfWeightName].astype(np.int64)
+        LHEPdfWeight = readJaggedBranch(self.LHEPdfWeightName, nofLHEPdfWeights)
+        self.nLHEPdfWeight = self.checkArrayLengths(self.LHEPdfWeightName, nofLHEPdfWeights, self.nLHEPdfWeight)
+
+        familyWeights['LHEWeightPdf'] = (
+          puWeight * np.clip(LHEPdfWeight * correctiveFactor[:, np.newaxis], -10., 10.), nofLHEPdfWeights, allEvents
+        )
+        if has_l1Prefire:
+          familyWeights['LHEWeightPdfL1PrefireNom'] = (familyWeights['LHEWeightPdf'][0] * l1_nom, nofLHEPdfWeights, allEvents)
+      else:
+        if not self.isPrinted[self.LHEPdfWeightName]:
+          self.isPrinted[self.LHEPdfWeightName] = True
+          print('Missing branch: %s' % self.LHEPdfWeightName)
+
+    if self.hasFamily('PSWeight', 'PSWeightL1PrefireNom', 'PSWeightOriginalXWGTUP', 'PSWeightOriginalXWGTUPL1PrefireNom'):
+      nof_PSweight = columns.get(self.PSWeightCountName, np.zeros(nofEntries)).astype(np.int64)
+      hasPSweights = nof_PSweight == self.nPSWeight_required
+      if hasPSweights.any():
+        PSweights = readJaggedBranch(self.PSWeightName, nof_PSweight)[:, :self.nPSWeight_required]
+        # FSR and ISR may move in opposite directions -> just take min and max of the weights to build the envelope
+        # target: ISR/FSR/both up, ISR/FSR/both down
+        PSweights_ext = np.column_stack([
+          PSweights[:, self.ISR_up_idx],   PSweights[:, self.FSR_up_idx],   PSweights.max(axis = 1),
+          PSweights[:, self.ISR_down_idx], PSweights[:, self.FSR_down_idx], PSweights.min(axis = 1),
+        ])
+        assert(PSweights_ext.shape[1] == self.nPSweight)
+
+        familyWeights['PSWeight'] = (
+          puWeight * np.clip(PSweights_ext, -10., 10.), fixedBins(self.nPSweight), hasPSweights
+        )
+        if has_l1Prefire:
+          familyWeights['PSWeightL1PrefireNom'] = (familyWeights['PSWeight'][0] * l1_nom, fixedBins(self.nPSweight), hasPSweights)
+
+        if self.nominalLHEweightName in columns:
+          lhe_nom = columns[self.nominalLHEweightName][:, np.newaxis]
+          familyWeights['PSWeightOriginalXWGTUP'] = (
+            puWeight * np.clip(PSweights_ext * lhe_nom, -10., 10.), fixedBins(self.nPSweight), hasPSweights
+          )
+          if has_l1Prefire:
+            familyWeights['PSWeightOriginalXWGTUPL1PrefireNom'] = (
+              familyWeights['PSWeightOriginalXWGTUP'][0] * l1_nom, fixedBins(self.nPSweight), hasPSweights
+            )
+        else:
+          if not self.isPrinted[self.nominalLHEweightName]:
+            self.isPrinted[self.nominalLHEweightName] = True
+            print('Missing branch: %s' % self.nominalLHEweightName)
+      if not hasPSweights.all():
+        if not self.isPrinted[self.PSWeightCountName]:
+          self.isPrinted[self.PSWeightCountName] = True
+          print('Missing branch: %s' % self.PSWeightCountName)
+
+    for family in list(familyWeights.keys()):
+      if family not in self.families:
+        del familyWeights[family]
+
+    return familyWeights
+
+  def getAuxBranchNames(self):
+    auxBranchNames = []
+    if 'HTXS' in self.splitBy:
+      auxBranchNames.extend([ self.htxsPtBranchName, self.htxsEtaBranchName ])
+    if 'LHENjet' in self.splitBy or 'LHENjetHT' in self.splitBy:
+      auxBranchNames.append(self.LHENjetsBranchName)
+    if 'LHEHT' in self.splitBy or 'LHENjetHT' in self.splitBy:
+      auxBranchNames.append(self.LHEHTBranchName)
+    return auxBranchNames
+
+  def getAuxBinIntervals(self, aux_binIdx):
+    aux_bin = self.aux_binning[aux_binIdx]
+    if self.aux_binSchemes[aux_binIdx] == 'HTXS':
+      if self.htxs[aux_bin] is None:
+        return { self.htxsEtaBranchName : (self.htxsEtaMax, np.inf) }
+      return { self.htxsEtaBranchName : (-np.inf, self.htxsEtaMax), self.htxsPtBranchName : self.htxs[aux_bin] }
+    auxBinIntervals = {}
+    for aux_bin_part in aux_bin.split('_'):
+      if aux_bin_part in self.lheNjets:
+        lheNjets = self.lheNjets[aux_bin_part]
+        auxBinIntervals[self.LHENjetsBranchName] = (lheNjets, lheNjets + 1)
+      elif aux_bin_part in self.lheHT:
+        auxBinIntervals[self.LHEHTBranchName] = self.lheHT[aux_bin_part]
+      else:
+        assert(False)
+    return auxBinIntervals
+
+  def buildAuxBinRouter(self):
+    auxVariables = collections.OrderedDict(
+      (branchName, abs if branchName == self.htxsEtaBranchName else None) for branchName in self.getAuxBranchNames()
+    )
+    # the bin indices of the router are offset by one wrt aux_binning, since the first aux bin is inclusive
+    return AuxBinRouter(auxVariables, [
+      self.getAuxBinIntervals(aux_binIdx) for aux_binIdx in range(1, len(self.aux_binning))
+    ])
+
+  def getAuxBinIdxs(self, event):
+    aux_binIdxs = [ 0 ]
+    if len(self.aux_binning) == 1:
+      return aux_binIdxs
+
+    auxValues = {}
+    for branchName in self.getAuxBranchNames():
+      if not hasattr(event, branchName):
+        raise RuntimeError("No such branch: %s" % branchName)
+      auxValues[branchName] = getattr(event, branchName)
+
+    aux_binIdxs.extend(aux_binIdx + 1 for aux_binIdx in self.auxBinRouter.route(auxValues))
+    return aux_binIdxs
+
+  def getTopPtRwgtSFs(self, topRwgt):
+    # ordered as self.topPtRwgtLabels: no reweighting, then each choice followed by its square
+    topPtRwgtSFs = [ 1. ]
+    if self.compTopRwgt:
+      for topRwgtSF in topRwgt:
+        topPtRwgtSFs.extend([ topRwgtSF, topRwgtSF**2 ])
+    assert(len(topPtRwgtSFs) == len(self.topPtRwgtLabels))
+    return topPtRwgtSFs
+
+  def getLheTHXWeights(self, event):
+    # returns the tH weights and the mask of those that are available in the current event
+    nofLheTHXWeights = 0
+    if hasattr(event, self.lheTHXWeightCountName) and hasattr(event, self.lheTHXWeightName):
+      nofLheTHXWeights = getattr(event, self.lheTHXWeightCountName)
+    lheTHXWeightsMask = self.lheTHXSMWeightIndicesArr < nofLheTHXWeights
+    if not lheTHXWeightsMask.all() and not self.isPrinted[self.lheTHXWeightName]:
+      self.isPrinted[self.lheTHXWeightName] = True
+      print('Missing or unfilled branch: %s' % self.lheTHXWeightName)
+    lheTHXWeightsMask |= self.lheTHXSMWeightIsNominal
+
+    lheTHXWeights = np.zeros(len(self.lheTHXSMWeightIndices), dtype = np.float64)
+    lheTHXWeights[self.lheTHXSMWeightIsNominal] = 1.
+    if nofLheTHXWeights > 0:
+      lheTHXWeightArr = np.fromiter(
+        getattr(event, self.lheTHXWeightName), dtype = np.float64, count = nofLheTHXWeights
+      )
+      lheTHXWeightsIdxs = self.lheTHXSMWeightIndicesArr[lheTHXWeightsMask & ~self.lheTHXSMWeightIsNominal]
+      lheTHXWeights[lheTHXWeightsMask & ~self.lheTHXSMWeightIsNominal] = lheTHXWeightArr[lheTHXWeightsIdxs]
+    return lheTHXWeights, lheTHXWeightsMask
+
+  def getFamilyWeights(self, event, has_l1Prefire, l1_nom, l1_up, l1_down):
+    # per-event weights of every histogram family, computed once and shared by all fill plan entries;
+    # the genWeight, tH weight and top pT reweighting SF are applied at the fill stage
+    assert(hasattr(event, self.puWeightName_up))
+    assert(hasattr(event, self.puWeightName_down))
+
+    puWeight = getattr(event, self.puWeightName)
+    puWeight_up = getattr(event, self.puWeightName_up)
+    puWeight_down = getattr(event, self.puWeightName_down)
+
+    familyWeights = collections.OrderedDict()
+    LHEEnvelopeValues = [ 1., 1. ]
+
+    familyWeights[''] = np.array([ puWeight, puWeight_up, puWeight_down ], dtype = np.float64)
+    if has_l1Prefire:
+      familyWeights['L1PrefireNom'] = familyWeights[''] * l1_nom
+      familyWeights['L1Prefire'] = puWeight * np.array([ l1_nom, l1_up, l1_down ], dtype = np.float64)
+
+    if hasattr(event, self.LHEScaleWeightName):
+      assert(self.compLHEEnvelope)
+      LHEScaleWeight = getattr(event, self.LHEScaleWeightName)
+      LHEEnvelopeValues = self.getLHEEnvelope(LHEScaleWeight)
+      LHENominal = self.getLHENominal(LHEScaleWeight)
+
+      nof_lheScaleWeight = len(LHEScaleWeight)
+      if nof_lheScaleWeight != self.nLHEScaleWeight:
+        print(
+          "WARNING: The length of '%s' array (= %i) does not match to the expected length of %i" % \
+          (self.LHEScaleWeightName, len(LHEScaleWeight), self.nLHEScaleWeight)
+        )
+        self.nLHEScaleWeight = nof_lheScaleWeight
+
+      if self.hasFamily('LHEWeightScale', 'LHEWeightScaleL1PrefireNom', 'LHEEnvelope', 'LHEEnvelopeL1PrefireNom'):
+        LHEScaleWeightArr = np.fromiter(LHEScaleWeight, dtype = np.float64, count = self.nLHEScaleWeight)
+        familyWeights['LHEWeightScale'] = puWeight * self.clip_lhe(LHEScaleWeightArr, LHENominal)
+        familyWeights['LHEEnvelope'] = puWeight * self.clip_lhe(LHEEnvelopeValues, LHENominal)
+        if has_l1Prefire:
+          familyWeights['LHEWeightScaleL1PrefireNom'] = familyWeights['LHEWeightScale'] * l1_nom
+          familyWeights['LHEEnvelopeL1PrefireNom'] = familyWeights['LHEEnvelope'] * l1_nom
+    else:
+      if not self.isPrinted[self.LHEScaleWeightName]:
+        self.isPrinted[self.LHEScaleWeightName] = True
+        print('Missing branch: %s' % self.LHEScaleWeightName)
+
+    if self.hasFamily('LHEWeightPdf', 'LHEWeightPdfL1PrefireNom'):
+      if hasattr(event, self.LHEPdfWeightName):
+        LHEPdfWeight = getattr(event, self.LHEPdfWeightName)
+
+        if len(LHEPdfWeight) != self.nLHEPdfWeight:
+          print(
+            "WARNING: The length of '%s' array (= %i) does not match to the expected length of %i" % \
+            (self.LHEPdfWeightName, len(LHEPdfWeight), self.nLHEPdfWeight)
+          )
+          self.nLHEPdfWeight = len(LHEPdfWeight)
+
+        LHEPdfWeightArr = np.fromiter(LHEPdfWeight, dtype = np.float64, count = self.nLHEPdfWeight)
+        familyWeights['LHEWeightPdf'] = puWeight * self.clip_lhe(LHEPdfWeightArr)
+        if has_l1Prefire:
+          familyWeights['LHEWeightPdfL1PrefireNom'] = familyWeights['LHEWeightPdf'] * l1_nom
+      else:
+        if not self.isPrinted[self.LHEPdfWeightName]:
+          self.isPrinted[self.LHEPdfWeightName] = True
+          print('Missing branch: %s' % self.LHEPdfWeightName)
+
+    if self.hasFamily('PSWeight', 'PSWeightL1PrefireNom', 'PSWeightOriginalXWGTUP', 'PSWeightOriginalXWGTUPL1PrefireNom'):
+      nof_PSweight = getattr(event, self.PSWeightCountName, 0)
+      if nof_PSweight == self.nPSWeight_required:
+        PSweights = getattr(event, self.PSWeightName)
+        assert(len(PSweights) == nof_PSweight)
+        # FSR and ISR may move in opposite directions -> just take min and max of the weights to build the envelope
+        PS_env_up = max([ PSweights[ps_idx] for ps_idx in range(nof_PSweight) ])
+        PS_env_down = min([ PSweights[ps_idx] for ps_idx in range(nof_PSweight) ])
+        # target: ISR/FSR/both up, ISR/FSR/both down
+        PSweights_ext = np.array([
+          PSweights[self.ISR_up_idx],   PSweights[self.FSR_up_idx],   PS_env_up,
+          PSweights[self.ISR_down_idx], PSweights[self.FSR_down_idx], PS_env_down,
+        ], dtype = np.float64)
+        assert(len(PSweights_ext) == self.nPSweight)
+
+        familyWeights['PSWeight'] = puWeight * np.clip(PSweights_ext, -10., 10.)
+        if has_l1Prefire:
+          familyWeights['PSWeightL1PrefireNom'] = familyWeights['PSWeight'] * l1_nom
+
+        if hasattr(event, self.nominalLHEweightName):
+          lhe_nom = getattr(event, self.nominalLHEweightName)
+          familyWeights['PSWeightOriginalXWGTUP'] = puWeight * np.clip(PSweights_ext * lhe_nom, -10., 10.)
+          if has_l1Prefire:
+            familyWeights['PSWeightOriginalXWGTUPL1PrefireNom'] = familyWeights['PSWeightOriginalXWGTUP'] * l1_nom
+        else:
+          if not self.isPrinted[self.nominalLHEweightName]:
+            self.isPrinted[self.nominalLHEweightName] = True
+            print('Missing branch: %s' % self.nominalLHEweightName)
+      else:
+        if not self.isPrinted[self.PSWeightCountName]:
+          self.isPrinted[self.PSWeightCountName] = True
+          print('Missing branch: %s' % self.PSWeightCountName)
+
+    for family in list(familyWeights.keys()):
+      if family not in self.families:
+        del familyWeights[family]
+
+    return familyWeights, LHEEnvelopeValues
+
   def analyze(self, event):
-    if 'histogram' in self.histograms['Count']:
-      if not self.isInitialized(['Count']):
-        self.initHistograms(['Count'])
-      self.histograms['Count']['histogram'].Fill(1, 1)
+    if self.columnar:
+      # the sums are computed in endFile(), only the output branches are filled here
+      self.analyzedEntries.Enter(get_tree_entry(event))
+      self.fillBranches(event)
+      return True
+
+    aux_binIdxs = self.getAuxBinIdxs(event)
+    self.counts[aux_binIdxs] += 1
 
     has_l1Prefire = hasattr(event, self.l1PrefireWeightNomName) and \
                     hasattr(event, self.l1PrefireWeightUpName)  and \
                     hasattr(event, self.l1PrefireWeightDownName)
+    l1_nom, l1_up, l1_down = 1., 1., 1.
     if has_l1Prefire:
       l1_nom  = getattr(event, self.l1PrefireWeightNomName)
       l1_up   = getattr(event, self.l1PrefireWeightUpName)
@@ -425,284 +1336,42 @@ class countHistogramProducer(Module):
     topRwgt = [ 1. ] * len(self.topPtRwgtChoices)
     LHEEnvelopeValues = [ 1., 1. ]
     if self.compTopRwgt:
-      genTops = Collection(event, self.genTopCollectionName)
+      genTops = readGenCollection(event, self.genTopCollectionName)
       topRwgt = [ self.getTopRwgtSF(genTops, choice) for choice in self.topPtRwgtChoices ]
 
-    for aux_bin in self.aux_binning:
-
-      if aux_bin:
-        assert(self.compHTXS or self.splitByLHENjet or self.splitByLHEHT)
-        if self.compHTXS:
-          assert(aux_bin in self.htxs)
-          if not hasattr(event, self.htxsPtBranchName):
-            raise RuntimeError("No such branch: %s" % self.htxsPtBranchName)
-          if not hasattr(event, self.htxsEtaBranchName):
-            raise RuntimeError("No such branch: %s" % self.htxsEtaBranchName)
-          htxs_pt = getattr(event, self.htxsPtBranchName)
-          htxs_eta = getattr(event, self.htxsEtaBranchName)
-          if not self.htxs[aux_bin](htxs_pt, htxs_eta):
-            continue
-        elif self.splitByLHENjet and not self.splitByLHEHT:
-          assert(aux_bin in self.lheNjets)
-          if not hasattr(event, self.LHENjetsBranchName):
-            raise RuntimeError("No such branch: %s" % self.LHENjetsBranchName)
-          lhe_njets = getattr(event, self.LHENjetsBranchName)
-          if not self.lheNjets[aux_bin](lhe_njets):
-            continue
-        elif self.splitByLHEHT and not self.splitByLHENjet:
-          assert(aux_bin in self.lheHT)
-          if not hasattr(event, self.LHEHTBranchName):
-            raise RuntimeError("No such branch: %s" % self.LHEHTBranchName)
-          lhe_ht = getattr(event, self.LHEHTBranchName)
-          if not self.lheHT[aux_bin](lhe_ht):
-            continue
-        elif self.splitByLHENjet and self.splitByLHEHT:
-          assert(aux_bin in self.lheNjetsHT)
-          if not hasattr(event, self.LHEHTBranchName):
-            raise RuntimeError("No such branch: %s" % self.LHEHTBranchName)
-          lhe_ht = getattr(event, self.LHEHTBranchName)
-          if not hasattr(event, self.LHENjetsBranchName):
-            raise RuntimeError("No such branch: %s" % self.LHENjetsBranchName)
-          lhe_njets = getattr(event, self.LHENjetsBranchName)
-          aux_bin_split = aux_bin.split('_')
-          matches_lhe_njets = self.lheNjets[aux_bin_split[0]](lhe_njets)
-          matches_lhe_ht = self.lheHT[aux_bin_split[1]](lhe_ht)
-          matches_lhe_njets_ht = matches_lhe_njets and matches_lhe_ht
-          if not matches_lhe_njets_ht:
-            continue
+    if hasattr(event, self.genWeightName):
+      if hasattr(event, self.puWeightName):
+        genWeightBin = None
+        if self.estimateRefGenWeight:
+          # the genWeight is clipped once the reference is known, see getFinalAccumulators()
+          genWeight_full = getattr(event, self.genWeightName)
+          genWeightBin = int(get_genWeightBins(abs(genWeight_full)))
+          self.fillGenWeightSketch([ genWeightBin ], [ abs(genWeight_full) ])
         else:
-          assert(False)
-
-        if 'histogram' in self.histograms['Count_{}'.format(aux_bin)]:
-          if not self.isInitialized(['Count_{}'.format(aux_bin)]):
-            self.initHistograms(['Count_{}'.format(aux_bin)])
-          self.histograms['Count_{}'.format(aux_bin)]['histogram'].Fill(1, 1)
-
-      if hasattr(event, self.genWeightName):
-        for fullGenWeight in self.useFullGenWeight:
           genWeight_full = clip_genWeight(getattr(event, self.genWeightName), self.ref_genWeight)
-          genWeight_sign = np.sign(genWeight_full)
-          genWeight = genWeight_full if fullGenWeight else genWeight_sign
-
-          if hasattr(event, self.puWeightName):
-            assert(hasattr(event, self.puWeightName_up))
-            assert(hasattr(event, self.puWeightName_down))
-
-            puWeight = getattr(event, self.puWeightName)
-            puWeight_up = getattr(event, self.puWeightName_up)
-            puWeight_down = getattr(event, self.puWeightName_down)
-
-            for topPtRwgtIdx, topPtRwgtLabel in enumerate(self.topPtRwgtLabels):
-              if self.compTopRwgt and topPtRwgtIdx > 0:
-                topSF_pow = int((topPtRwgtIdx % 2) == 0) + 1
-                assert(topSF_pow in [1, 2])
-                topSF_idx = int((topPtRwgtIdx - 1) / 2)
-                assert(topSF_idx <= len(self.topPtRwgtChoices))
-                topSF = topRwgt[topSF_idx]**topSF_pow
-              else:
-                topSF = 1.
-
-              for lheTHXSMWeightIndex in self.lheTHXSMWeightIndices:
-                do_tH = lheTHXSMWeightIndex >= 0
-                insert_name_common = topPtRwgtLabel
-                insert_name_common += ("_rwgt%d" % lheTHXSMWeightIndex) if do_tH else ""
-
-                lheTHXWeight = 1.
-                has_lhe = False
-
-                if do_tH:
-                  if hasattr(event, self.lheTHXWeightCountName) and hasattr(event, self.lheTHXWeightName):
-                    nofLheTHXWeights = getattr(event, self.lheTHXWeightCountName)
-                    if lheTHXSMWeightIndex < nofLheTHXWeights:
-                      lheTHXWeightArr = getattr(event, self.lheTHXWeightName)
-                      lheTHXWeight = lheTHXWeightArr[lheTHXSMWeightIndex]
-                      has_lhe = True
-                  if not has_lhe:
-                    if not self.isPrinted[self.lheTHXWeightName]:
-                      self.isPrinted[self.lheTHXWeightName] = True
-                      print('Missing or unfilled branch: %s' % self.lheTHXWeightName)
-
-                if do_tH and not has_lhe:
-                  continue
-
-                if aux_bin:
-                  insert_name = "%s_%s" % (insert_name_common, aux_bin)
-                else:
-                  insert_name = insert_name_common
-
-                prefix = "CountWeighted{}".format("Full" if fullGenWeight else "")
-
-                if 'histogram' in self.histograms['{}{}'.format(prefix, insert_name)]:
-                  if not self.isInitialized(['{}{}'.format(prefix, insert_name)]):
-                    self.initHistograms(['{}{}'.format(prefix, insert_name)])
-                  self.histograms['{}{}'.format(prefix, insert_name)]['histogram'].Fill(0., genWeight * puWeight * lheTHXWeight * topSF)
-                  self.histograms['{}{}'.format(prefix, insert_name)]['histogram'].Fill(1., genWeight * puWeight_up * lheTHXWeight * topSF)
-                  self.histograms['{}{}'.format(prefix, insert_name)]['histogram'].Fill(2., genWeight * puWeight_down * lheTHXWeight * topSF)
-
-                if has_l1Prefire:
-                  if 'histogram' in self.histograms['{}L1PrefireNom{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}L1PrefireNom{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}L1PrefireNom{}'.format(prefix, insert_name)])
-                    self.histograms['{}L1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(0., genWeight * puWeight * lheTHXWeight * l1_nom * topSF)
-                    self.histograms['{}L1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(1., genWeight * puWeight_up * lheTHXWeight * l1_nom * topSF)
-                    self.histograms['{}L1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(2., genWeight * puWeight_down * lheTHXWeight * l1_nom * topSF)
-
-                  if 'histogram' in self.histograms['{}L1Prefire{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}L1Prefire{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}L1Prefire{}'.format(prefix, insert_name)])
-                    self.histograms['{}L1Prefire{}'.format(prefix, insert_name)]['histogram'].Fill(0., genWeight * puWeight * lheTHXWeight * l1_nom * topSF)
-                    self.histograms['{}L1Prefire{}'.format(prefix, insert_name)]['histogram'].Fill(1., genWeight * puWeight * lheTHXWeight * l1_up * topSF)
-                    self.histograms['{}L1Prefire{}'.format(prefix, insert_name)]['histogram'].Fill(2., genWeight * puWeight * lheTHXWeight * l1_down * topSF)
-
-                if hasattr(event, self.LHEScaleWeightName):
-                  assert(self.compLHEEnvelope)
-                  LHEScaleWeight = getattr(event, self.LHEScaleWeightName)
-                  LHEEnvelopeValues = self.getLHEEnvelope(LHEScaleWeight)
-                  LHENominal = self.getLHENominal(LHEScaleWeight)
-
-                  nof_lheScaleWeight = len(LHEScaleWeight)
-                  if nof_lheScaleWeight != self.nLHEScaleWeight:
-                    print(
-                      "WARNING: The length of '%s' array (= %i) does not match to the expected length of %i" % \
-                      (self.LHEScaleWeightName, len(LHEScaleWeight), self.nLHEScaleWeight)
-                    )
-                    self.nLHEScaleWeight = nof_lheScaleWeight
-
-                  if 'histogram' in self.histograms['{}LHEWeightScale{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}LHEWeightScale{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}LHEWeightScale{}'.format(prefix, insert_name)], self.nLHEScaleWeight)
-                    for lhe_scale_idx in range(self.nLHEScaleWeight):
-                      self.histograms['{}LHEWeightScale{}'.format(prefix, insert_name)]['histogram'].Fill(
-                        float(lhe_scale_idx), genWeight * puWeight * lheTHXWeight * self.clip_lhe(LHEScaleWeight[lhe_scale_idx], LHENominal) * topSF
-                      )
-
-                  if has_l1Prefire:
-                    if 'histogram' in self.histograms['{}LHEWeightScaleL1PrefireNom{}'.format(prefix, insert_name)]:
-                      if not self.isInitialized(['{}LHEWeightScaleL1PrefireNom{}'.format(prefix, insert_name)]):
-                        self.initHistograms(['{}LHEWeightScaleL1PrefireNom{}'.format(prefix, insert_name)], self.nLHEScaleWeight)
-                      for lhe_scale_idx in range(self.nLHEScaleWeight):
-                        self.histograms['{}LHEWeightScaleL1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(
-                          float(lhe_scale_idx), genWeight * puWeight * lheTHXWeight * l1_nom * self.clip_lhe(LHEScaleWeight[lhe_scale_idx], LHENominal) * topSF
-                        )
-
-                  if 'histogram' in self.histograms['{}LHEEnvelope{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}LHEEnvelope{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}LHEEnvelope{}'.format(prefix, insert_name)], self.nLHEEnvelope)
-                    for lhe_scale_idx, lhe_scale_value in enumerate(LHEEnvelopeValues):
-                      self.histograms['{}LHEEnvelope{}'.format(prefix, insert_name)]['histogram'].Fill(
-                        float(lhe_scale_idx), genWeight * puWeight * lheTHXWeight * self.clip_lhe(lhe_scale_value, LHENominal) * topSF
-                      )
-                  if has_l1Prefire:
-                    if 'histogram' in self.histograms['{}LHEEnvelopeL1PrefireNom{}'.format(prefix, insert_name)]:
-                      if not self.isInitialized(['{}LHEEnvelopeL1PrefireNom{}'.format(prefix, insert_name)]):
-                        self.initHistograms(['{}LHEEnvelopeL1PrefireNom{}'.format(prefix, insert_name)], self.nLHEEnvelope)
-                      for lhe_scale_idx, lhe_scale_value in enumerate(LHEEnvelopeValues):
-                        self.histograms['{}LHEEnvelopeL1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(
-                          float(lhe_scale_idx), genWeight * puWeight * lheTHXWeight * l1_nom * self.clip_lhe(lhe_scale_value, LHENominal) * topSF
-                        )
-
-                else:
-                  if not self.isPrinted[self.LHEScaleWeightName]:
-                    self.isPrinted[self.LHEScaleWeightName] = True
-                    print('Missing branch: %s' % self.LHEScaleWeightName)
-
-                if hasattr(event, self.LHEPdfWeightName):
-                  LHEPdfWeight = getattr(event, self.LHEPdfWeightName)
-
-                  if len(LHEPdfWeight) != self.nLHEPdfWeight:
-                    print(
-                      "WARNING: The length of '%s' array (= %i) does not match to the expected length of %i" % \
-                      (self.LHEPdfWeightName, len(LHEPdfWeight), self.nLHEPdfWeight)
-                    )
-                    self.nLHEPdfWeight = len(LHEPdfWeight)
-
-                  if 'histogram' in self.histograms['{}LHEWeightPdf{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}LHEWeightPdf{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}LHEWeightPdf{}'.format(prefix, insert_name)], self.nLHEPdfWeight)
-                    for lhe_pdf_idx in range(self.nLHEPdfWeight):
-                      self.histograms['{}LHEWeightPdf{}'.format(prefix, insert_name)]['histogram'].Fill(
-                        float(lhe_pdf_idx), genWeight * puWeight * lheTHXWeight * self.clip_lhe(LHEPdfWeight[lhe_pdf_idx]) * topSF
-                      )
-
-                  if has_l1Prefire:
-                    if 'histogram' in self.histograms['{}LHEWeightPdfL1PrefireNom{}'.format(prefix, insert_name)]:
-                      if not self.isInitialized(['{}LHEWeightPdfL1PrefireNom{}'.format(prefix, insert_name)]):
-                        self.initHistograms(['{}LHEWeightPdfL1PrefireNom{}'.format(prefix, insert_name)], self.nLHEPdfWeight)
-                      for lhe_pdf_idx in range(self.nLHEPdfWeight):
-                        self.histograms['{}LHEWeightPdfL1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(
-                          float(lhe_pdf_idx), genWeight * puWeight * lheTHXWeight * l1_nom * self.clip_lhe(LHEPdfWeight[lhe_pdf_idx]) * topSF
-                        )
-                else:
-                  if not self.isPrinted[self.LHEPdfWeightName]:
-                    self.isPrinted[self.LHEPdfWeightName] = True
-                    print('Missing branch: %s' % self.LHEPdfWeightName)
-
-                nof_PSweight = getattr(event, self.PSWeightCountName, 0)
-                if nof_PSweight == self.nPSWeight_required:
-                  PSweights = getattr(event, self.PSWeightName)
-                  assert(len(PSweights) == nof_PSweight)
-                  # FSR and ISR may move in opposite directions -> just take min and max of the weights to build the envelope
-                  PS_env_up = max([ PSweights[ps_idx] for ps_idx in range(nof_PSweight) ])
-                  PS_env_down = min([ PSweights[ps_idx] for ps_idx in range(nof_PSweight) ])
-                  # target: ISR/FSR/both up, ISR/FSR/both down
-                  PSweights_ext = [
-                    PSweights[self.ISR_up_idx],   PSweights[self.FSR_up_idx],   PS_env_up,
-                    PSweights[self.ISR_down_idx], PSweights[self.FSR_down_idx], PS_env_down,
-                  ]
-                  assert(len(PSweights_ext) == self.nPSweight)
-
-                  if 'histogram' in self.histograms['{}PSWeight{}'.format(prefix, insert_name)]:
-                    if not self.isInitialized(['{}PSWeight{}'.format(prefix, insert_name)]):
-                      self.initHistograms(['{}PSWeight{}'.format(prefix, insert_name)], self.nPSweight)
-                    for psweight_idx, psweight in enumerate(PSweights_ext):
-                      self.histograms['{}PSWeight{}'.format(prefix, insert_name)]['histogram'].Fill(
-                        float(psweight_idx), genWeight * puWeight * lheTHXWeight * clip(psweight) * topSF
-                      )
-                  if has_l1Prefire:
-                    if 'histogram' in self.histograms['{}PSWeightL1PrefireNom{}'.format(prefix, insert_name)]:
-                      if not self.isInitialized(['{}PSWeightL1PrefireNom{}'.format(prefix, insert_name)]):
-                        self.initHistograms(['{}PSWeightL1PrefireNom{}'.format(prefix, insert_name)], self.nPSweight)
-                      for psweight_idx, psweight in enumerate(PSweights_ext):
-                        self.histograms['{}PSWeightL1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(
-                          float(psweight_idx), genWeight * puWeight * lheTHXWeight * l1_nom * clip(psweight) * topSF
-                        )
-
-                  if hasattr(event, self.nominalLHEweightName):
-                    lhe_nom = getattr(event, self.nominalLHEweightName)
-                    if 'histogram' in self.histograms['{}PSWeightOriginalXWGTUP{}'.format(prefix, insert_name)]:
-                      if not self.isInitialized(['{}PSWeightOriginalXWGTUP{}'.format(prefix, insert_name)]):
-                        self.initHistograms(['{}PSWeightOriginalXWGTUP{}'.format(prefix, insert_name)], self.nPSweight)
-                      for psweight_idx, psweight in enumerate(PSweights_ext):
-                        self.histograms['{}PSWeightOriginalXWGTUP{}'.format(prefix, insert_name)]['histogram'].Fill(
-                          float(psweight_idx), genWeight * puWeight * lheTHXWeight * clip(psweight * lhe_nom) * topSF
-                        )
-                    if has_l1Prefire:
-                      if 'histogram' in self.histograms['{}PSWeightOriginalXWGTUPL1PrefireNom{}'.format(prefix, insert_name)]:
-                        if not self.isInitialized(['{}PSWeightOriginalXWGTUPL1PrefireNom{}'.format(prefix, insert_name)]):
-                          self.initHistograms(['{}PSWeightOriginalXWGTUPL1PrefireNom{}'.format(prefix, insert_name)], self.nPSweight)
-                        for psweight_idx, psweight in enumerate(PSweights_ext):
-                          self.histograms['{}PSWeightOriginalXWGTUPL1PrefireNom{}'.format(prefix, insert_name)]['histogram'].Fill(
-                            float(psweight_idx), genWeight * puWeight * lheTHXWeight * l1_nom * clip(psweight * lhe_nom) * topSF
-                          )
-                  else:
-                    if not self.isPrinted[self.nominalLHEweightName]:
-                      self.isPrinted[self.nominalLHEweightName] = True
-                      print('Missing branch: %s' % self.nominalLHEweightName)
-
-                else:
-                  if not self.isPrinted[self.PSWeightCountName]:
-                    self.isPrinted[self.PSWeightCountName] = True
-                    print('Missing branch: %s' % self.PSWeightCountName)
-
-        else:
-          if not self.isPrinted[self.puWeightName]:
-            self.isPrinted[self.puWeightName] = True
-            print('Missing branch: %s' % self.puWeightName)
+        genWeight_sign = np.sign(genWeight_full)
+        genWeights = np.array([
+          genWeight_full if fullGenWeight else genWeight_sign for fullGenWeight in self.useFullGenWeight
+        ], dtype = np.float64)
+        topPtRwgtSFs = np.array(self.getTopPtRwgtSFs(topRwgt), dtype = np.float64)
+        lheTHXWeights, lheTHXWeightsMask = self.getLheTHXWeights(event)
+        familyWeights, LHEEnvelopeValues = self.getFamilyWeights(event, has_l1Prefire, l1_nom, l1_up, l1_down)
+
+        # genWeight x top pT reweighting SF x tH weight, shared by all families
+        evtWeights = np.multiply.outer(np.multiply.outer(genWeights, topPtRwgtSFs), lheTHXWeights)
+        accumulators = self.getAccumulators(genWeightBin)
+        for family, weights in familyWeights.items():
+          self.accumulate(accumulators, family, evtWeights, weights, aux_binIdxs, lheTHXWeightsMask)
 
       else:
-        if not self.isPrinted[self.genWeightName]:
-          self.isPrinted[self.genWeightName] = True
-          print('Missing branch: %s' % self.genWeightName)
+        if not self.isPrinted[self.puWeightName]:
+          self.isPrinted[self.puWeightName] = True
+          print('Missing branch: %s' % self.puWeightName)
+
+    else:
+      if not self.isPrinted[self.genWeightName]:
+        self.isPrinted[self.genWeightName] = True
+        print('Missing branch: %s' % self.genWeightName)
 
     if self.out:
       if self.compTopRwgt:
@@ -715,16 +1384,141 @@ class countHistogramProducer(Module):
 
     return True
 
+  def fillBranches(self, event):
+    if not self.out:
+      return
+    topRwgt = [ 1. ] * len(self.topPtRwgtChoices)
+    LHEEnvelopeValues = [ 1., 1. ]
+    if self.compTopRwgt:
+      genTops = readGenCollection(event, self.genTopCollectionName)
+      topRwgt = [ self.getTopRwgtSF(genTops, choice) for choice in self.topPtRwgtChoices ]
+    if hasattr(event, self.genWeightName) and hasattr(event, self.puWeightName) and \
+       hasattr(event, self.LHEScaleWeightName):
+      LHEScaleWeight = getattr(event, self.LHEScaleWeightName)
+      LHEEnvelopeValues = self.getLHEEnvelope(LHEScaleWeight)
+      self.nLHEScaleWeight = len(LHEScaleWeight)
+
+    if self.compTopRwgt:
+      for topPtRwgtIdx, choice in enumerate(self.topPtRwgtChoices):
+        self.out.fillBranch("{}_{}".format(self.topRwgtBranchName, choice), topRwgt[topPtRwgtIdx])
+    if self.compLHEEnvelope:
+      self.out.fillBranch(self.LHEEnvelopeNameUp, self.clip_lhe(LHEEnvelopeValues[0]))
+      self.out.fillBranch(self.LHEEnvelopeNameDown, self.clip_lhe(LHEEnvelopeValues[1]))
+
+def read_refGenWeight(directory):
+  # returns the reference genWeight that was used in the clipping, also from the outputs of several jobs merged with hadd
+  sumw, sumw2 = read_histogram(directory.Get(REF_GENWEIGHT_HISTOGRAM_NAME))
+  nofFiles = int(round(sumw[1]))
+  ref_genWeight = sumw[0] / nofFiles
+  if not np.isclose(sumw2[0], nofFiles * ref_genWeight**2, rtol = 1e-6, atol = 0.):
+    raise ValueError(
+      "The %d merged files were produced with different reference genWeights, hence their genWeights are clipped "
+      "inconsistently; use a fixed reference genWeight instead of '%s' if the sample is processed in several jobs" % \
+      (nofFiles, REF_GENWEIGHT_AUTO)
+    )
+  return ref_genWeight
+
+class CountHistogramReader(object):
+  # Provides the histograms of the legacy layout from the output that is written in the compact layout.
+  # Usage: reader = CountHistogramReader(inputFile.Get(process_name)); histogram = reader.Get('CountWeightedFull')
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.index = json.loads(self.directory.Get('%s_index' % COMPACT_PREFIX).GetString().Data())
+    self.families = collections.OrderedDict(
+      (family, (histogramName, title, tuple(shape))) for family, histogramName, title, shape in self.index['families']
+    )
+    self.arrays = {}
+    self.histogramKeys = None
+
+  def getArrays(self, family):
+    if family not in self.arrays:
+      histogramName, title, shape = self.families[family]
+      sumw, sumw2 = read_histogram(self.directory.Get(histogramName))
+      nofEntries = read_histogram(self.directory.Get('%s_entries' % histogramName))[0]
+      self.arrays[family] = (
+        sumw.reshape(shape), sumw2.reshape(shape), np.round(nofEntries).astype(np.int64).reshape(shape[2:4])
+      )
+    return self.arrays[family]
+
+  def getHistogramKeys(self):
+    # maps the legacy names to the family and the indices of the histogram
+    if self.histogramKeys is None:
+      self.histogramKeys = collections.OrderedDict()
+      counts = read_histogram(self.directory.Get('%s_Count' % COMPACT_PREFIX))[0]
+      for aux_binIdx in np.flatnonzero(counts):
+        self.histogramKeys[self.index['count'][aux_binIdx][0]] = (None, aux_binIdx)
+      for family in self.families:
+        nofEntries = self.getArrays(family)[2]
+        for lheTHXSMWeightIdx, aux_binIdx in np.argwhere(nofEntries > 0):
+          for genWeightIdx, genWeightLabel in enumerate(self.index['genWeight']):
+            for topPtRwgtIdx, topPtRwgtLabel in enumerate(self.index['topPtRwgt']):
+              histogramName = "CountWeighted{}{}{}{}{}".format(
+                genWeightLabel[0], family, topPtRwgtLabel[0],
+                self.index['lheTHX'][lheTHXSMWeightIdx][0], self.index['aux'][aux_binIdx][0],
+              )
+              self.histogramKeys[histogramName] = (family, (genWeightIdx, topPtRwgtIdx, lheTHXSMWeightIdx, aux_binIdx))
+    return self.histogramKeys
+
+  def keys(self):
+    return list(self.getHistogramKeys().keys())
+
+  def getRefGenWeight(self):
+    return read_refGenWeight(self.directory)
+
+  def Get(self, histogramName):
+    histogramKeys = self.getHistogramKeys()
+    if histogramName not in histogramKeys:
+      return None
+    family, histogramIdx = histogramKeys[histogramName]
+    if family is None:
+      nofCounts = read_histogram(self.directory.Get('%s_Count' % COMPACT_PREFIX))[0][histogramIdx]
+      histogram = create_histogram(
+        ROOT.TH1I, histogramName, self.index['count'][histogramIdx][1], 0., 2., [ nofCounts ], [ nofCounts ], nofCounts
+      )
+      histogram.SetDirectory(0)
+      return histogram
+    sumw, sumw2, nofEntries = self.getArrays(family)
+    genWeightIdx, topPtRwgtIdx, lheTHXSMWeightIdx, aux_binIdx = histogramIdx
+    histogramTitle = self.families[family][1].format(
+      gen  = self.index['genWeight'][genWeightIdx][1],
+      rwgt = self.index['topPtRwgt'][topPtRwgtIdx][1] + self.index['lheTHX'][lheTHXSMWeightIdx][1],
+      aux  = self.index['aux'][aux_binIdx][1],
+    )
+    nofBins = sumw.shape[-1]
+    histogram = create_histogram(
+      ROOT.TH1F, histogramName, histogramTitle, -0.5, nofBins - 0.5,
+      sumw[histogramIdx], sumw2[histogramIdx], nofEntries[lheTHXSMWeightIdx, aux_binIdx]
+    )
+    histogram.SetDirectory(0)
+    return histogram
+
 # provide this variable as the 2nd argument to the import option for the nano_postproc.py script
-def countHistogramAll(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = False, splitByLHEHT = False)
-def countHistogramAllCompTopRwgt(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = True,  compHTXS = False, splitByLHENjet = False, splitByLHEHT = False)
-def countHistogramAllCompHTXS(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = True,  splitByLHENjet = False, splitByLHEHT = False)
-def countHistogramAllSplitByLHENjet(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = True,  splitByLHEHT = False)
-def countHistogramAllSplitByLHEHT(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = False, splitByLHEHT = True)
-def countHistogramAllSplitByLHENjetHT(output_file, process_name, refGenWeight):
-  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = True,  splitByLHEHT = True)
+def countHistogramAll(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                      memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = False, splitByLHEHT = False, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllCompTopRwgt(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                                 memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = True,  compHTXS = False, splitByLHENjet = False, splitByLHEHT = False, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllCompHTXS(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                              memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = True,  splitByLHENjet = False, splitByLHEHT = False, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllSplitByLHENjet(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                                    memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = True,  splitByLHEHT = False, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllSplitByLHEHT(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                                  memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = False, splitByLHEHT = True, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllSplitByLHENjetHT(output_file, process_name, refGenWeight, columnar = False, families = None, outputLayout = 'legacy',
+                                      memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = True,  splitByLHEHT = True, columnar = columnar, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
+def countHistogramAllSplitBy(output_file, process_name, refGenWeight, splitBy, columnar = False, families = None, outputLayout = 'legacy',
+                             memoryLimit = None, scratchDir = None):
+  return countHistogramProducer(output_file, process_name, refGenWeight, compTopRwgt = False, compHTXS = False, splitByLHENjet = False, splitByLHEHT = False, columnar = columnar, splitBy = splitBy, families = families, outputLayout = outputLayout,
+                                memoryLimit = memoryLimit, scratchDir = scratchDir)
@@ -4,8 +4,15 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import MassTable, getGenParticles
+from tthAnalysis.NanoAODTools.postprocessing.histogramUtils import create_histogram, read_histogram
+from tthAnalysis.NanoAODTools.postprocessing.arrayCache import get_cache_file, load_arrays, save_arrays
+
 from HHStatAnalysis.AnalyticalModels.NonResonantModel import NonResonantModel
 
+import numpy as np
+import inspect
+import json
 import os
 
 def get_p4(higgs):
@@ -16,13 +23,79 @@ def get_p4(higgs):
 def get_p4_pair(higgsArr):
   return get_p4(higgsArr[0]), get_p4(higgsArr[1])
 
+# number of coefficients per bin in the analytical model
+NOF_COEFFICIENTS = 15
+
+WEIGHT_TABLE_PREFIX = 'HHWeightTable'
+
+# version of the normalizations and of the weight tables that are stored in the cache directory
+HH_CACHE_VERSION = 3
+
+def get_couplings(kl, kt, c2, cg, c2g):
+  return np.column_stack([ kl, kt, c2, cg, c2g ]).astype(np.float64)
+
+def get_axis_edges(axis):
+  return np.array([ axis.GetBinLowEdge(binIdx) for binIdx in range(1, axis.GetNbins() + 2) ])
+
+# kl, kt, c2, cg, c2g of the SM point
+COUPLINGS_SM = get_couplings([ 1. ], [ 1. ], [ 0. ], [ 0. ], [ 0. ])
+
+# binning of the model coefficients in mHH and |cos(theta*)|, as in NonResonantModel.getScaleFactor(); the binning is
+# checked against the model in diHiggsVarProducer.build_weight_matrices()
+COEFFICIENT_EDGES_MHH = np.array([
+   250.,  260.,  270.,  280.,  290.,  300.,  310.,  320.,  330.,  340.,  350.,  360.,  370.,  380.,  390.,  400.,
+   410.,  420.,  430.,  440.,  450.,  460.,  470.,  480.,  490.,  500.,  510.,  520.,  530.,  540.,  550.,  600.,
+   610.,  620.,  630.,  640.,  650.,  660.,  670.,  680.,  690.,  700.,  750.,  800.,  850.,  900.,  950., 1000.,
+  1100., 1200., 1300., 1400., 1500., 1750., 2000., 50000.,
+])
+COEFFICIENT_EDGES_COSTHETASTAR = np.array([ 0., 0.4, 0.6, 0.8, 1. ])
+
+def get_monomials(model, couplings):
+  # Coupling terms that multiply each model coefficient in NonResonantModel.functionGF, which is linear in the
+  # coefficients; the terms are obtained by evaluating the function for each coefficient separately.
+  unitCoefficients = np.eye(NOF_COEFFICIENTS)
+  return np.array([
+    [ model.functionGF(kl, kt, c2, cg, c2g, unitCoefficients[coeffIdx]) for coeffIdx in range(NOF_COEFFICIENTS) ]
+    for kl, kt, c2, cg, c2g in couplings
+  ])
+
+def get_coefficient_table(model):
+  # returns the coefficients that NonResonantModel.ReadCoefficients() has read from the file, as an array of shape
+  # (mHH bin, cos(theta*) bin, coefficient)
+  nofBinsMHH = len(COEFFICIENT_EDGES_MHH) - 1
+  nofBinsCosThetaStar = len(COEFFICIENT_EDGES_COSTHETASTAR) - 1
+  coefficientTable = np.zeros((nofBinsMHH, nofBinsCosThetaStar, NOF_COEFFICIENTS))
+  for coeffIdx in range(NOF_COEFFICIENTS):
+    coefficients = getattr(model, 'A%d' % (coeffIdx + 1))
+    for mHH_bin in range(nofBinsMHH):
+      for cosThetaStar_bin in range(nofBinsCosThetaStar):
+        coefficientTable[mHH_bin, cosThetaStar_bin, coeffIdx] = coefficients[mHH_bin][cosThetaStar_bin]
+  return coefficientTable
+
 class diHiggsVarProducer(Module):
 
-  def __init__(self, era, use_lhe = True, use_gen = False, compute_weights = False):
+  # In the 'full' output layout, the HH weights of every event are written as arrays. In the 'index' output layout,
+  # only the index of the (mHH, cos(theta*)) bin of the event in the weight table is written per event, while the table
+  # is stored once per output file (see HHWeightReader). The index only depends on the binning of the denominator
+  # histogram, and the table is written such that it can be recovered from output files that are merged with hadd.
+  # The events outside of the binning have the index -1, and their weights (if not zero) are written to a separate
+  # array that is empty for all other events.
+
+  # The HH model, the normalizations of the benchmarks and the weight table are set up only when the weights are
+  # needed for the first time. If cacheDir is given, the normalizations and the weight table are stored there and
+  # reused by the later jobs; the files are keyed by the contents of the input files and of the model they are computed
+  # from (see arrayCache).
+
+  def __init__(self, era, use_lhe = True, use_gen = False, compute_weights = False, cacheDir = None,
+               outputLayout = 'full'):
     self.use_gen = use_gen
     self.use_lhe = use_lhe
     assert(self.use_gen or self.use_lhe)
     self.compute_weights = compute_weights
+    self.outputLayout = outputLayout
+    if self.outputLayout not in [ 'full', 'index' ]:
+      raise ValueError("Invalid output layout: %s" % self.outputLayout)
+    self.massTable = MassTable()
 
     if self.use_gen:
       print("Computing di-Higgs variables from generator-level Higgs bosons")
@@ -59,32 +132,54 @@ class diHiggsVarProducer(Module):
     self.weightScan_genName = "{}_{}_{}".format(weightBaseName, scanName, gen_suffix)
     self.weightScan_lheName = "{}_{}_{}".format(weightBaseName, scanName, lhe_suffix)
 
+    self.weightIdx_genName = "{}_binIdx_{}".format(weightBaseName, gen_suffix)
+    self.weightIdx_lheName = "{}_binIdx_{}".format(weightBaseName, lhe_suffix)
+
+    outOfRangeName = "outOfRange"
+    self.nofWeightsOutOfRange_genName = "n{}_{}_{}".format(weightBaseName, outOfRangeName, gen_suffix)
+    self.nofWeightsOutOfRange_lheName = "n{}_{}_{}".format(weightBaseName, outOfRangeName, lhe_suffix)
+    self.weightOutOfRange_genName = "{}_{}_{}".format(weightBaseName, outOfRangeName, gen_suffix)
+    self.weightOutOfRange_lheName = "{}_{}_{}".format(weightBaseName, outOfRangeName, lhe_suffix)
+
     os.environ["MKL_NUM_THREADS"] = "1"
 
     cmssw_base = os.path.join(os.environ['CMSSW_BASE'], "src")
-    coeffFile = os.path.join(
+    self.coeffFile = os.path.join(
       cmssw_base, "HHStatAnalysis/AnalyticalModels/data/coefficientsByBin_extended_3M_costHHSim_19-4.txt"
     )
-    self.model = None
+    self.model_ = None
     if self.compute_weights:
-      assert (os.path.isfile(coeffFile))
-      self.model = NonResonantModel()
-      self.model.ReadCoefficients(coeffFile)
+      assert (os.path.isfile(self.coeffFile))
 
-    denominatorHistogramName = "denominator_reweighting"
-    denominatorFile = os.path.join(
+    self.denominatorHistogramName = "denominator_reweighting"
+    self.denominatorFile = os.path.join(
       cmssw_base, "hhAnalysis/bbww/data/denominator_reweighting_bbvv_{}.root".format(era)
     )
     self.denominatorFilePtr = None
     self.denominatorHistogram = None
     if self.compute_weights:
-      assert (os.path.isfile(denominatorFile))
-      self.denominatorFilePtr = ROOT.TFile.Open(denominatorFile, "READ")
+      assert (os.path.isfile(self.denominatorFile))
+      self.denominatorFilePtr = ROOT.TFile.Open(self.denominatorFile, "READ")
       assert(self.denominatorFilePtr)
-      assert(denominatorHistogramName in [ key.GetName() for key in self.denominatorFilePtr.GetListOfKeys() ])
-      self.denominatorHistogram = self.denominatorFilePtr.Get(denominatorHistogramName)
-
-    scanFile = os.path.join(cmssw_base, "hhAnalysis/bbww/data/kl_scan.dat")
+      assert(self.denominatorHistogramName in [ key.GetName() for key in self.denominatorFilePtr.GetListOfKeys() ])
+      self.denominatorHistogram = self.denominatorFilePtr.Get(self.denominatorHistogramName)
+
+    # the denominator is read once, including the under- and overflow bins, so that it can be looked up per event
+    # without calling ROOT
+    self.mHHEdges = None
+    self.cosThetaStarEdges = None
+    self.denominators = None
+    if self.compute_weights:
+      self.mHHEdges = get_axis_edges(self.denominatorHistogram.GetXaxis())
+      self.cosThetaStarEdges = get_axis_edges(self.denominatorHistogram.GetYaxis())
+      self.denominators = np.array([
+        [
+          self.denominatorHistogram.GetBinContent(mHH_bin, cosThetaStar_bin)
+          for cosThetaStar_bin in range(len(self.cosThetaStarEdges) + 1)
+        ] for mHH_bin in range(len(self.mHHEdges) + 1)
+      ])
+
+    self.scanFile = os.path.join(cmssw_base, "hhAnalysis/bbww/data/kl_scan.dat")
     self.nofWeightsScan = 0
     self.klScan      = []
     self.ktScan      = []
@@ -94,8 +189,8 @@ class diHiggsVarProducer(Module):
     self.BM_klScan   = []
     self.Norm_klScan = []
     if self.compute_weights:
-      assert (os.path.isfile(scanFile))
-      with open(scanFile, 'r') as scanFileObj:
+      assert (os.path.isfile(self.scanFile))
+      with open(self.scanFile, 'r') as scanFileObj:
         for line in scanFileObj:
           line_split = line.rstrip('\n').split()
           if len(line_split) != 7:
@@ -118,8 +213,8 @@ class diHiggsVarProducer(Module):
       )
       print("Using %d points to scan" % self.nofWeightsScan)
 
-    normFile = os.path.join(cmssw_base, "Support/NonResonant/Distros_5p_SM3M_sumBenchJHEP_13TeV_19-4.root")
-    normHist = "H1bin4"
+    self.normFile = os.path.join(cmssw_base, "Support/NonResonant/Distros_5p_SM3M_sumBenchJHEP_13TeV_19-4.root")
+    self.normHist = "H1bin4"
     self.nofWeightsBM = 13
     self.klJHEP   = [ 1.0,  7.5,  1.0,  1.0, -3.5,  1.0,  2.4,  5.0, 15.0,  1.0, 10.0,  2.4, 15.0 ]
     self.ktJHEP   = [ 1.0,  1.0,  1.0,  1.0,  1.5,  1.0,  1.0,  1.0,  1.0,  1.0,  1.5,  1.0,  1.0 ]
@@ -133,17 +228,216 @@ class diHiggsVarProducer(Module):
       len(self.cgJHEP)   == self.nofWeightsBM and
       len(self.c2gJHEP)  == self.nofWeightsBM
     )
-    self.normJHEP = []
+    self.normJHEP_ = None
     if self.compute_weights:
-      assert(os.path.isfile(normFile))
-      for idx in range(self.nofWeightsBM):
-        normJHEPval = self.model.getNormalization(
-          self.klJHEP[idx], self.ktJHEP[idx], self.c2JHEP[idx], self.cgJHEP[idx], self.c2gJHEP[idx], normFile, normHist
-        )
-        self.normJHEP.append(normJHEPval)
-      assert(len(self.normJHEP) == self.nofWeightsBM)
+      assert(os.path.isfile(self.normFile))
       print("Using %d JHEP BMs" % self.nofWeightsBM)
 
+    self.cacheDir = cacheDir
+    self.couplingsBM   = get_couplings(self.klJHEP, self.ktJHEP, self.c2JHEP, self.cgJHEP, self.c2gJHEP)
+    self.couplingsScan = get_couplings(self.klScan, self.ktScan, self.c2Scan, self.cgScan, self.c2gScan)
+    self.couplings     = np.concatenate([ self.couplingsBM, self.couplingsScan ])
+    # coupling terms of all points and the factors that the weights are computed with (see build_weight_matrices)
+    self.coefficientTable = None
+    self.monomials = None
+    self.inclusiveTerms = None
+    self.normFactors = None
+    self.useWeightMatrices = True
+    self.weightTable = None
+    self.weightTableReady = False
+
+  @property
+  def model(self):
+    if self.model_ is None:
+      self.model_ = NonResonantModel()
+      self.model_.ReadCoefficients(self.coeffFile)
+    return self.model_
+
+  def get_cache_file(self, name, fileNames, extras):
+    # the cached arrays also depend on the implementation of the model
+    modelFile = inspect.getsourcefile(NonResonantModel)
+    return get_cache_file(
+      self.cacheDir, name, HH_CACHE_VERSION, fileNames + ([ modelFile ] if modelFile else []), extras
+    )
+
+  @property
+  def normJHEP(self):
+    if self.normJHEP_ is None:
+      normFile = self.get_cache_file(
+        "HHNormalizations", [ self.coeffFile, self.normFile ], [ self.normHist, self.couplingsBM ]
+      )
+      if normFile and os.path.isfile(normFile):
+        self.normJHEP_ = list(load_arrays(normFile)['norms'])
+        print("Loaded the normalizations of %d JHEP BMs from %s" % (len(self.normJHEP_), normFile))
+      else:
+        self.normJHEP_ = [
+          self.model.getNormalization(kl, kt, c2, cg, c2g, self.normFile, self.normHist)
+          for kl, kt, c2, cg, c2g in self.couplingsBM
+        ]
+        if normFile:
+          save_arrays(normFile, norms = np.array(self.normJHEP_))
+      assert(len(self.normJHEP_) == self.nofWeightsBM)
+    return self.normJHEP_
+
+  def get_norms(self):
+    return list(self.normJHEP) + list(self.Norm_klScan)
+
+  def init_weight_table(self):
+    if not self.weightTableReady:
+      self.build_weight_table(self.get_cache_file(
+        "HHWeightTable",
+        [ self.coeffFile, self.denominatorFile, self.scanFile, self.normFile ],
+        [ self.denominatorHistogramName, self.normHist, self.couplingsBM ],
+      ))
+      self.weightTableReady = True
+
+  def build_weight_matrices(self):
+    # The scale factor of every coupling point is the ratio of the model function evaluated with the coefficients of
+    # the (mHH, cos(theta*)) bin of the event and with the inclusive coefficients:
+    #   w(c) = n(Cnorm(c)) * s * r(c),  r(c) = m(c) . A(bin) / m(c) . A(13TeV),
+    # where m(c) are the coupling terms, s depends only on the denominator and n only on the normalization. The coupling
+    # terms of all points are stacked into a matrix M, so that the weights of an event follow from the coefficients of
+    # its bin with one matrix-vector product:
+    #   w = w(SM) / r(SM) * (M . A(bin)) / (M . A(13TeV)) * n(Cnorm) / n(1),
+    # where the coefficients A(bin) are looked up in the table of the model coefficients and the weight of the SM point
+    # w(SM) is obtained from a single model evaluation.
+    try:
+      self.coefficientTable = get_coefficient_table(self.model)
+    except (AttributeError, IndexError, TypeError, ValueError) as err:
+      print("WARNING: cannot read the table of the model coefficients (%s); computing the HH weights point by point" % err)
+      self.useWeightMatrices = False
+      return
+    self.monomials = get_monomials(self.model, self.couplings)
+    self.monomialSM = get_monomials(self.model, COUPLINGS_SM)[0]
+    inclusiveCoefficients = np.asarray(self.model.A13tev, dtype = np.float64)
+    self.inclusiveTerms = self.monomials.dot(inclusiveCoefficients)
+    self.inclusiveTermSM = self.monomialSM.dot(inclusiveCoefficients)
+
+    # the dependence on the normalization is taken from the model at the SM point
+    refKinematics = dict(mhh = 400., cost = 0.5, kl = 1., kt = 1., c2 = 0., cg = 0., c2g = 0., effSumV0 = 1.)
+    refWeight = self.model.getScaleFactor(Cnorm = 1., **refKinematics)
+    if refWeight == 0. or not self.inclusiveTerms.all() or self.inclusiveTermSM == 0.:
+      print("WARNING: cannot express the HH weights by the model coefficients; computing them point by point")
+      self.useWeightMatrices = False
+      return
+    self.normFactors = np.array([
+      self.model.getScaleFactor(Cnorm = norm, **refKinematics) / refWeight for norm in self.get_norms()
+    ])
+
+    # make sure that the weights agree with the ones computed point by point in the middle of every coefficient bin,
+    # which also checks the binning of the coefficients
+    for mHH_bin in range(len(COEFFICIENT_EDGES_MHH) - 1):
+      for cosThetaStar_bin in range(len(COEFFICIENT_EDGES_COSTHETASTAR) - 1):
+        mHH = COEFFICIENT_EDGES_MHH[mHH_bin:mHH_bin + 2].mean()
+        cosThetaStar = COEFFICIENT_EDGES_COSTHETASTAR[cosThetaStar_bin:cosThetaStar_bin + 2].mean()
+        if not self.check_weight_matrices(mHH, cosThetaStar, 1.):
+          return
+
+  def check_weight_matrices(self, mHH, cosThetaStar, denominator):
+    weights = self.get_weights_from_matrices(mHH, cosThetaStar, denominator)
+    weightsRef = self.get_weights_per_point(mHH, cosThetaStar, denominator)
+    absTolerance = 1e-9 * np.abs(weightsRef).max() if len(weightsRef) else 0.
+    if weights is not None and not np.allclose(weights, weightsRef, rtol = 1e-6, atol = absTolerance):
+      print(
+        "WARNING: HH weights computed from the model coefficients do not agree with the model at mHH = %.1f, "
+        "cos(theta*) = %.2f; computing them point by point" % (mHH, cosThetaStar)
+      )
+      self.useWeightMatrices = False
+      return False
+    return True
+
+  def get_bin_coefficients(self, mHH, cosThetaStar):
+    # returns the model coefficients of the (mHH, cos(theta*)) bin, or None if outside of the binning
+    mHH_bin = int(np.searchsorted(COEFFICIENT_EDGES_MHH, mHH, side = 'right')) - 1
+    # the last bin in |cos(theta*)| includes its upper edge
+    nofBinsCosThetaStar = len(COEFFICIENT_EDGES_COSTHETASTAR) - 1
+    cosThetaStar_bin = min(int(np.searchsorted(COEFFICIENT_EDGES_COSTHETASTAR, abs(cosThetaStar), side = 'right')), nofBinsCosThetaStar) - 1
+    if not (0 <= mHH_bin < len(COEFFICIENT_EDGES_MHH) - 1 and 0 <= cosThetaStar_bin < nofBinsCosThetaStar):
+      return None
+    return self.coefficientTable[mHH_bin, cosThetaStar_bin]
+
+  def build_weight_table(self, weightTableFile = None):
+    # The weights depend on the event only through the bin of the denominator histogram, provided that the model
+    # coefficients do not change within the bins, i.e. that every edge of the coefficient binning within the range of
+    # the histogram is also an edge of the histogram. The weights are thus tabulated for all bins of the histogram (the
+    # events outside of its range are computed one by one); the table can be stored in a file for later jobs.
+    for axisName, coefficientEdges, denominatorEdges in [
+          ('mHH',         COEFFICIENT_EDGES_MHH,          self.mHHEdges),
+          ('cos(theta*)', COEFFICIENT_EDGES_COSTHETASTAR, self.cosThetaStarEdges),
+        ]:
+      innerEdges = coefficientEdges[(coefficientEdges > denominatorEdges[0]) & (coefficientEdges < denominatorEdges[-1])]
+      missingEdges = [
+        edge for edge in innerEdges if not np.isclose(denominatorEdges, edge, rtol = 1e-9, atol = 1e-9).any()
+      ]
+      if missingEdges:
+        print(
+          "WARNING: the edges %s of the model coefficients in %s are not edges of the denominator histogram; "
+          "computing the HH weights event by event" % (', '.join('%g' % edge for edge in missingEdges), axisName)
+        )
+        return
+
+    nofWeights = self.nofWeightsBM + self.nofWeightsScan
+    nofBinsMHH = len(self.mHHEdges) - 1
+    nofBinsCosThetaStar = len(self.cosThetaStarEdges) - 1
+    if weightTableFile and os.path.isfile(weightTableFile):
+      weightTable = load_arrays(weightTableFile)['weights']
+      if weightTable.shape == (nofBinsMHH * nofBinsCosThetaStar, nofWeights):
+        self.weightTable = weightTable
+        print("Loaded the HH weights of %d bins from %s" % (len(self.weightTable), weightTableFile))
+        return
+      print("WARNING: the HH weights in %s do not match the binning; recomputing them" % weightTableFile)
+
+    # the binning of the coefficients is checked against the model only if the weights can be computed from them
+    if self.useWeightMatrices and self.monomials is None:
+      self.build_weight_matrices()
+    if not self.useWeightMatrices:
+      print("WARNING: the binning of the model coefficients could not be checked; computing the HH weights event by event")
+      return
+
+    weightTable = np.zeros((nofBinsMHH, nofBinsCosThetaStar, nofWeights))
+    for mHH_bin in range(nofBinsMHH):
+      mHH = self.mHHEdges[mHH_bin:mHH_bin + 2].mean()
+      for cosThetaStar_bin in range(nofBinsCosThetaStar):
+        cosThetaStar = self.cosThetaStarEdges[cosThetaStar_bin:cosThetaStar_bin + 2].mean()
+        denominator = self.denominators[mHH_bin + 1, cosThetaStar_bin + 1]
+        weightTable[mHH_bin, cosThetaStar_bin] = self.get_weights(mHH, cosThetaStar, denominator)
+    self.weightTable = weightTable.reshape(nofBinsMHH * nofBinsCosThetaStar, nofWeights)
+    print("Computed the HH weights of %d bins" % len(self.weightTable))
+
+    if weightTableFile:
+      save_arrays(weightTableFile, weights = self.weightTable)
+      print("Stored the HH weights in %s" % weightTableFile)
+
+  def get_weights(self, mHH, cosThetaStar, denominator):
+    # returns the weights of the benchmarks followed by the weights of the scan points
+    if self.useWeightMatrices and self.monomials is None:
+      self.build_weight_matrices()
+    weights = self.get_weights_from_matrices(mHH, cosThetaStar, denominator) if self.useWeightMatrices else None
+    if weights is None:
+      weights = self.get_weights_per_point(mHH, cosThetaStar, denominator)
+    return weights
+
+  def get_weights_from_matrices(self, mHH, cosThetaStar, denominator):
+    # returns None if the weights cannot be expressed by the coefficients of the bin
+    binCoefficients = self.get_bin_coefficients(mHH, cosThetaStar)
+    if binCoefficients is None:
+      return None
+    binTermSM = self.monomialSM.dot(binCoefficients)
+    if binTermSM == 0.:
+      return None
+    weightSM = self.model.getScaleFactor(
+      mhh = mHH, cost = cosThetaStar, kl = 1., kt = 1., c2 = 0., cg = 0., c2g = 0., effSumV0 = denominator, Cnorm = 1.,
+    )
+    return weightSM * self.inclusiveTermSM / binTermSM * self.monomials.dot(binCoefficients) / self.inclusiveTerms * \
+           self.normFactors
+
+  def get_weights_per_point(self, mHH, cosThetaStar, denominator):
+    return np.array([
+      self.model.getScaleFactor(
+        mhh = mHH, cost = cosThetaStar, kl = kl, kt = kt, c2 = c2, cg = cg, c2g = c2g, effSumV0 = denominator, Cnorm = norm,
+      ) for (kl, kt, c2, cg, c2g), norm in zip(self.couplings, self.get_norms())
+    ])
+
   def beginJob(self):
     pass
 
@@ -152,13 +446,24 @@ class diHiggsVarProducer(Module):
 
   def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
     self.out = wrappedOutputTree
+    if self.compute_weights:
+      self.init_weight_table()
     if self.use_gen:
       self.out.branch(self.mHH_genName, "F")
       self.out.branch(self.cosThetaStar_genName, "F")
     if self.use_lhe:
       self.out.branch(self.mHH_lheName, "F")
       self.out.branch(self.cosThetaStar_lheName, "F")
-    if self.compute_weights:
+    if self.compute_weights and self.outputLayout == 'index':
+      if self.weightTable is None:
+        print("WARNING: no HH weight table, the weights of all events are written to the out-of-range arrays")
+      if self.use_gen:
+        self.out.branch(self.weightIdx_genName, "I")
+        self.out.branch(self.weightOutOfRange_genName, "F", lenVar = self.nofWeightsOutOfRange_genName)
+      if self.use_lhe:
+        self.out.branch(self.weightIdx_lheName, "I")
+        self.out.branch(self.weightOutOfRange_lheName, "F", lenVar = self.nofWeightsOutOfRange_lheName)
+    elif self.compute_weights:
       self.out.branch(self.nofWeightsBMName, "I")
       self.out.branch(self.nofWeightsScanName, "I")
       if self.use_gen:
@@ -169,14 +474,43 @@ class diHiggsVarProducer(Module):
         self.out.branch(self.weightScan_lheName, "F", lenVar = self.nofWeightsScanName)
 
   def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    if self.compute_weights and self.outputLayout == 'index':
+      assert(outputFile)
+      outputFile.cd()
+      self.writeWeightTable()
     if self.denominatorFilePtr:
       self.denominatorFilePtr.Close()
 
+  def writeWeightTable(self):
+    # The squares of the weights are stored as the sums of squared weights of the histogram, and the number of files is
+    # stored in a separate histogram; if the output files are merged with hadd, both are summed, which allows to recover
+    # the table and to check that all merged files have the same table.
+    nofWeights = self.nofWeightsBM + self.nofWeightsScan
+    weights = self.weightTable if self.weightTable is not None else np.zeros((0, nofWeights))
+    index = {
+      'nofRows'             : len(weights),
+      'nofBinsMHH'          : len(self.mHHEdges) - 1,
+      'nofBinsCosThetaStar' : len(self.cosThetaStarEdges) - 1,
+      'nofWeightsBM'        : self.nofWeightsBM,
+      'nofWeightsScan'      : self.nofWeightsScan,
+    }
+    if weights.size:
+      create_histogram(
+        ROOT.TH1D, WEIGHT_TABLE_PREFIX, 'HH weights', -0.5, weights.size - 0.5,
+        weights.ravel(), weights.ravel()**2, len(weights),
+      ).Write()
+    create_histogram(ROOT.TH1D, '%s_nofFiles' % WEIGHT_TABLE_PREFIX, 'number of files', 0., 1., [ 1. ], [ 1. ], 1).Write()
+    ROOT.TObjString(json.dumps(index)).Write('%s_index' % WEIGHT_TABLE_PREFIX)
+
+  def get_bins(self, mHH, cosThetaStar):
+    # same as TAxis::FindBin, i.e. 0 for underflow and the number of bins + 1 for overflow
+    mHH_bin = int(np.searchsorted(self.mHHEdges, mHH, side = 'right'))
+    cosThetaStar_bin = int(np.searchsorted(self.cosThetaStarEdges, abs(cosThetaStar), side = 'right'))
+    return mHH_bin, cosThetaStar_bin
+
   def get_denominator(self, mHH, cosThetaStar):
-    assert(self.denominatorHistogram)
-    mHH_bin = self.denominatorHistogram.GetXaxis().FindBin(mHH)
-    cosThetaStar_bin = self.denominatorHistogram.GetYaxis().FindBin(abs(cosThetaStar))
-    return self.denominatorHistogram.GetBinContent(mHH_bin, cosThetaStar_bin)
+    assert(self.denominators is not None)
+    return self.denominators[self.get_bins(mHH, cosThetaStar)]
   
   def compute(self, higgses):
     higgs_lead_p4, higgs_sublead_p4 = get_p4_pair(higgses)
@@ -186,70 +520,52 @@ class diHiggsVarProducer(Module):
     # boost leading or subleading Higgs -- doesn't matter
     higgs_lead_p4.Boost(-higgs_pair_p4.BoostVector())
     cosThetaStar = abs(higgs_lead_p4.CosTheta())
-    denominator = self.get_denominator(mHH, cosThetaStar) if self.compute_weights else 1.
 
     weightsBM = [ 0. ] * self.nofWeightsBM
-    if self.compute_weights:
-      weightsBM = []
-      for bmIdx in range(self.nofWeightsBM):
-        weightBM = self.model.getScaleFactor(
-          mhh      = mHH,
-          cost     = cosThetaStar,
-          kl       = self.klJHEP[bmIdx],
-          kt       = self.ktJHEP[bmIdx],
-          c2       = self.c2JHEP[bmIdx],
-          cg       = self.cgJHEP[bmIdx],
-          c2g      = self.c2gJHEP[bmIdx],
-          effSumV0 = denominator,
-          Cnorm    = self.normJHEP[bmIdx],
-        )
-        weightsBM.append(weightBM)
-
     weightsScan = [ 0. ] * self.nofWeightsScan
+    weightIdx = -1
     if self.compute_weights:
-      weightsScan = []
-      for scanIdx in range(self.nofWeightsScan):
-        weightScan = self.model.getScaleFactor(
-          mhh      = mHH,
-          cost     = cosThetaStar,
-          kl       = self.klScan[scanIdx],
-          kt       = self.ktScan[scanIdx],
-          c2       = self.c2Scan[scanIdx],
-          cg       = self.cgScan[scanIdx],
-          c2g      = self.c2gScan[scanIdx],
-          effSumV0 = denominator,
-          Cnorm    = self.Norm_klScan[scanIdx],
-        )
-        weightsScan.append(weightScan)
+      mHH_bin, cosThetaStar_bin = self.get_bins(mHH, cosThetaStar)
+      nofBinsCosThetaStar = len(self.cosThetaStarEdges) - 1
+      if self.weightTable is not None and 0 < mHH_bin < len(self.mHHEdges) and 0 < cosThetaStar_bin <= nofBinsCosThetaStar:
+        weightIdx = (mHH_bin - 1) * nofBinsCosThetaStar + cosThetaStar_bin - 1
+        weights = self.weightTable[weightIdx]
+      else:
+        weights = self.get_weights(mHH, cosThetaStar, self.denominators[mHH_bin, cosThetaStar_bin])
+      weightsBM   = weights[:self.nofWeightsBM]
+      weightsScan = weights[self.nofWeightsBM:]
+
+    return mHH, cosThetaStar, weightsBM, weightsScan, weightIdx
 
-    return mHH, cosThetaStar, weightsBM, weightsScan
+  def get_weights_out_of_range(self, weightIdx, weightsBM, weightsScan):
+    # the weights are written only for the events that are outside of the weight table and have non-zero weights
+    if weightIdx >= 0 or not (np.any(weightsBM) or np.any(weightsScan)):
+      return []
+    return list(weightsBM) + list(weightsScan)
 
   def analyze(self, event):
 
     weightsBM_gen   = [ 0. ] * self.nofWeightsBM
     weightsScan_gen = [ 0. ] * self.nofWeightsScan
+    weightIdx_gen = -1
     mHH_gen, cosThetaStar_gen = -1., -2.
     if self.use_gen:
-      genParticles = Collection(event, "GenPart")
+      genParticles = getGenParticles(event, self.massTable)
       higgses_gen = sorted(
-        filter(
-          lambda genPart:
-            genPart.pdgId == 25 and \
-            (genParticles[genPart.genPartIdxMother].pdgId != 25 if genPart.genPartIdxMother >= 0 else True),
-          genParticles
-        ),
+        genParticles.select(genParticles.higgsIdxs),
         key = lambda genHiggs: genHiggs.pt,
         reverse = True
       )
       nofHiggs_gen = len(higgses_gen)
 
       if nofHiggs_gen == 2:
-        mHH_gen, cosThetaStar_gen, weightsBM_gen, weightsScan_gen = self.compute(higgses_gen)
+        mHH_gen, cosThetaStar_gen, weightsBM_gen, weightsScan_gen, weightIdx_gen = self.compute(higgses_gen)
       else:
         print("Found an event that has not exactly two Higgs bosons at the generator level")
 
     weightsBM_lhe   = [ 0. ] * self.nofWeightsBM
     weightsScan_lhe = [ 0. ] * self.nofWeightsScan
+    weightIdx_lhe = -1
     mHH_lhe, cosThetaStar_lhe = -1., -2.
     if self.use_lhe:
       lheParticles = Collection(event, "LHEPart")
@@ -261,7 +577,7 @@ class diHiggsVarProducer(Module):
       nofHiggs_lhe = len(higgses_lhe)
 
       if nofHiggs_lhe == 2:
-        mHH_lhe, cosThetaStar_lhe, weightsBM_lhe, weightsScan_lhe = self.compute(higgses_lhe)
+        mHH_lhe, cosThetaStar_lhe, weightsBM_lhe, weightsScan_lhe, weightIdx_lhe = self.compute(higgses_lhe)
 
         if self.use_gen:
           assert(len(weightsBM_gen) == len(weightsBM_lhe))
@@ -275,7 +591,18 @@ class diHiggsVarProducer(Module):
     if self.use_lhe:
       self.out.fillBranch(self.mHH_lheName, mHH_lhe)
       self.out.fillBranch(self.cosThetaStar_lheName, cosThetaStar_lhe)
-    if self.compute_weights:
+    if self.compute_weights and self.outputLayout == 'index':
+      if self.use_gen:
+        self.out.fillBranch(self.weightIdx_genName, weightIdx_gen)
+        self.out.fillBranch(self.weightOutOfRange_genName, self.get_weights_out_of_range(
+          weightIdx_gen, weightsBM_gen, weightsScan_gen
+        ))
+      if self.use_lhe:
+        self.out.fillBranch(self.weightIdx_lheName, weightIdx_lhe)
+        self.out.fillBranch(self.weightOutOfRange_lheName, self.get_weights_out_of_range(
+          weightIdx_lhe, weightsBM_lhe, weightsScan_lhe
+        ))
+    elif self.compute_weights:
       self.out.fillBranch(self.nofWeightsBMName, len(weightsBM_gen))
       self.out.fillBranch(self.nofWeightsScanName, len(weightsScan_gen))
       if self.use_gen:
@@ -287,6 +614,41 @@ class diHiggsVarProducer(Module):
 
     return True
 
+class HHWeightReader(object):
+  # Expands the HH weights that are written in the 'index' output layout of diHiggsVarProducer, also from the output
+  # files that are merged with hadd.
+  # Usage: reader = HHWeightReader(inputFile)
+  #        weightsScan = reader.getWeightsScan(event.HHWeight_binIdx_lhe, event.HHWeight_outOfRange_lhe)
+
+  def __init__(self, directory):
+    index = json.loads(directory.Get('%s_index' % WEIGHT_TABLE_PREFIX).GetString().Data())
+    self.nofWeightsBM = index['nofWeightsBM']
+    self.nofWeightsScan = index['nofWeightsScan']
+    nofWeights = self.nofWeightsBM + self.nofWeightsScan
+    nofFiles = int(round(read_histogram(directory.Get('%s_nofFiles' % WEIGHT_TABLE_PREFIX))[0][0]))
+    # the last row holds the zero weights of the events with index -1
+    self.weights = np.zeros((index['nofRows'] + 1, nofWeights))
+    if index['nofRows'] > 0:
+      sumw, sumw2 = read_histogram(directory.Get(WEIGHT_TABLE_PREFIX))
+      weights = sumw / nofFiles
+      # the sum of squares equals the number of files times the square of the mean only if all tables are the same
+      if not np.allclose(sumw2, nofFiles * weights**2, rtol = 1e-6, atol = 0.):
+        raise ValueError("The HH weight tables of the %d merged files are not the same" % nofFiles)
+      self.weights[:-1] = weights.reshape(index['nofRows'], nofWeights)
+
+  def getWeights(self, weightIdxs, weightsOutOfRange = None):
+    # accepts a single index or an array of indices; the weights of a single event outside of the weight table are
+    # taken from its out-of-range array, if given
+    if weightsOutOfRange is not None and len(weightsOutOfRange) > 0:
+      return np.array([ weight for weight in weightsOutOfRange ])
+    return self.weights[weightIdxs]
+
+  def getWeightsBM(self, weightIdxs, weightsOutOfRange = None):
+    return self.getWeights(weightIdxs, weightsOutOfRange)[..., :self.nofWeightsBM]
+
+  def getWeightsScan(self, weightIdxs, weightsOutOfRange = None):
+    return self.getWeights(weightIdxs, weightsOutOfRange)[..., self.nofWeightsBM:]
+
 # provide this variable as the 2nd argument to the import option for the nano_postproc.py script
 diHiggsVar_2016 = lambda : diHiggsVarProducer(era = "2016")
 diHiggsVar_2017 = lambda : diHiggsVarProducer(era = "2017")
@@ -0,0 +1,52 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import MassTable, getGenParticles
+
+# Stores the daughters of every generator-level particle, so that the decay tree can be traversed downstream without
+# rescanning GenPart_genPartIdxMother:
+# - the daughters of the particle i are GenPartDaughter_idx[GenPart_daughterOffset[i] : GenPart_daughterOffset[i] + GenPart_nDaughters[i]],
+#   in the order of their indices;
+# - GenPart_lastCopyIdx[i] is the index of the last copy of the particle i, i.e. the end of the chain of the daughters
+#   that have the same |pdgId| as their mother (equal to i if the particle is the last copy).
+
+class genDecayGraphProducer(Module):
+
+  def __init__(self, genPartBr = 'GenPart'):
+    self.massTable = MassTable()
+    self.genPartBr = genPartBr
+    self.daughterBr = '{}Daughter'.format(self.genPartBr)
+
+    self.daughterOffsetBr = '{}_daughterOffset'.format(self.genPartBr)
+    self.nofDaughtersBr   = '{}_nDaughters'.format(self.genPartBr)
+    self.lastCopyIdxBr    = '{}_lastCopyIdx'.format(self.genPartBr)
+    self.daughterIdxBr    = '{}_idx'.format(self.daughterBr)
+
+  def beginJob(self):
+    pass
+
+  def endJob(self):
+    pass
+
+  def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    self.out = wrappedOutputTree
+    for branchName in [ self.daughterOffsetBr, self.nofDaughtersBr, self.lastCopyIdxBr ]:
+      self.out.branch(branchName, 'I', lenVar = 'n{}'.format(self.genPartBr))
+    self.out.branch(self.daughterIdxBr, 'I', lenVar = 'n{}'.format(self.daughterBr))
+
+  def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    pass
+
+  def analyze(self, event):
+    decayGraph = getGenParticles(event, self.massTable, prefix = self.genPartBr).decayGraph
+    daughterOffsets = decayGraph.daughterOffsets
+
+    self.out.fillBranch(self.daughterOffsetBr, daughterOffsets[:-1])
+    self.out.fillBranch(self.nofDaughtersBr,   daughterOffsets[1:] - daughterOffsets[:-1])
+    self.out.fillBranch(self.lastCopyIdxBr,    decayGraph.getLastCopyIdxs())
+    self.out.fillBranch(self.daughterIdxBr,    decayGraph.daughterIdxs)
+
+    return True
+
+genDecayGraph = lambda : genDecayGraphProducer()
@@ -1,8 +1,8 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import MassTable, getGenParticles
 
 # Possible values of the decay modes in case the event has one Higgs boson:
 #      3 H -> s sbar
@@ -27,11 +27,38 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 # Possible values of the decay modes in case the event has two Higgs bosons and HH -> bbVV and V = W or Z:
 # 5000023 H -> b bbar Z Z
 # 5000024 H -> b bbar W+ W-
+#
+# The value is -1 if the decay products of a Higgs boson cannot be determined from the generator record.
+
+def getHiggsDaughterIdxs(decayGraph, higgsIdx, pdgIds):
+  # Follows the chain of Higgs copies until the decay products of the Higgs are found. The daughters of every copy
+  # are visited in the order of their indices, and the daughters other than the Higgs are collected until the next
+  # copy is reached; the chain ends when exactly two decay products have been collected. Returns None if the record
+  # does not lead to two decay products.
+  higgsDaughterIdxs = []
+  for _ in range(len(pdgIds)):
+    nextHiggsIdx = -1
+    daughterIdxs = decayGraph.getDaughterIdxs(higgsIdx)
+    for daughterIdx in daughterIdxs:
+      if pdgIds[daughterIdx] == 25:
+        nextHiggsIdx = daughterIdx
+        break
+      higgsDaughterIdxs.append(daughterIdx)
+    if len(higgsDaughterIdxs) == 2:
+      return higgsDaughterIdxs
+    if nextHiggsIdx < 0:
+      # a single decay product is counted twice
+      if len(higgsDaughterIdxs) == 1 and len(daughterIdxs) == 1:
+        return higgsDaughterIdxs * 2
+      return None
+    higgsIdx = nextHiggsIdx
+  return None
 
 class genHiggsDecayModeProducer(Module):
 
   def __init__(self):
     self.genHiggsDecayModeName = "genHiggsDecayMode"
+    self.massTable = MassTable()
 
   def beginJob(self):
     pass
@@ -47,32 +74,19 @@ class genHiggsDecayModeProducer(Module):
     pass
 
   def analyze(self, event):
-    genParticles = Collection(event, "GenPart")
-
-    higgses = sorted(set(map(lambda genPartPair: genPartPair[0], filter(
-      lambda genPart:
-        genPart[1].pdgId == 25 and \
-        (genParticles[genPart[1].genPartIdxMother].pdgId != 25 if genPart[1].genPartIdxMother >= 0 else True),
-      enumerate(genParticles)
-    ))))
+    genParticles = getGenParticles(event, self.massTable)
+    pdgIds = genParticles.pdgId
+    higgses = genParticles.higgsIdxs
     nofHiggs = len(higgses)
 
     decayModeVals = []
     if 0 < nofHiggs < 3:
-      for idxHiggs in range(nofHiggs):
-        higgs_daus = [  ]
-        higgs_idx = higgses[idxHiggs]
-        while True:
-          for idx, genPart in enumerate(genParticles):
-            if genPart.genPartIdxMother == higgs_idx:
-              if genPart.pdgId == 25:
-                higgs_idx = idx
-                break
-              else:
-                higgs_daus.append(idx)
-          if len(higgs_daus) == 2:
-            break
-        higgs_daus_pdgId = list(sorted(set(map(lambda idx: abs(genParticles[idx].pdgId), higgs_daus)), reverse = True))
+      for higgs_idx in higgses:
+        higgs_daus = getHiggsDaughterIdxs(genParticles.decayGraph, higgs_idx, pdgIds)
+        if higgs_daus is None:
+          self.out.fillBranch(self.genHiggsDecayModeName, -1)
+          return True
+        higgs_daus_pdgId = list(sorted(set(map(lambda idx: abs(int(pdgIds[idx])), higgs_daus)), reverse = True))
         decayModeVal = sum(map(lambda pdgId: pdgId[1] * 10**(4 * pdgId[0]), enumerate(higgs_daus_pdgId)))
         decayModeVals.append(decayModeVal)
 
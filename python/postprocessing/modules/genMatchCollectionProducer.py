@@ -4,16 +4,11 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
-from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import MassTable, GenPartAux
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import MassTable, getGenParticles
 
 import collections
 import logging
 
-class GenPartAuxAug(GenPartAux):
-  def __init__(self, genPart, idx, massTable):
-    super(self.__class__, self).__init__(genPart, idx, massTable)
-    self.genPartFlav = 0
-
 class GenJetAux:
   def __init__(self, genJet, idx):
     self.pt               = genJet.pt
@@ -83,10 +78,7 @@ class genMatchCollectionProducer(Module):
   def analyze(self, event):
 
     # read the collections
-    genParts = {
-      idx : GenPartAuxAug(part, idx, self.massTable)
-      for idx, part in enumerate(Collection(event, self.genPartBr))
-    }
+    genParts = getGenParticles(event, self.massTable, prefix = self.genPartBr)
 
     recoGenMatches = { recoObjBr : [] for recoObjBr in [ self.muBr, self.elBr, self.taBr, self.jtBr ] }
     genMatchIdxs   = { recoObjBr : [] for recoObjBr in [ self.muBr, self.elBr, self.taBr, self.jtBr ] }
@@ -96,7 +88,7 @@ class genMatchCollectionProducer(Module):
       nof_genMatches = 0
 
       for recoObj in recoCollection:
-        if recoObj.genPartIdx in genParts:
+        if 0 <= recoObj.genPartIdx < len(genParts):
           recoGenMatches[recoObjBr].append((recoObj.genPartIdx, recoObj.genPartFlav))
           genMatchIdxs[recoObjBr].append(nof_genMatches)
           nof_genMatches += 1
@@ -1,13 +1,13 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
+import numpy as np
 import math
 import logging
 import sys
-import itertools
+import collections
 
 
 sign = lambda x: int(math.copysign(1, x) if x != 0 else 0)
@@ -66,39 +66,76 @@ statusFlagsMap = {
 
 
 class MassTable:
-  def __init__(self):
-    self.pdgTable = ROOT.TDatabasePDG()
+  # The masses and charges are looked up in the PDG table of ROOT only once per pdgId and process, and are shared by
+  # all instances of this class; the pdgIds that are not defined in the table are remembered as well (as None)
+  pdgTable   = None
+  pdgMasses  = {}
+  pdgCharges = {}
+
+  def lookup(self, pdgId):
+    pdgId = int(pdgId)
+    if pdgId not in MassTable.pdgMasses:
+      if MassTable.pdgTable is None:
+        MassTable.pdgTable = ROOT.TDatabasePDG()
+      genParticleInstance = MassTable.pdgTable.GetParticle(pdgId)
+      if genParticleInstance:
+        MassTable.pdgMasses[pdgId]  = genParticleInstance.Mass()
+        MassTable.pdgCharges[pdgId] = sign(genParticleInstance.Charge())
+      else:
+        # Since most of the common low-mass particles are defined in ROOT's PDG table,
+        # and that it's more than likely we don't need such generator-level information,
+        # we can safely set the masses of such particles to 0 GeV.
+        # It's also more than likely that we don't need to know the charges of generator-level particles
+        # that are not defined in ROOT's PDG id table. Therefore, we assign neutral charges to
+        # these particles.
+        logging.debug("Setting the mass to 0 GeV and the charge to neutral for a particle with PDG id of %d" % pdgId)
+        MassTable.pdgMasses[pdgId]  = None
+        MassTable.pdgCharges[pdgId] = None
+    return MassTable.pdgMasses[pdgId], MassTable.pdgCharges[pdgId]
 
   def getMass(self, mass, pdgId):
     if mass > 10. or (pdgId == 22 and mass > 1.) or abs(pdgId) == 24 or pdgId == 23:
       return mass
     else:
-      genParticleInstance = self.pdgTable.GetParticle(pdgId)
-      if not genParticleInstance:
-        # Since most of the common low-mass particles are defined in ROOT's PDG table,
-        # and that it's more than likely we don't need such generator-level information,
-        # we can safely set the masses of such particles to 0 GeV
-        logging.debug("Setting the mass to 0 GeV for a particle with PDG id of %d" % pdgId)
-        return 0.
-      return genParticleInstance.Mass()
+      pdgMass = self.lookup(pdgId)[0]
+      return pdgMass if pdgMass is not None else 0.
 
   def getCharge(self, pdgId):
-    genParticleInstance = self.pdgTable.GetParticle(pdgId)
-    if not genParticleInstance:
-      # It's more than likely that we don't need to know the charges of generator-level particles
-      # that are not defined in ROOT's PDG id table. Therefore, we assign neutral charges to
-      # these particles.
-      logging.debug("Setting the charge to neutral for a particle with PDG id of %d" % pdgId)
-      return 0
-    return sign(genParticleInstance.Charge())
+    pdgCharge = self.lookup(pdgId)[1]
+    return pdgCharge if pdgCharge is not None else 0
+
+  def lookupArray(self, pdgIds, column, dtype):
+    # each distinct pdgId of the array is looked up only once
+    pdgIds = np.asarray(pdgIds, dtype = np.int64)
+    uniquePdgIds, inverseIdxs = np.unique(pdgIds, return_inverse = True)
+    values = np.array([ self.lookup(pdgId)[column] for pdgId in uniquePdgIds ], dtype = object)
+    values[np.equal(values, None)] = 0
+    return values.astype(dtype)[inverseIdxs].reshape(pdgIds.shape)
+
+  def masses(self, pdgIds):
+    # masses in the PDG table (0 GeV if the pdgId is not defined there)
+    return self.lookupArray(pdgIds, 0, np.float64)
+
+  def charges(self, pdgIds):
+    # signs of the charges in the PDG table (neutral if the pdgId is not defined there)
+    return self.lookupArray(pdgIds, 1, np.int64)
+
+  def getMasses(self, masses, pdgIds):
+    # vectorized version of getMass()
+    masses = np.asarray(masses, dtype = np.float64)
+    pdgIds = np.asarray(pdgIds, dtype = np.int64)
+    isKept = (masses > 10.) | ((pdgIds == 22) & (masses > 1.)) | (np.abs(pdgIds) == 24) | (pdgIds == 23)
+    return np.where(isKept, masses, self.masses(pdgIds))
 
 
 class GenPart(object):
-  def __init__(self, p4, pdgId, charge, status, statusFlags):
-    self.pt               = p4.Pt()
-    self.eta              = p4.Eta()
-    self.phi              = p4.Phi()
-    self.mass             = p4.M()
+  __slots__ = [ 'pt', 'eta', 'phi', 'mass', 'pdgId', 'charge', 'status', 'statusFlags' ]
+
+  def __init__(self, pt, eta, phi, mass, pdgId, charge, status, statusFlags):
+    self.pt               = pt
+    self.eta              = eta
+    self.phi              = phi
+    self.mass             = mass
     self.pdgId            = pdgId
     self.charge           = charge
     self.status           = status
@@ -112,6 +149,8 @@ class GenPart(object):
     return self.__str__()
 
 class GenPartAux(object):
+  __slots__ = [ 'pt', 'eta', 'phi', 'mass', 'pdgId', 'charge', 'status', 'statusFlags', 'genPartIdxMother', 'idx' ]
+
   def __init__(self, genPart, idx, massTable):
     self.pt               = genPart.pt
     self.eta              = genPart.eta
@@ -133,11 +172,265 @@ class GenPartAux(object):
   def __repr__(self):
     return self.__str__()
 
+  @classmethod
+  def fromArrays(cls, genParticles, idx, massTable):
+    genPart = cls.__new__(cls)
+    genPart.pt               = float(genParticles.pt[idx])
+    genPart.eta              = float(genParticles.eta[idx])
+    genPart.phi              = float(genParticles.phi[idx])
+    genPart.pdgId            = int(genParticles.pdgId[idx])
+    genPart.mass             = massTable.getMass(float(genParticles.mass[idx]), genPart.pdgId)
+    genPart.charge           = massTable.getCharge(genPart.pdgId)
+    genPart.status           = int(genParticles.status[idx])
+    genPart.statusFlags      = int(genParticles.statusFlags[idx])
+    genPart.genPartIdxMother = int(genParticles.genPartIdxMother[idx])
+    genPart.idx              = int(idx)
+    return genPart
+
   def checkIf(self, condition):
     assert(condition in statusFlagsMap)
     return (self.statusFlags & (1 << statusFlagsMap[condition]) != 0)
 
 
+class GenPartCut(object):
+  # Declarative selection of generator-level particles, given by the allowed pdgIds, |pdgId|s and status values,
+  # and by the names of the status flags (see statusFlagsMap) that must all be set (flags), must all be unset
+  # (vetoFlags) or of which at least one must be set (anyFlags). The cuts can be combined with &, | and ~, and are
+  # evaluated as a single boolean mask over all particles of an event; calling a cut returns the selected particles.
+
+  def __init__(self, pdgIds = None, absPdgIds = None, status = None, flags = None, vetoFlags = None, anyFlags = None):
+    self.pdgIds    = list(pdgIds)    if pdgIds    is not None else None
+    self.absPdgIds = list(absPdgIds) if absPdgIds is not None else None
+    self.status    = list(status)    if status    is not None else None
+    self.flagsMask     = self.getFlagsMask(flags)
+    self.vetoFlagsMask = self.getFlagsMask(vetoFlags)
+    self.anyFlagsMask  = self.getFlagsMask(anyFlags)
+
+  def getFlagsMask(self, flags):
+    flagsMask = 0
+    for flag in (flags or []):
+      if flag not in statusFlagsMap:
+        raise ValueError("Invalid status flag: %s" % flag)
+      flagsMask |= 1 << statusFlagsMap[flag]
+    return flagsMask
+
+  def mask(self, genParticles):
+    mask = np.ones(len(genParticles), dtype = bool)
+    if self.pdgIds is not None:
+      mask &= np.isin(genParticles.pdgId, self.pdgIds)
+    if self.absPdgIds is not None:
+      mask &= np.isin(np.abs(genParticles.pdgId), self.absPdgIds)
+    if self.status is not None:
+      mask &= np.isin(genParticles.status, self.status)
+    if self.flagsMask:
+      mask &= (genParticles.statusFlags & self.flagsMask) == self.flagsMask
+    if self.vetoFlagsMask:
+      mask &= (genParticles.statusFlags & self.vetoFlagsMask) == 0
+    if self.anyFlagsMask:
+      mask &= (genParticles.statusFlags & self.anyFlagsMask) != 0
+    return mask
+
+  def __call__(self, genParticles):
+    return genParticles.select(self.mask(genParticles))
+
+  def __and__(self, other):
+    return GenPartCutExpression(np.logical_and, self, other)
+
+  def __or__(self, other):
+    return GenPartCutExpression(np.logical_or, self, other)
+
+  def __invert__(self):
+    return GenPartCutExpression(np.logical_not, self)
+
+
+class GenPartCutExpression(GenPartCut):
+
+  def __init__(self, operation, *operands):
+    self.operation = operation
+    self.operands  = operands
+
+  def mask(self, genParticles):
+    return self.operation(*[ operand.mask(genParticles) for operand in self.operands ])
+
+
+class DecayGraph(object):
+  # Index of the decay tree of an event that is built once and shared by all selections:
+  # - daughters of every particle in CSR form (offsets + flat array of indices, in the order of the indices);
+  # - indices of the particles bucketed by their pdgId;
+  # - links to the next copy of a particle, i.e. the last daughter that has the same |pdgId| as its mother,
+  #   so that the first or the last copy in a chain can be found without scanning the whole event
+
+  def __init__(self, pdgIds, motherIdxs):
+    self.pdgIds = np.asarray(pdgIds, dtype = np.int64)
+    self.motherIdxs = np.asarray(motherIdxs, dtype = np.int64)
+    nofParticles = len(self.pdgIds)
+
+    hasMother = (self.motherIdxs >= 0) & (self.motherIdxs < nofParticles)
+    daughterIdxs = np.flatnonzero(hasMother)
+    daughterMotherIdxs = self.motherIdxs[daughterIdxs]
+    # stable sort keeps the daughters of each particle in the order of their indices
+    self.daughterIdxs = daughterIdxs[np.argsort(daughterMotherIdxs, kind = 'mergesort')]
+    self.daughterOffsets = np.zeros(nofParticles + 1, dtype = np.int64)
+    np.cumsum(np.bincount(daughterMotherIdxs, minlength = nofParticles), out = self.daughterOffsets[1:])
+
+    isCopy = np.abs(self.pdgIds[daughterIdxs]) == np.abs(self.pdgIds[daughterMotherIdxs])
+    self.nextCopyIdxs = np.full(nofParticles, -1, dtype = np.int64)
+    np.maximum.at(self.nextCopyIdxs, daughterMotherIdxs[isCopy], daughterIdxs[isCopy])
+
+    pdgIdOrder = np.argsort(self.pdgIds, kind = 'mergesort')
+    bucketPdgIds, bucketStarts = np.unique(self.pdgIds[pdgIdOrder], return_index = True)
+    bucketEnds = np.append(bucketStarts[1:], nofParticles)
+    self.pdgIdBuckets = {
+      int(pdgId) : pdgIdOrder[bucketStart:bucketEnd]
+      for pdgId, bucketStart, bucketEnd in zip(bucketPdgIds, bucketStarts, bucketEnds)
+    }
+
+  def getDaughterIdxs(self, idx):
+    if idx < 0:
+      return self.daughterIdxs[:0]
+    return self.daughterIdxs[self.daughterOffsets[idx]:self.daughterOffsets[idx + 1]]
+
+  def getNofDaughters(self, idx):
+    if idx < 0:
+      return 0
+    return int(self.daughterOffsets[idx + 1] - self.daughterOffsets[idx])
+
+  def getAllDaughterIdxs(self, idxs):
+    # daughters of all given particles, in increasing order
+    if not len(idxs):
+      return self.daughterIdxs[:0]
+    return np.sort(np.concatenate([ self.getDaughterIdxs(idx) for idx in idxs ]))
+
+  def getIdxs(self, pdgIds):
+    # indices of all particles with the given pdgIds, in increasing order
+    buckets = [ self.pdgIdBuckets[pdgId] for pdgId in pdgIds if pdgId in self.pdgIdBuckets ]
+    if not buckets:
+      return self.daughterIdxs[:0]
+    return np.sort(np.concatenate(buckets))
+
+  def getAbsIdxs(self, absPdgIds):
+    return self.getIdxs([ sign * absPdgId for absPdgId in absPdgIds for sign in [ +1, -1 ] ])
+
+  def isLastCopy(self, idx):
+    return self.nextCopyIdxs[idx] < 0
+
+  def getLastCopyIdx(self, idx):
+    # the chain is followed at most through every particle of the event in case the record has a cycle
+    for _ in range(len(self.pdgIds)):
+      if self.nextCopyIdxs[idx] < 0:
+        break
+      idx = self.nextCopyIdxs[idx]
+    return idx
+
+  def getLastCopyIdxs(self):
+    # last copy of every particle, found by following the links to the next copies with pointer jumping
+    lastCopyIdxs = np.where(self.nextCopyIdxs < 0, np.arange(len(self.pdgIds)), self.nextCopyIdxs)
+    for _ in range(len(self.pdgIds)):
+      nextLastCopyIdxs = lastCopyIdxs[lastCopyIdxs]
+      if np.array_equal(nextLastCopyIdxs, lastCopyIdxs):
+        break
+      lastCopyIdxs = nextLastCopyIdxs
+    return lastCopyIdxs
+
+  def getFirstCopyIdx(self, idx):
+    for _ in range(len(self.pdgIds)):
+      motherIdx = self.motherIdxs[idx]
+      if motherIdx < 0 or abs(self.pdgIds[motherIdx]) != abs(self.pdgIds[idx]):
+        break
+      idx = motherIdx
+    return idx
+
+
+class GenParticles(object):
+  # Struct-of-arrays view of the generator-level particles in an event. The GenPart branches are read into NumPy
+  # arrays on their first use, while the GenPartAux objects are created only for the particles that are accessed by
+  # index, i.e. mostly the ones that are written out. The decay graph and the decay analysis are built on demand.
+
+  branchTypes = collections.OrderedDict([
+    ('pt',               np.float64),
+    ('eta',              np.float64),
+    ('phi',              np.float64),
+    ('mass',             np.float64),
+    ('pdgId',            np.int64),
+    ('status',           np.int64),
+    ('statusFlags',      np.int64),
+    ('genPartIdxMother', np.int64),
+  ])
+
+  def __init__(self, event, massTable, prefix = "GenPart"):
+    self.event          = event
+    self.massTable      = massTable
+    self.prefix         = prefix
+    self.nofParticles   = int(getattr(event, "n%s" % prefix))
+    self.arrays         = {}
+    self.particles      = {}
+    self.decayGraph_    = None
+    self.decayAnalysis_ = None
+    self.higgsIdxs_     = None
+
+  def __getattr__(self, name):
+    if name not in GenParticles.branchTypes:
+      raise AttributeError("No such attribute: %s" % name)
+    if name not in self.arrays:
+      self.arrays[name] = np.fromiter(
+        getattr(self.event, "%s_%s" % (self.prefix, name)), dtype = GenParticles.branchTypes[name], count = self.nofParticles
+      )
+    return self.arrays[name]
+
+  def __len__(self):
+    return self.nofParticles
+
+  def __getitem__(self, idx):
+    if not (0 <= idx < self.nofParticles):
+      raise IndexError("Index out of range: %d" % idx)
+    if idx not in self.particles:
+      self.particles[idx] = GenPartAux.fromArrays(self, idx, self.massTable)
+    return self.particles[idx]
+
+  def __iter__(self):
+    for idx in range(self.nofParticles):
+      yield self[idx]
+
+  def select(self, selection):
+    # returns the particles at the given indices or where the given mask is set
+    selection = np.asarray(selection)
+    idxs = np.flatnonzero(selection) if selection.dtype == bool else selection
+    return [ self[idx] for idx in idxs ]
+
+  @property
+  def decayGraph(self):
+    if self.decayGraph_ is None:
+      self.decayGraph_ = DecayGraph(self.pdgId, self.genPartIdxMother)
+    return self.decayGraph_
+
+  @property
+  def decayAnalysis(self):
+    if self.decayAnalysis_ is None:
+      self.decayAnalysis_ = DecayAnalysis(self)
+    return self.decayAnalysis_
+
+  @property
+  def higgsIdxs(self):
+    # Higgs bosons that do not come from another Higgs, i.e. the first copies in their chains
+    if self.higgsIdxs_ is None:
+      genHiggsIdxs = self.decayGraph.getIdxs([ 25 ])
+      self.higgsIdxs_ = genHiggsIdxs[getMotherPdgIds(self, genHiggsIdxs) != 25]
+    return self.higgsIdxs_
+
+def getGenParticles(event, massTable, prefix = "GenPart"):
+  # Returns the generator-level particles of the event, which are decoded only once per event and shared by all
+  # modules. The cache is kept in the event object itself, which the event loop creates anew for every entry, and is
+  # keyed by the entry number in case the event object is reused.
+  entry = vars(event).get('_entry')
+  cache = vars(event).get('_genParticlesCache')
+  if cache is None or cache[0] != entry:
+    cache = (entry, {})
+    event._genParticlesCache = cache
+  if prefix not in cache[1]:
+    cache[1][prefix] = GenParticles(event, massTable, prefix = prefix)
+  return cache[1][prefix]
+
+
 class SelectionOptions:
   SAVE_TAU                      = 0
   SAVE_LEPTONIC_TAU             = 1
@@ -162,314 +455,322 @@ class SelectionOptions:
 
 #NOTE status == 1 seems to exclude FSR leptons, see
 # https://github.com/cms-sw/cmssw/issues/26163
-def genLeptonSelection(genParticles):
-  return filter(lambda genPart: abs(genPart.pdgId) in [11, 13] and genPart.status == 1, genParticles)
-
-def genPromptLeptonSelection(genParticles):
-  return filter(
-    lambda genLepton:
-      genLepton.checkIf('isLastCopy') and
-      not genLepton.checkIf('isDirectHadronDecayProduct') and
-      (
-        genLepton.checkIf('isPrompt') or
-        genLepton.checkIf('isDirectPromptTauDecayProduct')
-      ),
-    genLeptonSelection(genParticles)
-  )
-
-def getP4(genParticle):
-  p4 = ROOT.TLorentzVector()
-  p4.SetPtEtaPhiM(genParticle.pt, genParticle.eta, genParticle.phi, genParticle.mass)
-  return p4
+genLeptonSelection = GenPartCut(absPdgIds = [ 11, 13 ], status = [ 1 ])
+
+genPromptLeptonSelection = genLeptonSelection & GenPartCut(
+  flags     = [ 'isLastCopy' ],
+  vetoFlags = [ 'isDirectHadronDecayProduct' ],
+  anyFlags  = [ 'isPrompt', 'isDirectPromptTauDecayProduct' ],
+)
+
+def getP4Sum(pt, eta, phi, mass):
+  # returns the pt, eta, phi and mass of the sum of the four-momenta given by the arrays
+  px = np.sum(pt * np.cos(phi))
+  py = np.sum(pt * np.sin(phi))
+  pz = np.sum(pt * np.sinh(eta))
+  energy = np.sum(np.sqrt((pt * np.cosh(eta))**2 + mass**2))
+  ptSum = math.hypot(px, py)
+  if ptSum > 0.:
+    etaSum = math.asinh(pz / ptSum)
+  else:
+    etaSum = math.copysign(1e10, pz)
+  massSquared = energy**2 - px**2 - py**2 - pz**2
+  massSum = math.copysign(math.sqrt(abs(massSquared)), massSquared)
+  return ptSum, etaSum, math.atan2(py, px), massSum
 
 def genPhotonCandidateSelection(genParticles):
+  decayGraph = genParticles.decayGraph
+  pdgIds = genParticles.pdgId
+  motherIdxs = genParticles.genPartIdxMother
   # find all status = 1 prompt leptons
   leptonPdgIds = [ 11, 13, 15 ]
-  genPromptFinalStateParticles = { sign * pdgId : [] for pdgId in leptonPdgIds for sign in [ +1, -1 ] }
-  for genPart in genParticles:
-    if genPart.checkIf('isPrompt') and genPart.status == 1 and abs(genPart.pdgId) in leptonPdgIds:
-      genPromptFinalStateParticles[genPart.pdgId].append(genPart.idx)
-
-  # form the SFOS pairs
-  sfosPairCandidates = []
-  for leptonFlavor in leptonPdgIds:
-    sfosPairCandidates.extend(list(itertools.product(
-      genPromptFinalStateParticles[leptonFlavor],
-      genPromptFinalStateParticles[-leptonFlavor]
-    )))
-
-  # for every lepton in each pair, find the parent that doesn't decay to a single particle
-  sfosPairs = []
-  for sfosPairCandidate in sfosPairCandidates:
-    sfosPair = []
-    for leptonIdx in sfosPairCandidate:
-      currentIdx = -1
-      leptonIdxs = [ leptonIdx ]
-      while leptonIdxs:
-        currentIdx = leptonIdxs.pop()
-        momIdx = genParticles[currentIdx].genPartIdxMother
-        assert(momIdx != currentIdx)
-        nof_momIdx_daugthers = len([ genPart for genPart in genParticles if genPart.genPartIdxMother == momIdx ])
-        if momIdx >= 0 and genParticles[momIdx].pdgId == genParticles[currentIdx].pdgId and nof_momIdx_daugthers == 1:
-          leptonIdxs.append(momIdx)
-      assert(currentIdx >= 0)
-      sfosPair.append(currentIdx)
-    assert(len(sfosPair) == 2)
-    sfosPairs.append(sfosPair)
-
-  # find out the SFOS leptons pairs that have a common mother that is coming from a lepton
-  sfosPairsWithCommonMom = {}
-  sfosPairsWithNoMoms = []
-  for sfosPair in sfosPairs:
-    moms = [ genParticles[leptonIdx].genPartIdxMother for leptonIdx in sfosPair ]
-    assert(len(moms) == 2)
-    if moms[0] == moms[1]:
-      momIdx = moms[0]
-      if momIdx < 0:
-        sfosPairsWithNoMoms.append(sfosPair)
-        continue
-      momPdgId = abs(genParticles[momIdx].pdgId)
-      if momPdgId not in leptonPdgIds:
-        continue
-      if momIdx not in sfosPairsWithCommonMom:
-        sfosPairsWithCommonMom[momIdx] = []
-      sfosPairsWithCommonMom[momIdx].append(sfosPair)
+  isPromptFinalStateLepton = GenPartCut(absPdgIds = leptonPdgIds, status = [ 1 ], flags = [ 'isPrompt' ])
+  leptonIdxs = np.flatnonzero(isPromptFinalStateLepton.mask(genParticles))
+
+  # for every lepton, find the parent that doesn't decay to a single particle and group the leptons by the mother of
+  # that parent, so that only the leptons with a common mother need to be paired
+  sfosCandidates = {}
+  for leptonIdx in leptonIdxs:
+    currentIdx = leptonIdx
+    for _ in range(len(genParticles)):
+      momIdx = motherIdxs[currentIdx]
+      assert(momIdx != currentIdx)
+      if momIdx >= 0 and pdgIds[momIdx] == pdgIds[currentIdx] and decayGraph.getNofDaughters(momIdx) == 1:
+        currentIdx = momIdx
+      else:
+        break
+    momIdx = int(motherIdxs[currentIdx])
+    if momIdx >= 0 and abs(pdgIds[momIdx]) not in leptonPdgIds:
+      continue
+    if momIdx not in sfosCandidates:
+      sfosCandidates[momIdx] = { pdgId : [] for pdgId in leptonPdgIds + [ -pdgId for pdgId in leptonPdgIds ] }
+    sfosCandidates[momIdx][int(pdgIds[leptonIdx])].append(int(currentIdx))
 
-  # for each mother, keep only the SFOS daughters that have the lowest energy
-  sfosFinalPairs = []
-  for momIdx in sfosPairsWithCommonMom:
-    nof_sfosPairs = len(sfosPairsWithCommonMom[momIdx])
-    if nof_sfosPairs > 1:
-      sfosPairWEnergy = []
-      for sfosPairIdx, sfosPair in enumerate(sfosPairsWithCommonMom[momIdx]):
-        firstParticle = genParticles[sfosPair[0]]
-        secondParticle = genParticles[sfosPair[1]]
-        pairEnergy = (getP4(firstParticle) + getP4(secondParticle)).E()
-        sfosPairWEnergy.append((sfosPairIdx, pairEnergy))
-
-      sfosPairWEnergy = list(sorted(sfosPairWEnergy, key = lambda entry: entry[1]))
-      assert(len(sfosPairWEnergy) > 1)
-      sfosFinalPairs.append(sfosPairsWithCommonMom[momIdx][sfosPairWEnergy[0][0]])
-
-    elif nof_sfosPairs == 1:
-      sfosFinalPairs.append(sfosPairsWithCommonMom[momIdx][0])
-    else:
-      assert(False)
+  chainIdxs = [ leptonIdx for candidates in sfosCandidates.values() for leptons in candidates.values() for leptonIdx in leptons ]
+  chainMasses = genParticles.massTable.getMasses(genParticles.mass[chainIdxs], pdgIds[chainIdxs])
+  chainEnergies = np.sqrt((genParticles.pt[chainIdxs] * np.cosh(genParticles.eta[chainIdxs]))**2 + chainMasses**2)
+  energies = dict(zip(chainIdxs, chainEnergies))
 
-  # assume that parentless SFOS pairs come from different photons
+  # form the SFOS pairs of the leptons with a common mother that is a lepton, and keep only the pair with the lowest
+  # energy for each such mother; all SFOS pairs of the parentless leptons are assumed to come from different photons
+  sfosFinalPairs = []
+  sfosPairsWithNoMoms = []
+  for momIdx in sorted(sfosCandidates):
+    sfosPairs = [
+      (firstLepton, secondLepton)
+      for leptonFlavor in leptonPdgIds
+      for firstLepton in sfosCandidates[momIdx][leptonFlavor]
+      for secondLepton in sfosCandidates[momIdx][-leptonFlavor]
+    ]
+    if not sfosPairs:
+      continue
+    if momIdx < 0:
+      sfosPairsWithNoMoms.extend(sfosPairs)
+      continue
+    sfosPairEnergies = [ energies[firstLepton] + energies[secondLepton] for firstLepton, secondLepton in sfosPairs ]
+    sfosFinalPairs.append(sfosPairs[int(np.argmin(sfosPairEnergies))])
   sfosFinalPairs.extend(sfosPairsWithNoMoms)
 
   # construct the proxy photons
   proxyPhotons = []
   for sfosPair in sfosFinalPairs:
-    firstParticle = genParticles[sfosPair[0]]
-    secondParticle = genParticles[sfosPair[1]]
-    finalParticle = getP4(firstParticle) + getP4(secondParticle)
-    proxyPhoton = GenPart(finalParticle, 22, 0, 201, 2**statusFlagsMap['isPrompt'])
-    #print("Considered\n  %s\n  %s\nas input to produce proxy photon:\n  %s" % (firstParticle, secondParticle, proxyPhoton)) # for debugging
+    sfosPairIdxs = list(sfosPair)
+    pt, eta, phi, mass = getP4Sum(
+      genParticles.pt[sfosPairIdxs], genParticles.eta[sfosPairIdxs], genParticles.phi[sfosPairIdxs],
+      genParticles.massTable.getMasses(genParticles.mass[sfosPairIdxs], pdgIds[sfosPairIdxs]),
+    )
+    proxyPhoton = GenPart(pt, eta, phi, mass, 22, 0, 201, 2**statusFlagsMap['isPrompt'])
     proxyPhotons.append(proxyPhoton)
 
   return proxyPhotons
 
-def genIsHardProcessSelection(genParticles):
-  return filter(
-    lambda genPart:
-      (genPart.statusFlags & 128) and \
-      (abs(genPart.pdgId) in [ 11, 13, 15, 21 ] or abs(genPart.pdgId) < 6) and \
-      (genPart.status != 21 if (abs(genPart.pdgId) == 21 or abs(genPart.pdgId) < 6) else True),
-    genParticles
-  )
+# the incoming quarks and gluons (status 21) are excluded
+genIsHardProcessSelection = GenPartCut(absPdgIds = [ 1, 2, 3, 4, 5, 11, 13, 15, 21 ], flags = [ 'isHardProcess' ]) & (
+  GenPartCut(absPdgIds = [ 11, 13, 15 ]) | ~GenPartCut(status = [ 21 ])
+)
 
-def genPhotonSelection(genParticles):
-  return filter(lambda genPart: genPart.pdgId == 22, genParticles)
+genPhotonSelection = GenPartCut(pdgIds = [ 22 ])
 
-def genPromptPhotonSelection(genParticles):
-  return filter(lambda genPart: genPart.checkIf('isPrompt'), genPhotonSelection(genParticles))
+genPromptPhotonSelection = GenPartCut(pdgIds = [ 22 ], flags = [ 'isPrompt' ])
+
+def getMotherPdgIds(genParticles, idxs):
+  # pdgIds of the mothers of the given particles, or 0 if a particle has no mother
+  motherIdxs = genParticles.genPartIdxMother[idxs]
+  return np.where(motherIdxs >= 0, genParticles.pdgId[motherIdxs], 0)
 
 def genHiggsSelection(genParticles):
-  return filter(
-    lambda genPart:
-      genPart.pdgId == 25 and \
-      (genParticles[genPart.genPartIdxMother].pdgId != 25 if genPart.genPartIdxMother >= 0 else True),
-    genParticles
-  )
+  return genParticles.select(genParticles.higgsIdxs)
 
 def genHiggsDaughtersSelection(genParticles):
-  return filter(
-    lambda genPart:
-      genPart.pdgId != 25 and \
-      (genParticles[genPart.genPartIdxMother].pdgId == 25 if genPart.genPartIdxMother >= 0 else False),
-    genParticles
-  )
+  decayGraph = genParticles.decayGraph
+  genHiggsDaughterIdxs = decayGraph.getAllDaughterIdxs(decayGraph.getIdxs([ 25 ]))
+  return genParticles.select(genHiggsDaughterIdxs[genParticles.pdgId[genHiggsDaughterIdxs] != 25])
 
 def genWZquarkSelection(genParticles):
-  return filter(
-    lambda genPart:
-      abs(genPart.pdgId) in [1, 2, 3, 4, 5, 6] and genPart.genPartIdxMother >= 0 and \
-      abs(genParticles[genPart.genPartIdxMother].pdgId) in [23, 24],
-    genParticles
-  )
+  decayGraph = genParticles.decayGraph
+  genVdaughterIdxs = decayGraph.getAllDaughterIdxs(decayGraph.getAbsIdxs([ 23, 24 ]))
+  return genParticles.select(genVdaughterIdxs[np.isin(np.abs(genParticles.pdgId[genVdaughterIdxs]), [1, 2, 3, 4, 5, 6])])
 
 def genVbosonSelection(genParticles):
-  return filter(
-    lambda genPart:
-      abs(genPart.pdgId) in [23, 24] and genPart.genPartIdxMother >= 0 and \
-      genParticles[genPart.genPartIdxMother].pdgId != genPart.pdgId,
-    genParticles
-  )
+  genVIdxs = genParticles.decayGraph.getAbsIdxs([ 23, 24 ])
+  return genParticles.select(genVIdxs[
+    (genParticles.genPartIdxMother[genVIdxs] >= 0) & \
+    (getMotherPdgIds(genParticles, genVIdxs) != genParticles.pdgId[genVIdxs])
+  ])
 
 def genTauFromV(genParticles):
-  return filter(
-    lambda genPart:
-    abs(genPart.pdgId) == 15 and genPart.genPartIdxMother >= 0 and \
-      abs(genParticles[genPart.genPartIdxMother].pdgId) in [ 23, 24 ],
-    genParticles
-  )
+  decayGraph = genParticles.decayGraph
+  genVdaughterIdxs = decayGraph.getAllDaughterIdxs(decayGraph.getAbsIdxs([ 23, 24 ]))
+  return genParticles.select(genVdaughterIdxs[np.abs(genParticles.pdgId[genVdaughterIdxs]) == 15])
+
+genNuSelection = GenPartCut(absPdgIds = [ 12, 14, 16 ])
+
+class DecayAnalysis(object):
+  # Results of the top and tau decays in an event, shared by all genTopSelection and genTauSelection calls.
+  # The decays are analyzed in stages that are evaluated on demand and cached, so that a selection only runs
+  # (and only fails on) the checks of the stages it depends on:
+  # - tops: the last tops in the chain and their decay products;
+  # - topDecays: W boson and the down-type quark from each top decay;
+  # - WfromTopDecays: leptonic, tauonic and hadronic decays of the last W from each top;
+  # - tauFromTopDecays: decays of the taus from t -> W b, W -> tau vtau;
+  # - taus: the last taus in the chain, their decay products and whether they decay leptonically.
+
+  def __init__(self, genParticles):
+    self.genParticles = genParticles
+    self.decayGraph = genParticles.decayGraph
+    self.stages = {}
+    self.isHadronicWfromTopChecked = False
+    self.isLeptonicTauChecked = False
+
+  def getStage(self, stageName):
+    if stageName not in self.stages:
+      self.stages[stageName] = getattr(self, 'analyze_%s' % stageName)()
+    return self.stages[stageName]
+
+  def analyze_tops(self):
+    genParticles = self.genParticles
+    # the tops that do not decay into another top
+    genTopCandidates = collections.OrderedDict(
+      (genTopIdx, self.decayGraph.getDaughterIdxs(genTopIdx))
+      for genTopIdx in self.decayGraph.getAbsIdxs([ 6 ]) if self.decayGraph.isLastCopy(genTopIdx)
+    )
 
-def genNuSelection(genParticles):
-  return filter(lambda genPart: abs(genPart.pdgId) in [12, 14, 16], genParticles)
+    for genTopCandidateIdx, genTopCandidateDaughterIdxs in genTopCandidates.items():
+      genTopCandidate = genParticles[genTopCandidateIdx]
+      if len(genTopCandidateDaughterIdxs) != 2:
+        print("WARNING: invalid number of top (%s) decay products (%s): %i; total # tops: %i" %
+          (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)), len(genTopCandidateDaughterIdxs), len(genTopCandidates))
+        )
+        del genTopCandidates[genTopCandidateIdx]
+        continue
+    return genTopCandidates
 
-def genTopSelection(genParticles, choice, enable_consistency_checks = True):
-  genTopMotherMap = {}
-  genWMotherMap = {}
-  for genPart in genParticles:
-    if abs(genPart.pdgId) == 6:
-      genTopMotherMap[genPart.idx] = genPart.genPartIdxMother # daughter -> mother
-    elif abs(genPart.pdgId) == 24:
-      genWMotherMap[genPart.genPartIdxMother] = genPart.idx # mother -> daughter
-
-  genTopCandidates = {}
-  for genTopIdx in genTopMotherMap:
-    if genTopIdx not in genTopMotherMap.values():
-      genTopCandidates[genTopIdx] = []
-
-  for genPart in genParticles:
-    if genPart.genPartIdxMother in genTopCandidates:
-      genTopCandidates[genPart.genPartIdxMother].append(genPart.idx)
-
-  for genTopCandidateIdx, genTopCandidateDaughterIdxs in genTopCandidates.items():
-    genTopCandidate = genParticles[genTopCandidateIdx]
-    if len(genTopCandidateDaughterIdxs) != 2:
-      print("WARNING: invalid number of top (%s) decay products (%s): %i; total # tops: %i" %
-        (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)), len(genTopCandidateDaughterIdxs), len(genTopCandidates))
-      )
-      del genTopCandidates[genTopCandidateIdx]
-      continue
+  def analyze_topDecays(self):
+    # top always decays into W + q, where q = d, s, b with b the most common one
+    genParticles = self.genParticles
+    genBquarkFromTop = []
+    genWsfromTop     = [] # pairs of top and W
 
-  if choice == SelectionOptions.SAVE_TOP:
-    return map(lambda genTopIdx: genParticles[genTopIdx], genTopCandidates)
-
-  # top always decays into W + q, where q = d, s, b with b the most common one
-  genBquarkFromTop               = []
-  genLepsFromWfromTop            = []
-  genNusFromWfromTop             = []
-  genTausFromTop                 = []
-  genNusTauFromTop               = []
-  genLepsFromTauFromTop          = []
-  genNuLepFromTauFromTop         = []
-  genNuTauFromLeptonicTauFromTop = []
-  genNuTauFromHadronicTauFromTop = []
-  genQuarkFromWfromTop           = []
-
-  for genTopCandidateIdx, genTopCandidateDaughterIdxs in genTopCandidates.items():
-    genTopCandidate = genParticles[genTopCandidateIdx]
-    assert(len(genTopCandidateDaughterIdxs) == 2)
-
-    genWsfromTop = [ genParticles[idx] for idx in genTopCandidateDaughterIdxs if genParticles[idx].pdgId == 24 * sign(genTopCandidate.pdgId) ]
-    genQsfromTop = [ genParticles[idx] for idx in genTopCandidateDaughterIdxs if sign(genTopCandidate.pdgId) * genParticles[idx].pdgId in [1, 3, 5] ]
-
-    if len(genWsfromTop) != 1:
-      print("Not exactly 1 W boson found from top (%s) decay: %s" % \
-        (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)))
-      )
-      continue
-    if len(genQsfromTop) != 1:
-      raise ValueError("Not exactly 1 quark found from top (%s) decay: %s" % \
-        (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)))
-      )
+    for genTopCandidateIdx, genTopCandidateDaughterIdxs in self.getStage('tops').items():
+      genTopCandidate = genParticles[genTopCandidateIdx]
+      assert(len(genTopCandidateDaughterIdxs) == 2)
 
-    if abs(genQsfromTop[0].pdgId) == 5:
-      genBquarkFromTop.extend(genQsfromTop)
-    if choice == SelectionOptions.SAVE_BQUARK_FROM_TOP:
-      continue # skip the next part
-
-    genWfromTop = genWsfromTop[0]
-    # now search for leptons and/or taus which are descendant of the W boson
-    # however, the W might ,,travel'' until it decays, i.e. its immediate daughter can be a single W boson
-    # that's why we have to loop over the generator level particle collection and find out which W is the last one
-    # in the top decay chain
-    while genWfromTop.idx in genWMotherMap:
-      genWfromTop = genParticles[genWMotherMap[genWfromTop.idx]]
-
-    # let's look at W's decay products; possibilities include:
-    # 1) leptonic: W -> l vl
-    # 2) tauonic:  W -> tau vtau
-    # 3) hadronic: W -> q q'
-
-    genWfromTopDaughters = filter(lambda genPart: genPart.genPartIdxMother == genWfromTop.idx, genParticles)
-    if len(genWfromTopDaughters) != 2:
-      raise ValueError("Invalid number (%i) of W (%s) daughters from top (%s) decay: %s" % \
-        (len(genWfromTopDaughters), genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
-      )
+      genWsfromTopCandidate = [ genParticles[idx] for idx in genTopCandidateDaughterIdxs if genParticles[idx].pdgId == 24 * sign(genTopCandidate.pdgId) ]
+      genQsfromTop = [ genParticles[idx] for idx in genTopCandidateDaughterIdxs if sign(genTopCandidate.pdgId) * genParticles[idx].pdgId in [1, 3, 5] ]
 
-    if any(map(lambda genPart: abs(genPart.pdgId) in [11, 13], genWfromTopDaughters)):
-      lepsFromWfromTop = filter(lambda genPart: -sign(genWfromTop.pdgId) * genPart.pdgId in [11, 13], genWfromTopDaughters)
-      if len(lepsFromWfromTop) != 1:
-        raise ValueError("Inconsistent W (%s) decay products from top (%s) decay: %s" % \
-          (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+      if len(genWsfromTopCandidate) != 1:
+        print("Not exactly 1 W boson found from top (%s) decay: %s" % \
+          (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)))
         )
-      genLepFromWfromTop = lepsFromWfromTop[0]
-      nusLepFromWfromTop = filter(lambda genPart: genPart.pdgId == sign(genWfromTop.pdgId) * (abs(genLepFromWfromTop.pdgId) + 1), genWfromTopDaughters)
-      if len(nusLepFromWfromTop) != 1:
-        raise ValueError("Inconsistent W (%s) decay products from top (%s) decay: %s" % \
-          (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+        continue
+      if len(genQsfromTop) != 1:
+        raise ValueError("Not exactly 1 quark found from top (%s) decay: %s" % \
+          (genTopCandidate, ', '.join(map(lambda idx: str(genParticles[idx]), genTopCandidateDaughterIdxs)))
         )
-      genLepsFromWfromTop.extend(lepsFromWfromTop)
-      genNusFromWfromTop.extend(nusLepFromWfromTop)
-    elif any(map(lambda genPart: abs(genPart.pdgId) == 15, genWfromTopDaughters)):
-      genTausFromWfromTop   = filter(lambda genPart: genPart.pdgId == -sign(genWfromTop.pdgId) * 15, genWfromTopDaughters)
-      genNusTauFromWfromTop = filter(lambda genPart: genPart.pdgId ==  sign(genWfromTop.pdgId) * 16, genWfromTopDaughters)
-
-      if len(genTausFromWfromTop) != 1 or len(genNusTauFromWfromTop) != 1:
-        raise ValueError("Inconsistent W (%s) tauonic decay products from top (%s) decay: %s" % \
+
+      if abs(genQsfromTop[0].pdgId) == 5:
+        genBquarkFromTop.extend(genQsfromTop)
+      genWsfromTop.append((genTopCandidate, genWsfromTopCandidate[0]))
+
+    return {
+      SelectionOptions.SAVE_BQUARK_FROM_TOP : genBquarkFromTop,
+      'Ws'                                  : genWsfromTop,
+    }
+
+  def analyze_WfromTopDecays(self):
+    genParticles = self.genParticles
+    genLepsFromWfromTop   = []
+    genNusFromWfromTop    = []
+    genTausFromTop        = []
+    genNusTauFromTop      = []
+    genQuarkFromWfromTop  = []
+    genTausFromWfromTop_  = [] # triplets of top, W and tau
+    genHadronicWsfromTop_ = [] # triplets of top, W and its daughters
+
+    for genTopCandidate, genWfromTop in self.getStage('topDecays')['Ws']:
+      # now search for leptons and/or taus which are descendant of the W boson
+      # however, the W might ,,travel'' until it decays, i.e. its immediate daughter can be a single W boson
+      # that's why we have to follow the chain of W bosons and find out which W is the last one in the top decay chain
+      genWfromTop = genParticles[self.decayGraph.getLastCopyIdx(genWfromTop.idx)]
+
+      # let's look at W's decay products; possibilities include:
+      # 1) leptonic: W -> l vl
+      # 2) tauonic:  W -> tau vtau
+      # 3) hadronic: W -> q q'
+
+      genWfromTopDaughters = [ genParticles[genPartIdx] for genPartIdx in self.decayGraph.getDaughterIdxs(genWfromTop.idx) ]
+      if len(genWfromTopDaughters) != 2:
+        raise ValueError("Invalid number (%i) of W (%s) daughters from top (%s) decay: %s" % \
+          (len(genWfromTopDaughters), genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+        )
+
+      if any(map(lambda genPart: abs(genPart.pdgId) in [11, 13], genWfromTopDaughters)):
+        lepsFromWfromTop = filter(lambda genPart: -sign(genWfromTop.pdgId) * genPart.pdgId in [11, 13], genWfromTopDaughters)
+        if len(lepsFromWfromTop) != 1:
+          raise ValueError("Inconsistent W (%s) decay products from top (%s) decay: %s" % \
+            (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+          )
+        genLepFromWfromTop = lepsFromWfromTop[0]
+        nusLepFromWfromTop = filter(lambda genPart: genPart.pdgId == sign(genWfromTop.pdgId) * (abs(genLepFromWfromTop.pdgId) + 1), genWfromTopDaughters)
+        if len(nusLepFromWfromTop) != 1:
+          raise ValueError("Inconsistent W (%s) decay products from top (%s) decay: %s" % \
+            (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+          )
+        genLepsFromWfromTop.extend(lepsFromWfromTop)
+        genNusFromWfromTop.extend(nusLepFromWfromTop)
+      elif any(map(lambda genPart: abs(genPart.pdgId) == 15, genWfromTopDaughters)):
+        genTausFromWfromTop   = filter(lambda genPart: genPart.pdgId == -sign(genWfromTop.pdgId) * 15, genWfromTopDaughters)
+        genNusTauFromWfromTop = filter(lambda genPart: genPart.pdgId ==  sign(genWfromTop.pdgId) * 16, genWfromTopDaughters)
+
+        if len(genTausFromWfromTop) != 1 or len(genNusTauFromWfromTop) != 1:
+          raise ValueError("Inconsistent W (%s) tauonic decay products from top (%s) decay: %s" % \
+            (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+          )
+
+        genTausFromTop.extend(genTausFromWfromTop)
+        genNusTauFromTop.extend(genNusTauFromWfromTop)
+        genTausFromWfromTop_.append((genTopCandidate, genWfromTop, genTausFromWfromTop[0]))
+      elif all(map(lambda genPart: abs(genPart.pdgId) in [1, 2, 3, 4, 5], genWfromTopDaughters)):
+        # hadronic case
+        genQuarkFromWfromTop.extend(genWfromTopDaughters)
+        genHadronicWsfromTop_.append((genTopCandidate, genWfromTop, genWfromTopDaughters))
+      else:
+        raise ValueError("Invalid W (%s) daughters from top (%s) decay: %s" % \
           (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
         )
 
-      genTausFromTop.extend(genTausFromWfromTop)
-      genNusTauFromTop.extend(genNusTauFromWfromTop)
+    return {
+      SelectionOptions.SAVE_LEPTON_FROM_TOP       : genLepsFromWfromTop,
+      SelectionOptions.SAVE_LEPTONIC_NU_FROM_TOP  : genNusFromWfromTop,
+      SelectionOptions.SAVE_TAU_FROM_TOP          : genTausFromTop,
+      SelectionOptions.SAVE_TAU_NU_FROM_TOP       : genNusTauFromTop,
+      SelectionOptions.SAVE_QUARK_FROM_W_FROM_TOP : genQuarkFromWfromTop,
+      'taus'                                      : genTausFromWfromTop_,
+      'hadronicWs'                                : genHadronicWsfromTop_,
+    }
+
+  def checkHadronicWfromTopDecays(self):
+    if self.isHadronicWfromTopChecked:
+      return
+    for genTopCandidate, genWfromTop, genWfromTopDaughters in self.getStage('WfromTopDecays')['hadronicWs']:
+      genWfromTopDaughters_pdgIdSorted = list(sorted(genWfromTopDaughters, key = lambda genPart: abs(genPart.pdgId), reverse = True))
+      if not ((genWfromTopDaughters_pdgIdSorted[0].pdgId == -5 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  4 * sign(genWfromTop.pdgId)) or \
+              (genWfromTopDaughters_pdgIdSorted[0].pdgId == -5 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  2 * sign(genWfromTop.pdgId)) or \
+              (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  4 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -3 * sign(genWfromTop.pdgId)) or \
+              (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  4 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -1 * sign(genWfromTop.pdgId)) or \
+              (genWfromTopDaughters_pdgIdSorted[0].pdgId == -3 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  2 * sign(genWfromTop.pdgId)) or \
+              (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  2 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -1 * sign(genWfromTop.pdgId))):
+        raise ValueError("Invalid hadronic W (%s) decay products from top (%s): %s" % \
+          (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
+        )
+    self.isHadronicWfromTopChecked = True
 
-      if choice not in [
-          SelectionOptions.SAVE_LEPTON_FROM_TAU_FROM_TOP,
-          SelectionOptions.SAVE_LEPTON_NU_FROM_TAU_FROM_TOP,
-          SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU_FROM_TOP,
-          SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU_FROM_TOP,
-        ]:
-        continue
+  def analyze_tauFromTopDecays(self):
+    genParticles = self.genParticles
+    genLepsFromTauFromTop          = []
+    genNuLepFromTauFromTop         = []
+    genNuTauFromLeptonicTauFromTop = []
+    genNuTauFromHadronicTauFromTop = []
 
-      genTauFromWfromTop = genTausFromWfromTop[0]
+    for genTopCandidate, genWfromTop, genTauFromWfromTop in self.getStage('WfromTopDecays')['taus']:
       # let's check tau decay products from t -> Wb, W -> tau vtau
-      # map all mother taus to their daughters and pick the one we chose
-      genTauMotherMap = {}
-      for genPart in genParticles:
-        if abs(genPart.pdgId) == 15:
-          genTauMotherMap[genPart.genPartIdxMother] = genPart.idx
-
-      genTauFromWfromTop_toDecay = genTauFromWfromTop
-      while genTauFromWfromTop_toDecay.idx in genTauMotherMap:
-        genTauFromWfromTop_toDecay = genParticles[genTauMotherMap[genTauFromWfromTop_toDecay.idx]]
+      # follow the chain of taus to the one that decays
+      genTauFromWfromTop_toDecay = genParticles[self.decayGraph.getLastCopyIdx(genTauFromWfromTop.idx)]
 
       # now check tau decay products
-      tauFromWfromTopDaughters = filter(lambda genPart: genPart.genPartIdxMother == genTauFromWfromTop_toDecay.idx, genParticles)
+      tauFromWfromTopDaughters = [
+        genParticles[genPartIdx] for genPartIdx in self.decayGraph.getDaughterIdxs(genTauFromWfromTop_toDecay.idx)
+      ]
       if any(map(lambda genPart: abs(genPart.pdgId) in [11, 13], tauFromWfromTopDaughters)):
         # leptonic tau decay, record lepton, tau neutrino and lepton neutrino
         nusTauFromTauFromWfromTop = filter(lambda genPart: genPart.pdgId == 16 * sign(genTauFromWfromTop_toDecay.pdgId), tauFromWfromTopDaughters)
         if len(nusTauFromTauFromWfromTop) != 1:
-          raise ValueError("Not enough tau neutrinos in leptonic tau (%s) decay from W (%s) from top (%s): %s"\
+          raise ValueError("Not enough tau neutrinos in leptonic tau (%s) decay from W (%s) from top (%s): %s" % \
             (genTauFromWfromTop_toDecay, genWfromTop, genTopCandidate, ', '.join(map(str, tauFromWfromTopDaughters)))
           )
         lepsFromTauFromTauFromWfromTop = filter(lambda genPart: abs(genPart.pdgId) in [11, 13], tauFromWfromTopDaughters)
         if len(lepsFromTauFromTauFromWfromTop) != 1:
-          raise ValueError("Too many leptons in leptonic tau (%s) decay from W (%s) from top (%s): %s"\
+          raise ValueError("Too many leptons in leptonic tau (%s) decay from W (%s) from top (%s): %s" % \
             (genTauFromWfromTop_toDecay, genWfromTop, genTopCandidate, ', '.join(map(str, tauFromWfromTopDaughters)))
           )
         nusLepFromTauFromWfromTop = filter(
@@ -477,7 +778,7 @@ def genTopSelection(genParticles, choice, enable_consistency_checks = True):
           tauFromWfromTopDaughters
         )
         if len(nusLepFromTauFromWfromTop) != 1:
-          raise ValueError("Not enough lepton neutrinos in leptonic tau (%s) decay from W (%s) from top (%s): %s"\
+          raise ValueError("Not enough lepton neutrinos in leptonic tau (%s) decay from W (%s) from top (%s): %s" % \
             (genTauFromWfromTop_toDecay, genWfromTop, genTopCandidate, ', '.join(map(str, tauFromWfromTopDaughters)))
           )
         genLepsFromTauFromTop.extend(lepsFromTauFromTauFromWfromTop)
@@ -491,67 +792,80 @@ def genTopSelection(genParticles, choice, enable_consistency_checks = True):
             (genTauFromWfromTop_toDecay, genWfromTop, genTopCandidate, ', '.join(map(str, tauFromWfromTopDaughters)))
           )
         genNuTauFromHadronicTauFromTop.extend(nusTauFromTauFromWfromTop)
-    elif all(map(lambda genPart: abs(genPart.pdgId) in [1, 2, 3, 4, 5], genWfromTopDaughters)):
-      # hadronic case
-      if enable_consistency_checks:
-        genWfromTopDaughters_pdgIdSorted = list(sorted(genWfromTopDaughters, key = lambda genPart: abs(genPart.pdgId), reverse = True))
-        if not ((genWfromTopDaughters_pdgIdSorted[0].pdgId == -5 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  4 * sign(genWfromTop.pdgId)) or \
-                (genWfromTopDaughters_pdgIdSorted[0].pdgId == -5 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  2 * sign(genWfromTop.pdgId)) or \
-                (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  4 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -3 * sign(genWfromTop.pdgId)) or \
-                (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  4 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -1 * sign(genWfromTop.pdgId)) or \
-                (genWfromTopDaughters_pdgIdSorted[0].pdgId == -3 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId ==  2 * sign(genWfromTop.pdgId)) or \
-                (genWfromTopDaughters_pdgIdSorted[0].pdgId ==  2 * sign(genWfromTop.pdgId) and genWfromTopDaughters_pdgIdSorted[1].pdgId == -1 * sign(genWfromTop.pdgId))):
-          raise ValueError("Invalid hadronic W (%s) decay products from top (%s): %s" % \
-            (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
-          )
-      genQuarkFromWfromTop.extend(genWfromTopDaughters)
-    else:
-      raise ValueError("Invalid W (%s) daughters from top (%s) decay: %s" % \
-        (genWfromTop, genTopCandidate, ', '.join(map(str, genWfromTopDaughters)))
-      )
-
-  if choice == SelectionOptions.SAVE_BQUARK_FROM_TOP:
-    return genBquarkFromTop
-  if choice == SelectionOptions.SAVE_LEPTON_FROM_TOP:
-    return genLepsFromWfromTop
-  if choice == SelectionOptions.SAVE_LEPTONIC_NU_FROM_TOP:
-    return genNusFromWfromTop
-  if choice == SelectionOptions.SAVE_TAU_FROM_TOP:
-    return genTausFromTop
-  if choice == SelectionOptions.SAVE_TAU_NU_FROM_TOP:
-    return genNusTauFromTop
-  if choice == SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU_FROM_TOP:
-    return genNuTauFromHadronicTauFromTop
-  if choice == SelectionOptions.SAVE_LEPTON_FROM_TAU_FROM_TOP:
-    return genLepsFromTauFromTop
-  if choice == SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU_FROM_TOP:
-    return genNuTauFromLeptonicTauFromTop
-  if choice == SelectionOptions.SAVE_LEPTON_NU_FROM_TAU_FROM_TOP:
-    return genNuLepFromTauFromTop
-  if choice == SelectionOptions.SAVE_QUARK_FROM_W_FROM_TOP:
-    return genQuarkFromWfromTop
-
-  raise ValueError("Invalid selection option: %i" % choice)
 
-def genTauSelection(genParticles, choice, enable_consistency_checks = False):
-  genTauMotherMap = {}
-  for genPart in genParticles:
-    if abs(genPart.pdgId) == 15:
-      genTauMotherMap[genPart.idx] = genPart.genPartIdxMother
-
-  genTauCandidates = {}
-  for genTauIdx in genTauMotherMap:
-    if genTauIdx not in genTauMotherMap.values():
-      genTauCandidates[genTauIdx] = { 'daughters' : [], 'isLeptonic' : False }
-
-  for genPart in genParticles:
-    if genPart.genPartIdxMother in genTauCandidates:
-      genTauCandidates[genPart.genPartIdxMother]['daughters'].append(genPart)
-      genTauCandidates[genPart.genPartIdxMother]['isLeptonic'] = genTauCandidates[genPart.genPartIdxMother]['isLeptonic'] or \
-                                                                 abs(genPart.pdgId) in [11, 13]
-
-  # assert that the decay products of the leptonic taus are consistent
-  if enable_consistency_checks:
+    return {
+      SelectionOptions.SAVE_LEPTON_FROM_TAU_FROM_TOP          : genLepsFromTauFromTop,
+      SelectionOptions.SAVE_LEPTON_NU_FROM_TAU_FROM_TOP       : genNuLepFromTauFromTop,
+      SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU_FROM_TOP : genNuTauFromLeptonicTauFromTop,
+      SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU_FROM_TOP : genNuTauFromHadronicTauFromTop,
+    }
+
+  def getTopSelection(self, choice, enable_consistency_checks = True):
+    genParticles = self.genParticles
+    if choice == SelectionOptions.SAVE_TOP:
+      return [ genParticles[genTopIdx] for genTopIdx in self.getStage('tops') ]
+    if choice == SelectionOptions.SAVE_BQUARK_FROM_TOP:
+      return list(self.getStage('topDecays')[choice])
+
+    WfromTopDecays = self.getStage('WfromTopDecays')
+    if enable_consistency_checks:
+      self.checkHadronicWfromTopDecays()
+    if choice in WfromTopDecays:
+      return list(WfromTopDecays[choice])
+
+    tauFromTopDecays = self.getStage('tauFromTopDecays')
+    if choice in tauFromTopDecays:
+      return list(tauFromTopDecays[choice])
+
+    raise ValueError("Invalid selection option: %i" % choice)
+
+  def analyze_taus(self):
+    genParticles = self.genParticles
+    # the taus that do not decay into another tau
+    genTauCandidates = collections.OrderedDict()
+    for genTauIdx in self.decayGraph.getAbsIdxs([ 15 ]):
+      if self.decayGraph.isLastCopy(genTauIdx):
+        genTauDaughters = [ genParticles[genPartIdx] for genPartIdx in self.decayGraph.getDaughterIdxs(genTauIdx) ]
+        genTauCandidates[genTauIdx] = {
+          'daughters'  : genTauDaughters,
+          'isLeptonic' : any(abs(genPart.pdgId) in [11, 13] for genPart in genTauDaughters),
+        }
+
+    genLeptonicTaus, genHadronicTaus = [], []
+    genLeptonsFromTaus, genNusLepFromTaus, genNusTauFromLepTaus, genNusTauFromHadTaus = [], [], [], []
+    for genTauIdx, genTauCandidate in genTauCandidates.items():
+      if genTauCandidate['isLeptonic']:
+        genLeptonicTaus.append(genParticles[genTauIdx])
+        for genLeptonicTauDaughter in genTauCandidate['daughters']:
+          if abs(genLeptonicTauDaughter.pdgId) in [11, 13]:
+            genLeptonsFromTaus.append(genLeptonicTauDaughter)
+          elif abs(genLeptonicTauDaughter.pdgId) in [12, 14]:
+            genNusLepFromTaus.append(genLeptonicTauDaughter)
+          elif abs(genLeptonicTauDaughter.pdgId) == 16:
+            genNusTauFromLepTaus.append(genLeptonicTauDaughter)
+      else:
+        genHadronicTaus.append(genParticles[genTauIdx])
+        for genHadronicTauDaughter in genTauCandidate['daughters']:
+          if abs(genHadronicTauDaughter.pdgId) == 16:
+            genNusTauFromHadTaus.append(genHadronicTauDaughter)
+
+    return {
+      SelectionOptions.SAVE_TAU                      : [ genParticles[genTauIdx] for genTauIdx in genTauCandidates ],
+      SelectionOptions.SAVE_LEPTONIC_TAU             : genLeptonicTaus,
+      SelectionOptions.SAVE_HADRONIC_TAU             : genHadronicTaus,
+      SelectionOptions.SAVE_LEPTON_FROM_TAU          : genLeptonsFromTaus,
+      SelectionOptions.SAVE_LEPTONIC_NU_FROM_TAU     : genNusLepFromTaus,
+      SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU : genNusTauFromLepTaus,
+      SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU : genNusTauFromHadTaus,
+      'candidates'                                   : genTauCandidates,
+    }
+
+  def checkLeptonicTauDecays(self):
+    # assert that the decay products of the leptonic taus are consistent
+    if self.isLeptonicTauChecked:
+      return
+    genParticles = self.genParticles
+    genTauCandidates = self.getStage('taus')['candidates']
     for genTauIdx in genTauCandidates:
       if genTauCandidates[genTauIdx]['isLeptonic']:
         genTauCurrent   = genParticles[genTauIdx]
@@ -572,11 +886,11 @@ def genTauSelection(genParticles, choice, enable_consistency_checks = False):
           elif abs(daughter.pdgId) == 16:
             genTauDaughterNuTau = daughter
 
-        if genTauDaughterNuLep.pdgId is None:
+        if genTauDaughterNuLep is None:
           raise ValueError("Could not find lepton nu from leptonic tau (%s) decay (daughters: %s)" % \
             (genTauCurrent, ', '.join(map(str, genTauDaughters)))
           )
-        if genTauDaughterNuTau.pdgId is None:
+        if genTauDaughterNuTau is None:
           raise ValueError("Could not find tau nu from leptonic tau (%s) decay (daughters: %s)" % \
             (genTauCurrent, ', '.join(map(str, genTauDaughters)))
           )
@@ -587,67 +901,43 @@ def genTauSelection(genParticles, choice, enable_consistency_checks = False):
           raise ValueError("Inconsistent pdgIds b/w lepton (%s) and lepton nu (%s) in leptonic tau decay" % \
             (genTauDaughterLep, genTauDaughterNuLep)
           )
+    self.isLeptonicTauChecked = True
 
-  if choice == SelectionOptions.SAVE_TAU:
-    return map(lambda genTauIdx: genParticles[genTauIdx], genTauCandidates)
-  elif choice in [
-      SelectionOptions.SAVE_HADRONIC_TAU,
-      SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU,
-    ]:
-    genHadronicTauIdxs = filter(lambda genTauIdx: not genTauCandidates[genTauIdx]['isLeptonic'], genTauCandidates)
-    if choice == SelectionOptions.SAVE_HADRONIC_TAU:
-      return map(lambda genLeptonicTauIdx: genParticles[genLeptonicTauIdx], genHadronicTauIdxs)
-
-    genHadronicTauDaughterArrays = map(
-      lambda genLeptonicTauIdx: genTauCandidates[genLeptonicTauIdx]['daughters'], genHadronicTauIdxs
-    )
-    genNusTauFromHadTaus = []
-    for genHadronicTauDaughters in genHadronicTauDaughterArrays:
-      for genHadronicTauDaughter in genHadronicTauDaughters:
-        if abs(genHadronicTauDaughter.pdgId) == 16:
-          genNusTauFromHadTaus.append(genHadronicTauDaughter)
-    if choice == SelectionOptions.SAVE_TAU_NU_FROM_HADRONIC_TAU:
-      return genNusTauFromHadTaus
-  elif choice in [
-      SelectionOptions.SAVE_LEPTONIC_TAU,
-      SelectionOptions.SAVE_LEPTON_FROM_TAU,
-      SelectionOptions.SAVE_LEPTONIC_NU_FROM_TAU,
-      SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU,
-    ]:
-    genLeptonicTauIdxs = filter(lambda genTauIdx: genTauCandidates[genTauIdx]['isLeptonic'], genTauCandidates)
-    if choice == SelectionOptions.SAVE_LEPTONIC_TAU:
-      return map(lambda genLeptonicTauIdx: genParticles[genLeptonicTauIdx], genLeptonicTauIdxs)
-
-    genLeptonicTauDaughterArrays = map(
-      lambda genLeptonicTauIdx: genTauCandidates[genLeptonicTauIdx]['daughters'], genLeptonicTauIdxs
-    )
-    genLeptonsFromTaus, genNusLepFromTaus, genNusTauFromLepTaus = [], [], []
-    for genLeptonicTauDaughters in genLeptonicTauDaughterArrays:
-      for genLeptonicTauDaughter in genLeptonicTauDaughters:
-        if abs(genLeptonicTauDaughter.pdgId) in [11, 13]:
-          genLeptonsFromTaus.append(genLeptonicTauDaughter)
-        elif abs(genLeptonicTauDaughter.pdgId) in [12, 14]:
-          genNusLepFromTaus.append(genLeptonicTauDaughter)
-        elif abs(genLeptonicTauDaughter.pdgId) == 16:
-          genNusTauFromLepTaus.append(genLeptonicTauDaughter)
-
-    if choice == SelectionOptions.SAVE_LEPTON_FROM_TAU:
-      return genLeptonsFromTaus
-    if choice == SelectionOptions.SAVE_LEPTONIC_NU_FROM_TAU:
-      return genNusLepFromTaus
-    if choice == SelectionOptions.SAVE_TAU_NU_FROM_LEPTONIC_TAU:
-      return genNusTauFromLepTaus
-  else:
-    raise ValueError("Choice %i not implemented" % choice)
+  def getTauSelection(self, choice, enable_consistency_checks = False):
+    taus = self.getStage('taus')
+    if enable_consistency_checks:
+      self.checkLeptonicTauDecays()
+    if choice not in taus or choice == 'candidates':
+      raise ValueError("Choice %i not implemented" % choice)
+    return list(taus[choice])
+
+
+def genTopSelection(genParticles, choice, enable_consistency_checks = True):
+  return genParticles.decayAnalysis.getTopSelection(choice, enable_consistency_checks)
+
+def genTauSelection(genParticles, choice, enable_consistency_checks = False):
+  return genParticles.decayAnalysis.getTauSelection(choice, enable_consistency_checks)
 
 
+# selections that construct new particles instead of picking them from the GenPart collection
+syntheticSelections = [ genPhotonCandidateSelection ]
+
 class genParticleProducer(Module):
+  # In the 'full' output layout, all kinematic variables of the selected particles are copied to the output. In the
+  # 'index' output layout, only the indices of the selected particles in the GenPart collection are written together
+  # with the mass and charge from the MassTable, which are not stored in GenPart (see readGenCollection); the proxy
+  # particles that are not part of the GenPart collection are still written in the 'full' layout. The index layout
+  # requires the GenPart collection to be kept in the output.
 
-  def __init__(self, genEntry, verbose = False):
+  def __init__(self, genEntry, verbose = False, outputLayout = 'full'):
     self.massTable = MassTable()
     self.branchLenNames  = {}
     self.selections      = {}
     self.branchBaseNames = []
+    self.outputLayout    = outputLayout
+
+    if self.outputLayout not in [ 'full', 'index' ]:
+      raise ValueError("Invalid output layout: %s" % self.outputLayout)
 
     self.genBranches = {
         "pt"          : "F",
@@ -659,11 +949,21 @@ class genParticleProducer(Module):
         "status"      : "I",
         "statusFlags" : "I",
       }
+    self.genIdxBranches = {
+        "genPartIdx"  : "I",
+        "mass"        : "F",
+        "charge"      : "I",
+      }
+    self.outputBranches = {}
 
     for branchBaseName, selection in genEntry.items():
       self.branchBaseNames.append(branchBaseName)
       self.selections[branchBaseName]     = selection
       self.branchLenNames[branchBaseName] = "n%s" % branchBaseName
+      if self.outputLayout == 'index' and selection not in syntheticSelections:
+        self.outputBranches[branchBaseName] = self.genIdxBranches
+      else:
+        self.outputBranches[branchBaseName] = self.genBranches
 
     if verbose:
       logging.getLogger().setLevel(logging.DEBUG)
@@ -677,7 +977,7 @@ class genParticleProducer(Module):
   def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
     self.out = wrappedOutputTree
     for branchBaseName in self.branchBaseNames:
-      for branchName, branchType in self.genBranches.items():
+      for branchName, branchType in self.outputBranches[branchBaseName].items():
         self.out.branch(
           "%s_%s" % (branchBaseName, branchName),
           branchType,
@@ -688,7 +988,7 @@ class genParticleProducer(Module):
     pass
 
   def analyze(self, event):
-    genParticles  = map(lambda genPartIdx: GenPartAux(genPartIdx[1], genPartIdx[0], self.massTable), enumerate(Collection(event, "GenPart")))
+    genParticles  = getGenParticles(event, self.massTable)
     #print(":".join(str(getattr(event, nr)) for nr in [ 'run', 'luminosityBlock', 'event' ])) # for debugging pruposes
 
     for branchBaseName in self.branchBaseNames:
@@ -701,13 +1001,35 @@ class genParticleProducer(Module):
         )
         raise exception_type, type(exception_value)(exception_value_str), exception_traceback
       gen_arr = list(sorted(gen_arr, key = lambda genPart: genPart.pt, reverse = True)) # sort by pT
-      for branchName, branchType in self.genBranches.items():
+      for branchName in self.outputBranches[branchBaseName]:
+        attrName = 'idx' if branchName == 'genPartIdx' else branchName
         self.out.fillBranch(
           "%s_%s" % (branchBaseName, branchName),
-          map(lambda genPart: getattr(genPart, branchName), gen_arr)
+          map(lambda genPart: getattr(genPart, attrName), gen_arr)
         )
     return True
 
+def readGenCollection(event, branchBaseName, prefix = "GenPart"):
+  # reconstructs the particles written by genParticleProducer in either output layout
+  nofParticles = int(getattr(event, "n%s" % branchBaseName))
+  if not hasattr(event, "%s_genPartIdx" % branchBaseName):
+    branches = [
+      getattr(event, "%s_%s" % (branchBaseName, branchName))
+      for branchName in [ 'pt', 'eta', 'phi', 'mass', 'pdgId', 'charge', 'status', 'statusFlags' ]
+    ]
+    return [ GenPart(*[ branch[idx] for branch in branches ]) for idx in range(nofParticles) ]
+  genPartIdxs = getattr(event, "%s_genPartIdx" % branchBaseName)
+  masses      = getattr(event, "%s_mass"       % branchBaseName)
+  charges     = getattr(event, "%s_charge"     % branchBaseName)
+  branches = [
+    getattr(event, "%s_%s" % (prefix, branchName)) for branchName in [ 'pt', 'eta', 'phi', 'pdgId', 'status', 'statusFlags' ]
+  ]
+  genParticles = []
+  for idx in range(nofParticles):
+    pt, eta, phi, pdgId, status, statusFlags = [ branch[genPartIdxs[idx]] for branch in branches ]
+    genParticles.append(GenPart(pt, eta, phi, masses[idx], pdgId, charges[idx], status, statusFlags))
+  return genParticles
+
 
 genPhotonCandidateEntry             = ("GenPhotonCandidate",             genPhotonCandidateSelection)
 genIsHardProcessEntry               = ("GenIsHardProcess",               genIsHardProcessSelection)
@@ -772,7 +1094,7 @@ genLepFromTauFromTop           = lambda : genParticleProducer(dict([genLepFromTa
 genQuarkFromTop                = lambda : genParticleProducer(dict([genQuarkFromTopEntry]))                # only quarks (q, q') from t -> W b, W -> q q' decay
 genBQuarkFromTop               = lambda : genParticleProducer(dict([genBQuarkFromTopEntry]))               # only b-quarks (b) from t -> W b
 
-genAll = lambda : genParticleProducer(dict([
+genAll = lambda outputLayout = 'full' : genParticleProducer(dict([
     genPhotonCandidateEntry,
     genIsHardProcessEntry,
     genLeptonEntry,
@@ -789,4 +1111,5 @@ genAll = lambda : genParticleProducer(dict([
     genNuFromTopEntry,
     genQuarkFromTopEntry,
     genBQuarkFromTopEntry,
-  ]))
+  ]), outputLayout = outputLayout)
+genAllIndexed = lambda : genAll(outputLayout = 'index') # same as genAll, but stores the indices to the GenPart collection
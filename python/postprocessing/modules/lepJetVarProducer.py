@@ -1,13 +1,126 @@
 import ROOT
-import math, os
+import math, os, re
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
+import numpy as np
+
+from tthAnalysis.NanoAODTools.postprocessing.arrayCache import get_cache_file, load_arrays, save_arrays
+
+# Evaluates L1FastJet corrections from the txt files of JetCorrectorParameters, without going through
+# FactorizedJetCorrector: the header of the file lists the binning variable (JetEta), the formula variables
+# (JetPt, JetA and Rho in any order, which map to x, y and z in the formula) and the formula itself, and every
+# subsequent line holds the range of JetEta, the number of remaining columns, the ranges of the formula variables
+# and the formula parameters. As in FactorizedJetCorrector, the formula variables are clamped to their ranges,
+# and the correction is 1 if JetEta falls outside of all bins.
+class L1FastJetCorrector(object):
+
+    formulaVariables = [ 'x', 'y', 'z' ]
+    formulaFunctions = { 'log' : 'np.log', 'exp' : 'np.exp', 'pow' : 'np.power', 'max' : 'np.maximum', 'min' : 'np.minimum' }
+    inputVariables = [ 'JetPt', 'JetEta', 'JetA', 'Rho' ]
+    # version of the parsed tables that are stored in the cache directory
+    cacheVersion = 1
+
+    def __init__(self, fileName, cacheDir = None):
+        self.fileName = fileName
+        baseName = os.path.splitext(os.path.basename(self.fileName))[0]
+        cacheFile = get_cache_file(cacheDir, baseName, self.cacheVersion, [ self.fileName ])
+        if cacheFile and os.path.isfile(cacheFile):
+            table = load_arrays(cacheFile)
+        else:
+            table = self.parse()
+            if cacheFile:
+                save_arrays(cacheFile, **table)
+
+        self.formula = str(table['formula'])
+        self.parVarNames = [ str(parVarName) for parVarName in table['parVarNames'] ]
+        self.etaMin = table['etaMin']
+        self.etaMax = table['etaMax']
+        self.parMin = table['parMin']
+        self.parMax = table['parMax']
+        self.params = table['params']
+        self.expression = compile(self.translateFormula(self.formula), self.fileName, 'eval')
+
+    def parse(self):
+        with open(self.fileName, 'r') as fileObj:
+            lines = [ line.strip() for line in fileObj if line.strip() ]
+        if not lines or not (lines[0].startswith('{') and lines[0].endswith('}')):
+            raise ValueError("Missing header in file: %s" % self.fileName)
+
+        header = lines[0][1:-1].split()
+        if len(header) < 3 or header[0] != '1' or header[1] != 'JetEta':
+            raise ValueError("Expected a single binning variable JetEta in file: %s" % self.fileName)
+        nofParVars = int(header[2])
+        parVarNames = header[3:3 + nofParVars]
+        if len(header) < 4 + nofParVars or header[-1] != 'L1FastJet':
+            raise ValueError("Not a L1FastJet correction in file: %s" % self.fileName)
+        for parVarName in parVarNames:
+            if parVarName not in self.inputVariables:
+                raise ValueError("Invalid variable %s in file: %s" % (parVarName, self.fileName))
+        formula = header[3 + nofParVars]
+
+        rows = [ [ float(value) for value in line.split() ] for line in lines[1:] ]
+        nofColumns = set(len(row) for row in rows)
+        if len(nofColumns) != 1 or any(int(row[2]) != len(row) - 3 for row in rows):
+            raise ValueError("Inconsistent number of columns in file: %s" % self.fileName)
+        rows = np.array(rows)
+        if np.any(rows[1:, 0] != rows[:-1, 1]):
+            raise ValueError("Non-contiguous JetEta bins in file: %s" % self.fileName)
+
+        parRanges = rows[:, 3:3 + 2 * nofParVars]
+        return {
+            'formula'     : np.array(formula),
+            'parVarNames' : np.array(parVarNames),
+            'etaMin'      : rows[:, 0],
+            'etaMax'      : rows[:, 1],
+            'parMin'      : parRanges[:, 0::2],
+            'parMax'      : parRanges[:, 1::2],
+            'params'      : rows[:, 3 + 2 * nofParVars:],
+        }
+
+    def translateFormula(self, formula):
+        # turn the TFormula expression into a NumPy expression of the variables x, y, z and the parameters p; the
+        # numeric literals are matched first, so that the exponent of e.g. 1e-4 is not taken for an identifier
+        def translateToken(match):
+            token = match.group(0)
+            if token[0].isdigit() or token[0] == '.':
+                return token
+            if token.startswith('['):
+                return 'p[{}]'.format(token[1:-1])
+            if token in self.formulaFunctions:
+                return self.formulaFunctions[token]
+            if token in self.formulaVariables[:len(self.parVarNames)]:
+                return token
+            raise ValueError("Unsupported token '%s' in formula %s of file: %s" % (token, formula, self.fileName))
+        return re.sub(r'(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|\[\d+\]|[A-Za-z_]\w*', translateToken, formula)
+
+    def getCorrection(self, pt, eta, area, rho):
+        inputs = dict(zip(self.inputVariables, np.broadcast_arrays(
+            np.asarray(pt, dtype = np.float64), np.asarray(eta, dtype = np.float64),
+            np.asarray(area, dtype = np.float64), np.asarray(rho, dtype = np.float64),
+        )))
+        eta = inputs['JetEta']
+
+        binIdxs = np.searchsorted(self.etaMin, eta, side = 'right') - 1
+        inRange = (binIdxs >= 0) & (eta < self.etaMax[np.clip(binIdxs, 0, None)])
+        binIdxs = binIdxs[inRange]
+
+        variables = {
+            formulaVariable : np.clip(inputs[parVarName][inRange], self.parMin[binIdxs, parVarIdx], self.parMax[binIdxs, parVarIdx])
+            for parVarIdx, (formulaVariable, parVarName) in enumerate(zip(self.formulaVariables, self.parVarNames))
+        }
+        variables['p'] = self.params[binIdxs].T
+        variables['np'] = np
+
+        corrections = np.ones(eta.shape)
+        corrections[inRange] = eval(self.expression, { '__builtins__' : {} }, variables)
+        return corrections if corrections.ndim else float(corrections)
+
 class lepJetVarProducer(Module):
 
-    def __init__(self, era, btagAlgos):
+    def __init__(self, era, btagAlgos, cacheDir = None):
         # define lepton and jet branches and branch used to access energy densitity rho
         # (the latter is needed to compute L1 jet energy corrections)
         self.era = era
@@ -57,21 +170,15 @@ class lepJetVarProducer(Module):
         self.l1corrInputFilePath = os.path.join(self.l1corrInputFilePath, l1corrInputDirName)
         self.l1corrInputFileName = "{}_L1FastJet_AK4PFchs.txt".format(l1corrInputDirName)
 
-        # load libraries for accessing jet energy corrections from txt files
-        for library in [ "libCondFormatsJetMETObjects" ]:
-            if library not in ROOT.gSystem.GetLibraries():
-                print("Load Library '%s'" % library.replace("lib", ""))
-                ROOT.gSystem.Load(library)
+        # directory where the parsed corrections are cached in binary form (no caching if not set)
+        self.cacheDir = cacheDir
 
     def beginJob(self):
         # initialize L1 jet energy corrections
         # (cf. https://twiki.cern.ch/twiki/bin/view/CMSPublic/WorkBookJetEnergyCorrections#OffsetJEC )
         l1corrInputFileFullPath = os.path.join(self.l1corrInputFilePath, self.l1corrInputFileName)
         print("Loading L1 jet energy corrections from file '%s'" % l1corrInputFileFullPath)
-        self.l1corrParams = ROOT.JetCorrectorParameters(l1corrInputFileFullPath)
-        v_l1corrParams = getattr(ROOT, 'vector<JetCorrectorParameters>')()
-        v_l1corrParams.push_back(self.l1corrParams)
-        self.l1corr = ROOT.FactorizedJetCorrector(v_l1corrParams)
+        self.l1corr = L1FastJetCorrector(l1corrInputFileFullPath, self.cacheDir)
 
     def endJob(self):
         pass
@@ -94,7 +201,7 @@ class lepJetVarProducer(Module):
         else:
             return lepton.pt
 
-    def jetLepAwareJEC(self, lepton, jet, rho, isElectron):
+    def jetLepAwareJEC(self, lepton, jet, l1corrFactor, isElectron):
         corrFactor = (1. - jet.rawFactor)
         jet_rawPt = corrFactor*jet.pt
 
@@ -108,26 +215,20 @@ class lepJetVarProducer(Module):
         p4j = ROOT.TLorentzVector()
         p4j.SetPtEtaPhiM(jet.pt, jet.eta, jet.phi, jet.mass)
 
-        self.l1corr.setJetPt(jet_rawPt)
-        self.l1corr.setJetEta(jet.eta)
-        self.l1corr.setJetA(jet.area)
-        self.l1corr.setRho(rho)
-        l1corrFactor = self.l1corr.getCorrection()
-
         p4j_lepAware = (p4j * corrFactor - p4l * (1. / l1corrFactor)) * (1. / corrFactor) + p4l
         return p4j_lepAware
 
-    def getPtRatio(self, lepton, jet, rho, isElectron):
-        p4j_lepAware = self.jetLepAwareJEC(lepton, jet, rho, isElectron)
+    def getPtRatio(self, lepton, jet, l1corrFactor, isElectron):
+        p4j_lepAware = self.jetLepAwareJEC(lepton, jet, l1corrFactor, isElectron)
         lepton_pt_uncorr = self.getUncorrectedPt(lepton, isElectron)
         return min(lepton_pt_uncorr / p4j_lepAware.Pt(), 1.5)
 
-    def getPtRelv2(self, lepton, jet, rho, isElectron):
+    def getPtRelv2(self, lepton, jet, l1corrFactor, isElectron):
         lepton_pt_uncorr = self.getUncorrectedPt(lepton, isElectron)
         p4l = ROOT.TLorentzVector()
         p4l.SetPtEtaPhiM(lepton_pt_uncorr, lepton.eta, lepton.phi, lepton.mass)
 
-        p4j_lepAware = self.jetLepAwareJEC(lepton, jet, rho, isElectron)
+        p4j_lepAware = self.jetLepAwareJEC(lepton, jet, l1corrFactor, isElectron)
         p4j_minu_p4l = p4j_lepAware - p4l
 
         return 0. if p4j_minu_p4l.Rho() < 1e-4 else p4l.Perp(p4j_minu_p4l.Vect())
@@ -137,6 +238,12 @@ class lepJetVarProducer(Module):
         njets = len(jets)
         rho = getattr(event, self.rhoBranchName)
 
+        # evaluate the L1 corrections of all jets at once
+        jets_rawPt = np.array([ (1. - jet.rawFactor) * jet.pt for jet in jets ])
+        jets_eta   = np.array([ jet.eta  for jet in jets ])
+        jets_area  = np.array([ jet.area for jet in jets ])
+        jets_l1corrFactor = self.l1corr.getCorrection(jets_rawPt, jets_eta, jets_area, rho)
+
         for leptonBranchName in self.leptonBranchNames:
             leptons = Collection(event, leptonBranchName)
 
@@ -152,8 +259,9 @@ class lepJetVarProducer(Module):
                       leptons_jetBtagDiscr[btagAlgo].append(-1.)
                 else:
                     jet = jets[lepton.jetIdx]
-                    leptons_jetPtRatio.append(self.getPtRatio(lepton, jet, rho, leptonBranchName == self.electronBranchName))
-                    leptons_jetPtRelv2.append(self.getPtRelv2(lepton, jet, rho, leptonBranchName == self.electronBranchName))
+                    l1corrFactor = jets_l1corrFactor[lepton.jetIdx]
+                    leptons_jetPtRatio.append(self.getPtRatio(lepton, jet, l1corrFactor, leptonBranchName == self.electronBranchName))
+                    leptons_jetPtRelv2.append(self.getPtRelv2(lepton, jet, l1corrFactor, leptonBranchName == self.electronBranchName))
 
                     for btagAlgo in self.btagAlgos:
                       leptons_jetBtagDiscr[btagAlgo].append(getattr(jet, self.btagAlgoMap[btagAlgo]))
@@ -1,4 +1,5 @@
-from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import genAll
+from tthAnalysis.NanoAODTools.postprocessing.modules.genParticleProducer import genAll, genAllIndexed
+from tthAnalysis.NanoAODTools.postprocessing.modules.genDecayGraphProducer import genDecayGraph
 from tthAnalysis.NanoAODTools.postprocessing.modules.genMatchCollectionProducer import genMatchCollection
 from tthAnalysis.NanoAODTools.postprocessing.modules.lepJetVarProducer import lepJetVarBTagAll_2016, lepJetVarBTagAll_2017, lepJetVarBTagAll_2018
 from tthAnalysis.NanoAODTools.postprocessing.modules.genHiggsDecayModeProducer import genHiggsDecayMode
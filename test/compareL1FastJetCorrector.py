@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Compares the L1FastJet corrections of L1FastJetCorrector with the ones of FactorizedJetCorrector for the given
+# JetCorrectorParameters txt files (by default, all L1FastJet files in the data directory of this package), at random
+# values of (pt, eta, area, rho) that also cover the regions outside of the ranges of the parameterization.
+# Exits with a non-zero status if any correction disagrees, or if the comparison cannot be made; it is run as a unit
+# test of the package by scram b runtests (see BuildFile.xml).
+#
+# Usage: python compareL1FastJetCorrector.py [-i <txt files>] [-n <number of jets per file>]
+
+import ROOT
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+from tthAnalysis.NanoAODTools.postprocessing.modules.lepJetVarProducer import L1FastJetCorrector
+
+RELATIVE_TOLERANCE = 1e-6
+
+def get_reference(corrector, pt, eta, area, rho):
+  corrections = np.zeros(len(pt))
+  for jetIdx in range(len(pt)):
+    corrector.setJetPt(pt[jetIdx])
+    corrector.setJetEta(eta[jetIdx])
+    corrector.setJetA(area[jetIdx])
+    corrector.setRho(rho[jetIdx])
+    corrections[jetIdx] = corrector.getCorrection()
+  return corrections
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', dest = 'input', metavar = 'file', required = False, type = str, nargs = '+',
+                    default = sorted(glob.glob(os.path.join(
+                      os.environ['CMSSW_BASE'], 'src', 'tthAnalysis', 'NanoAODTools', 'data', '*L1FastJet*.txt'
+                    ))),
+                    help = 'JetCorrectorParameters txt files')
+parser.add_argument('-n', '--nof-jets', dest = 'nof_jets', metavar = 'number', required = False, type = int,
+                    default = 100000, help = 'Number of jets per file')
+args = parser.parse_args()
+
+if not args.input:
+  print("No JetCorrectorParameters files to compare")
+  sys.exit(1)
+if ROOT.gSystem.Load('libCondFormatsJetMETObjects') < 0:
+  print("Failed to load FactorizedJetCorrector")
+  sys.exit(1)
+
+rng = np.random.RandomState(12345)
+pt   = np.exp(rng.uniform(np.log(1.), np.log(8000.), args.nof_jets))
+eta  = rng.uniform(-5.5, 5.5, args.nof_jets)
+area = rng.uniform(0., 1.2, args.nof_jets)
+rho  = rng.uniform(0., 80., args.nof_jets)
+
+isFailed = False
+for fileName in args.input:
+  corrections = L1FastJetCorrector(fileName).getCorrection(pt, eta, area, rho)
+
+  parameters = ROOT.vector('JetCorrectorParameters')()
+  parameters.push_back(ROOT.JetCorrectorParameters(fileName))
+  corrections_ref = get_reference(ROOT.FactorizedJetCorrector(parameters), pt, eta, area, rho)
+
+  isClose = np.isclose(corrections, corrections_ref, rtol = RELATIVE_TOLERANCE, atol = 0.)
+  print("%s: %d out of %d corrections agree" % (os.path.basename(fileName), isClose.sum(), len(isClose)))
+  for jetIdx in np.flatnonzero(~isClose)[:10]:
+    print("  pt = %.3f, eta = %.3f, area = %.3f, rho = %.3f: %.8g vs %.8g" % (
+      pt[jetIdx], eta[jetIdx], area[jetIdx], rho[jetIdx], corrections[jetIdx], corrections_ref[jetIdx]
+    ))
+  if not isClose.all():
+    isFailed = True
+
+sys.exit(1 if isFailed else 0)